@@ -0,0 +1,67 @@
+"""
+Shared helpers for the relay benchmarks.
+
+The relay lives in a script with a hyphenated file name, so it is loaded
+here by path instead of being imported as a module.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RELAY_SCRIPT = os.path.join(REPO_ROOT, "file-relay-system_1.py")
+
+
+# Load file-relay-system_1.py as a module, optionally overriding CONFIG entries
+def load_relay(config_overrides=None, log_level=logging.WARNING):
+    module = sys.modules.get("file_relay")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("file_relay", RELAY_SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["file_relay"] = module
+        spec.loader.exec_module(module)
+    if config_overrides:
+        module.CONFIG.update(config_overrides)
+    module.setup_logging()
+    logging.getLogger().setLevel(log_level)
+    return module
+
+
+# Percentile of an unsorted list of numbers (nearest-rank)
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+# Print results as a table and optionally save them as JSON
+def report(results, output=None):
+    for row in results:
+        print("  ".join(f"{key}={value}" for key, value in row.items()))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {output}")
+
+
+# Print how results moved against a JSON file saved by an earlier run
+def compare(results, baseline_path, key_fields, metrics):
+    with open(baseline_path) as f:
+        baseline = {tuple(row.get(k) for k in key_fields): row for row in json.load(f)}
+    print(f"Compared with {baseline_path}:")
+    for row in results:
+        key = tuple(row.get(k) for k in key_fields)
+        old = baseline.get(key)
+        if old is None:
+            continue
+        changes = []
+        for metric in metrics:
+            before, after = old.get(metric), row.get(metric)
+            if before and after is not None:
+                changes.append(f"{metric} {before} -> {after} ({(after - before) / before * 100:+.1f}%)")
+        print("/".join(str(k) for k in key) + "  " + "  ".join(changes))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+FileReceiver receive-path throughput benchmark
+
+Uploads files over loopback to an in-process receiver (threaded FileReceiver
+or AsyncFileReceiver) and reports MB/s for each receive strategy. The "recv"
+strategy with 4 KiB chunks is the original receive loop and serves as the
+baseline.
+"""
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import load_relay, report
+
+# (strategy, chunk size) combinations measured by default
+CASES = [
+    ("recv", 4096),
+    ("recv", 262144),
+    ("recv_into", 65536),
+    ("recv_into", 262144),
+    ("recv_into", 1048576),
+    ("splice", 262144),
+    ("splice", 1048576),
+]
+
+
+# Upload one file using the legacy header/ACK/SUCCESS protocol
+def upload(port, file_name, payload, send_chunk):
+    sock = socket.create_connection(("127.0.0.1", port))
+    try:
+        header = json.dumps({"file_name": file_name, "file_size": len(payload)})
+        sock.sendall(header.encode("utf-8"))
+        if sock.recv(3) != b"ACK":
+            raise RuntimeError("Receiver did not acknowledge header")
+        view = memoryview(payload)
+        for offset in range(0, len(payload), send_chunk):
+            sock.sendall(view[offset:offset + send_chunk])
+        reply = sock.recv(1024)
+        if reply != b"SUCCESS":
+            raise RuntimeError(f"Upload failed: {reply!r}")
+    finally:
+        sock.close()
+
+
+def run_case(relay, port, strategy, chunk_size, payload, repeat):
+    relay.CONFIG["recv_strategy"] = strategy
+    relay.CONFIG["recv_chunk_size"] = chunk_size
+    start = time.perf_counter()
+    for i in range(repeat):
+        upload(port, f"bench_{strategy}_{chunk_size}_{i}.bin", payload, 1048576)
+    elapsed = time.perf_counter() - start
+    return {
+        "strategy": strategy,
+        "chunk_size": chunk_size,
+        "files": repeat,
+        "bytes": len(payload) * repeat,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(len(payload) * repeat / elapsed / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive-path throughput benchmark")
+    parser.add_argument("--size-mb", type=int, default=256, help="Size of each uploaded file in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="Uploads per case")
+    parser.add_argument("--receiver", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--dir", help="Directory receiving the files (defaults to a temp dir)")
+    parser.add_argument("--output", help="Save results as JSON to this path")
+    args = parser.parse_args()
+
+    incoming_dir = args.dir or tempfile.mkdtemp(prefix="relay_bench_")
+    staging_dir = os.path.join(incoming_dir, ".staging")
+    os.makedirs(staging_dir, exist_ok=True)
+    relay = load_relay({"incoming_dir": incoming_dir, "staging_dir": staging_dir,
+                        "outgoing_dir": os.path.join(incoming_dir, ".outgoing"),
+                        "receiver_mode": args.receiver})
+    relay.CONFIG["cut_through"]["enabled"] = False    # Measure the receive path alone
+
+    receiver = relay.create_file_receiver(host="127.0.0.1", port=0)
+    server_thread = threading.Thread(target=receiver.start, daemon=True)
+    server_thread.start()
+    receiver.ready.wait(5)
+    if args.receiver == "asyncio":
+        port = receiver.server.sockets[0].getsockname()[1]
+    else:
+        port = receiver.server_socket.getsockname()[1]
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    results = []
+    for strategy, chunk_size in CASES:
+        # The asyncio receiver reads into a reused buffer for anything but "recv"
+        if strategy == "splice" and (args.receiver == "asyncio" or not hasattr(os, "splice")):
+            continue
+        results.append(run_case(relay, port, strategy, chunk_size, payload, args.repeat))
+        for entry in os.scandir(incoming_dir):
+            if entry.is_file():
+                os.remove(entry.path)
+
+    report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
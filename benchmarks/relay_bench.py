@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+End-to-end relay benchmark
+
+Runs the whole relay in-process against N stand-in Pis (paramiko SFTP
+servers on loopback, optionally behind a netem-style link with latency,
+jitter and a bandwidth limit) and pushes synthetic workloads through each
+ingest path:
+
+    legacy   uploads to the FileReceiver with the header/ACK/SUCCESS protocol
+    framed   pipelined batches to the FileReceiver with send_files()
+    watched  files written straight into the watched incoming_dir
+
+Workloads are many small files, a few huge images and a mix of sizes, spread
+over single-Pi, paired and "all" routing patterns. Each run reports files/s,
+MB/s and p50/p99 latency per stage:
+
+    ingest   client starts sending -> file published into incoming_dir
+             (framed batches start when their connection does)
+    detect   published -> watcher hands the file to the ingest queue
+    queue    handed to the ingest queue -> relay worker picks it up
+    relay    picked up (or published, for cut-through) -> last Pi done
+    e2e      client starts sending -> last Pi done
+
+Cut-through uploads skip detect and queue. Results can be saved as JSON and
+compared against an earlier run with --baseline.
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from common import compare, load_relay, percentile, report
+from sftp_server import LocalSFTPServer
+
+STAGES = ("ingest", "detect", "queue", "relay", "e2e")
+INGEST_MODES = ("legacy", "framed", "watched")
+LINK_CHUNK = 65536
+
+
+# One direction of a shaped link: a propagation delay (plus jitter) and a
+# serialisation delay at the given rate, like netem delay/rate on an interface
+def _shape(src, dst, latency, jitter, rate):
+    chunks = queue.Queue()
+
+    def read():
+        try:
+            while True:
+                data = src.recv(LINK_CHUNK)
+                chunks.put((time.monotonic() + latency + random.uniform(0, jitter), data))
+                if not data:
+                    return
+        except OSError:
+            chunks.put((0, b""))
+
+    threading.Thread(target=read, daemon=True).start()
+    link_free = 0.0
+    try:
+        while True:
+            due, data = chunks.get()
+            if not data:
+                break
+            start = max(due, link_free, time.monotonic())
+            delay = start - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            dst.sendall(data)
+            link_free = start + (len(data) / rate if rate else 0)
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        src.close()
+        dst.close()
+
+
+class ShapedSFTPServer(LocalSFTPServer):
+    """Stand-in Pi reached over a link with added latency and limited bandwidth."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, bandwidth_mbit=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.rate = bandwidth_mbit * 1e6 / 8
+
+    def wrap_socket(self, client):
+        if not (self.latency or self.jitter or self.rate):
+            return client
+        server_end, relay_end = socket.socketpair()
+        for src, dst in ((client, relay_end), (relay_end, client)):
+            threading.Thread(target=_shape, args=(src, dst, self.latency, self.jitter, self.rate),
+                             daemon=True).start()
+        return server_end
+
+
+# Per-file stage timestamps, collected from hooks around the relay pipeline
+class StageClock:
+    def __init__(self):
+        self.marks = {}
+        self.failed = 0
+        self.cond = threading.Condition()
+
+    def mark(self, file_name, stage, when=None):
+        with self.cond:
+            self.marks.setdefault(file_name, {}).setdefault(stage, when or time.perf_counter())
+            if stage == "done":
+                self.cond.notify_all()
+
+    def finished(self, names):
+        return sum(1 for name in names if "done" in self.marks.get(name, {}))
+
+    def wait(self, names, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.finished(names) == len(names), timeout)
+
+    def latencies(self, names):
+        spans = {
+            "ingest": ("start", "ingested"),
+            "detect": ("ingested", "detected"),
+            "queue": ("detected", "dequeued"),
+            "e2e": ("start", "done"),
+        }
+        values = {stage: [] for stage in STAGES}
+        with self.cond:
+            for name in names:
+                marks = self.marks.get(name, {})
+                for stage, (begin, end) in spans.items():
+                    if begin in marks and end in marks:
+                        values[stage].append(marks[end] - marks[begin])
+                begin = marks.get("dequeued", marks.get("ingested"))
+                if begin is not None and "done" in marks:
+                    values["relay"].append(marks["done"] - begin)
+        return values
+
+
+# Route the relay's hand-offs through the clock
+def instrument(relay, clock):
+    publish_incoming_file = relay.publish_incoming_file
+    relay_file = relay.relay_file_to_raspberry_pis
+    save_transfer_log = relay.save_transfer_log
+
+    def published(part_path, file_name):
+        dest_path = publish_incoming_file(part_path, file_name)
+        clock.mark(file_name, "ingested")
+        return dest_path
+
+    def dequeued(file_path, on_complete=None):
+        clock.mark(os.path.basename(file_path), "dequeued")
+        return relay_file(file_path, on_complete)
+
+    def saved(transfer_log):
+        if any(d["status"] != "success" for d in transfer_log["destinations"]):
+            with clock.cond:
+                clock.failed += 1
+        clock.mark(transfer_log["file_name"], "done")
+        return save_transfer_log(transfer_log)
+
+    relay.publish_incoming_file = published
+    relay.relay_file_to_raspberry_pis = dequeued
+    relay.save_transfer_log = saved
+
+
+# Routing patterns over pi0..piN-1: one Pi, two neighbouring Pis, or all of them
+def routing_patterns(pi_names):
+    patterns = {f"{name}_": [name] for name in pi_names}
+    if len(pi_names) > 1:
+        for i, name in enumerate(pi_names):
+            patterns[f"pair{i}_"] = [name, pi_names[(i + 1) % len(pi_names)]]
+    patterns["all_"] = "all"
+    return patterns
+
+
+# Log-like text that compresses well, standing in for config and log files
+def text_payload(size):
+    line = b"2026-01-01T00:00:00 INFO relay sensor=%04d value=%08d status=ok\n"
+    out = bytearray()
+    i = 0
+    while len(out) < size:
+        out += line % (i % 10000, i * 7919 % 100000000)
+        i += 1
+    return bytes(out[:size])
+
+
+# (file name, size, kind) for every file of a workload
+def workload_files(workload, args, patterns):
+    rng = random.Random(workload)
+    single = [p for p in patterns if not p.startswith(("pair", "all"))]
+    if workload == "small":
+        return [(f"{single[i % len(single)]}small_{i}.cfg", args.small_kb * 1024, "text")
+                for i in range(args.small_count)]
+    if workload == "large":
+        return [(f"all_large_{i}.img", args.large_mb * 1024 * 1024, "random")
+                for i in range(args.large_count)]
+    files = []
+    for i in range(args.mixed_count):
+        size = int(min(rng.lognormvariate(11, 2), args.large_mb * 1024 * 1024))
+        kind = rng.choice(("text", "random"))
+        files.append((f"{rng.choice(list(patterns))}mixed_{i}.{'log' if kind == 'text' else 'bin'}", size, kind))
+    return files
+
+
+def write_sources(source_dir, files):
+    os.makedirs(source_dir, exist_ok=True)
+    paths = []
+    for file_name, size, kind in files:
+        path = os.path.join(source_dir, file_name)
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining:
+                n = min(remaining, 16 * 1024 * 1024)
+                f.write(text_payload(n) if kind == "text" else os.urandom(n))
+                remaining -= n
+        paths.append(path)
+    return paths
+
+
+# Upload one file with the legacy header/ACK/SUCCESS protocol
+def legacy_upload(port, path):
+    file_name = os.path.basename(path)
+    with socket.create_connection(("127.0.0.1", port)) as sock, open(path, "rb") as f:
+        header = json.dumps({"file_name": file_name, "file_size": os.path.getsize(path)})
+        sock.sendall(header.encode("utf-8"))
+        if sock.recv(3) != b"ACK":
+            raise RuntimeError("Receiver did not acknowledge header")
+        sock.sendfile(f)
+        reply = sock.recv(1024)
+        if reply != b"SUCCESS":
+            raise RuntimeError(f"Upload of {file_name} failed: {reply!r}")
+
+
+# Write a file in place in incoming_dir, as scp or a local producer would.
+# Returns when the last byte was written, just before the close the watcher sees.
+def watched_write(incoming_dir, path):
+    with open(path, "rb") as src, open(os.path.join(incoming_dir, os.path.basename(path)), "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+        dst.flush()
+        return time.perf_counter()
+
+
+# Feed files through one ingest path with several concurrent clients
+def drive(relay, clock, mode, port, jobs, clients, batch):
+    work = queue.Queue()
+    if mode == "framed":
+        for i in range(0, len(jobs), batch):
+            work.put(jobs[i:i + batch])
+    else:
+        for job in jobs:
+            work.put([job])
+    errors = []
+
+    def client():
+        while True:
+            try:
+                group = work.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            for path in group:
+                clock.mark(os.path.basename(path), "start", start)
+            try:
+                if mode == "framed":
+                    acks = relay.send_files("127.0.0.1", port, group)
+                    failed = [name for name, ack in acks.items() if ack["status"] != "ok"]
+                    if failed or len(acks) != len(group):
+                        raise RuntimeError(f"Framed batch incomplete: {len(acks)} acks, failed {failed}")
+                elif mode == "legacy":
+                    legacy_upload(port, group[0])
+                else:
+                    written = watched_write(relay.CONFIG["incoming_dir"], group[0])
+                    clock.mark(os.path.basename(group[0]), "ingested", written)
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def run(relay, clock, workload, mode, port, sources, args):
+    # Hardlinks named uniquely per run that keep their routing prefix, e.g. pi0_legacy_small_3.cfg
+    mode_dir = os.path.join(os.path.dirname(sources[0]), mode)
+    os.makedirs(mode_dir, exist_ok=True)
+    jobs = []
+    for path in sources:
+        job = os.path.join(mode_dir, os.path.basename(path).replace("_", f"_{mode}_", 1))
+        os.link(path, job)
+        jobs.append(job)
+    names = [os.path.basename(job) for job in jobs]
+    total_bytes = sum(os.path.getsize(path) for path in sources)
+
+    start = time.perf_counter()
+    errors = drive(relay, clock, mode, port, jobs, args.clients, args.batch)
+    completed = clock.wait(names, args.timeout)
+    end = max((clock.marks[name]["done"] for name in names if "done" in clock.marks.get(name, {})),
+              default=time.perf_counter())
+    elapsed = max(end - start, 1e-9)
+
+    done = clock.finished(names)
+    row = {
+        "workload": workload,
+        "ingest": mode,
+        "files": len(names),
+        "completed": done,
+        "failed": clock.failed,
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(done / elapsed, 1),
+        "mb_per_s": round(total_bytes * done / len(names) / elapsed / 1e6, 1) if names else 0,
+    }
+    for stage, values in clock.latencies(names).items():
+        for pct in (50, 99):
+            value = percentile(values, pct)
+            row[f"{stage}_p{pct}_ms"] = round(value * 1000, 1) if value is not None else None
+    if errors:
+        row["errors"] = errors[:5]
+    if not completed:
+        print(f"{workload}/{mode}: only {done} of {len(names)} files relayed within {args.timeout}s")
+    with clock.cond:
+        clock.failed = 0
+    return row
+
+
+# Empty the relay's directories and the stand-in Pis' target directories between runs
+def clean(relay, pi_dirs):
+    for directory in [relay.CONFIG["incoming_dir"], relay.CONFIG["outgoing_dir"]] + pi_dirs:
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                os.remove(entry.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end relay benchmark")
+    parser.add_argument("--pis", type=int, default=3, help="Number of stand-in Pis")
+    parser.add_argument("--latency-ms", type=float, default=0, help="One-way delay added to each Pi link")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra delay on each Pi link")
+    parser.add_argument("--bandwidth-mbit", type=float, default=0, help="Rate limit per Pi link (0 = unlimited)")
+    parser.add_argument("--workload", nargs="+", choices=["small", "large", "mixed"],
+                        default=["small", "large", "mixed"])
+    parser.add_argument("--ingest", nargs="+", choices=INGEST_MODES, default=list(INGEST_MODES))
+    parser.add_argument("--receiver", choices=["asyncio", "threaded"], default="asyncio")
+    parser.add_argument("--small-count", type=int, default=1000, help="Files in the small workload")
+    parser.add_argument("--small-kb", type=int, default=16, help="Size of each small file in KB")
+    parser.add_argument("--large-count", type=int, default=3, help="Files in the large workload")
+    parser.add_argument("--large-mb", type=int, default=128, help="Size of each large file in MB")
+    parser.add_argument("--mixed-count", type=int, default=200, help="Files in the mixed workload")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent senders")
+    parser.add_argument("--batch", type=int, default=32, help="Files per framed connection")
+    parser.add_argument("--no-cut-through", action="store_true", help="Relay uploads only once complete")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for each run to finish")
+    parser.add_argument("--dir", help="Working directory (defaults to a temp dir, removed afterwards)")
+    parser.add_argument("--output", help="Save results as JSON to this path")
+    parser.add_argument("--baseline", help="Compare against results saved earlier with --output")
+    args = parser.parse_args()
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix="relay_bench_")
+    incoming_dir = os.path.join(work_dir, "incoming")
+    relay = load_relay({
+        "incoming_dir": incoming_dir,
+        "staging_dir": os.path.join(incoming_dir, ".staging"),
+        "outgoing_dir": os.path.join(work_dir, "outgoing"),
+        "log_dir": os.path.join(work_dir, "logs"),
+        "receiver_mode": args.receiver,
+    })
+    relay.CONFIG["cut_through"]["enabled"] = not args.no_cut_through
+    relay.CONFIG["ingest_queue"]["state_file"] = None
+    relay.CONFIG["journal"]["dir"] = None
+    relay.CONFIG["delta_transfer"]["remote_dir"] = os.path.join(work_dir, ".file_relay")
+
+    servers = []
+    pi_dirs = []
+    pis = []
+    for i in range(args.pis):
+        server = ShapedSFTPServer(args.latency_ms, args.jitter_ms, args.bandwidth_mbit,
+                                  window_size=64 * 1024 * 1024).start()
+        pi_dir = os.path.join(work_dir, f"pi{i}")
+        os.makedirs(pi_dir)
+        servers.append(server)
+        pi_dirs.append(pi_dir)
+        pis.append(server.pi_config(f"pi{i}", pi_dir))
+    patterns = routing_patterns([pi["name"] for pi in pis])
+    relay.CONFIG.update({"raspberry_pis": pis, "file_patterns": patterns, "default_target": "all"})
+    relay.ROUTER = relay.FileRouter(relay.CONFIG)
+    relay.ensure_directories()
+
+    clock = StageClock()
+    instrument(relay, clock)
+    relay.INGEST_QUEUE = relay.IngestQueue(**relay.CONFIG["ingest_queue"])
+    relay.INGEST_QUEUE.start()
+
+    def on_ready(file_path):
+        clock.mark(os.path.basename(file_path), "detected")
+        relay.INGEST_QUEUE.put(file_path)
+
+    observer = relay.create_observer()
+    handler = relay.NewFileHandler(on_ready, close_events=relay.observer_has_close_events(observer))
+    observer.schedule(handler, incoming_dir, recursive=True)
+    observer.start()
+
+    receiver = relay.create_file_receiver(host="127.0.0.1", port=0)
+    threading.Thread(target=receiver.start, daemon=True).start()
+    port = None
+    while port is None:
+        time.sleep(0.01)
+        listener = getattr(receiver, "server_socket", None)
+        if listener is None and getattr(receiver, "server", None) and receiver.server.sockets:
+            listener = receiver.server.sockets[0]
+        if listener is not None and listener.getsockname()[1]:
+            port = listener.getsockname()[1]
+
+    settings = {"pis": args.pis, "latency_ms": args.latency_ms, "bandwidth_mbit": args.bandwidth_mbit,
+                "receiver": args.receiver, "cut_through": not args.no_cut_through}
+    results = []
+    try:
+        for workload in args.workload:
+            sources = write_sources(os.path.join(work_dir, "source", workload),
+                                    workload_files(workload, args, patterns))
+            for mode in args.ingest:
+                row = dict(settings)
+                row.update(run(relay, clock, workload, mode, port, sources, args))
+                results.append(row)
+                clean(relay, pi_dirs)
+            shutil.rmtree(os.path.join(work_dir, "source", workload))
+    finally:
+        observer.stop()
+        observer.join()
+        relay.INGEST_QUEUE.stop()
+        relay.RETRY_SCHEDULER.stop()
+        relay.FANOUT.stop()
+        relay.SFTP_POOL.close()
+        for server in servers:
+            server.stop()
+        if relay.JOURNAL:
+            relay.JOURNAL.close()
+        if not args.dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(results, args.output)
+    if args.baseline:
+        compare(results, args.baseline, ("workload", "ingest"),
+                ("files_per_s", "mb_per_s", "e2e_p50_ms", "e2e_p99_ms"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+In-process paramiko SSH/SFTP server used as a stand-in Raspberry Pi.
+
+Serves the local filesystem over SFTP on a loopback port and runs exec
+requests (mkdir -p, sha256sum, the delta helper) with /bin/sh, which is
+everything the relay needs from a Pi. Any user name and password is accepted.
+"""
+
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTP_OK,
+    Channel,
+    ServerInterface,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+)
+
+
+class _SSHServer(ServerInterface):
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        # Started by _Transport once the request has been acknowledged
+        channel.pending_exec = command.decode("utf-8")
+        return True
+
+
+# Handle a channel request, then start the exec command it accepted, if any
+def _handle_channel_request(channel, m):
+    Channel._handle_request(channel, m)
+    command = getattr(channel, "pending_exec", None)
+    if command is not None:
+        channel.pending_exec = None
+        threading.Thread(target=_run_exec, args=(channel, command), daemon=True).start()
+
+
+class _Transport(paramiko.Transport):
+    """Transport that starts exec commands only after replying to the request.
+
+    paramiko sends the reply to a channel request after
+    check_channel_exec_request returns and has no hook after that. A command
+    started from the check itself can send its exit status and close the
+    channel first, and the client then fails with "Channel closed". This
+    overrides the (private) channel request handler table to start the
+    command after the reply is out; it is the only paramiko internal the
+    server relies on.
+    """
+
+    _channel_handler_table = {
+        **paramiko.Transport._channel_handler_table,
+        paramiko.common.MSG_CHANNEL_REQUEST: _handle_channel_request,
+    }
+
+
+# Run an exec request, streaming the channel into the command's stdin
+def _run_exec(channel, command):
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        try:
+            while True:
+                data = channel.recv(1024 * 1024)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        finally:
+            proc.stdin.close()
+
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    stdout, stderr = proc.stdout.read(), proc.stderr.read()
+    proc.wait()
+    channel.sendall(stdout)
+    channel.sendall_stderr(stderr)
+    channel.send_exit_status(proc.returncode)
+    channel.close()
+
+
+class _FileHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _LocalSFTP(SFTPServerInterface):
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _FileHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            return SFTPServer.convert_errno(17)
+        os.rename(oldpath, newpath)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class LocalSFTPServer:
+    """SSH/SFTP server on 127.0.0.1 that accepts any credentials."""
+
+    host_key = None
+
+    def __init__(self, window_size=16 * 1024 * 1024, max_packet_size=32768):
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.sock = None
+        self.port = None
+        self.transports = []
+        if LocalSFTPServer.host_key is None:
+            LocalSFTPServer.host_key = paramiko.RSAKey.generate(2048)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def wrap_socket(self, client):
+        """Hook for subclasses that shape the connection (see relay_bench.py)."""
+        return client
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = _Transport(
+                self.wrap_socket(client),
+                default_window_size=self.window_size,
+                default_max_packet_size=self.max_packet_size,
+            )
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, _LocalSFTP)
+            try:
+                transport.start_server(server=_SSHServer())
+            except (paramiko.SSHException, EOFError):
+                transport.close()         # Client left during the handshake, e.g. a liveness probe
+                continue
+            self.transports.append(transport)
+
+    def pi_config(self, name, target_dir):
+        """Raspberry Pi entry for the relay CONFIG pointing at this server."""
+        return {
+            "name": name,
+            "ip": "127.0.0.1",
+            "port": self.port,
+            "user": "bench",
+            "password": "bench",
+            "target_dir": target_dir,
+        }
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+SFTP upload throughput benchmark
+
+Uploads a file to an in-process paramiko SFTP server (a stand-in Pi) with
+the original sftp.put path and with the relay's pipelined upload engine
+under different window, request size, read mode and cipher settings, and
+reports MB/s for each.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import paramiko
+
+from common import load_relay, report
+from sftp_server import LocalSFTPServer
+
+# sftp_engine overrides measured by default
+CASES = [
+    {"window_size": 2 * 1024 * 1024, "ciphers": ["aes128-ctr"]},
+    {"window_size": 16 * 1024 * 1024, "ciphers": ["aes128-ctr"]},
+    {"window_size": 16 * 1024 * 1024, "ciphers": ["aes128-ctr"], "request_size": 131072},
+    {"window_size": 16 * 1024 * 1024, "ciphers": ["aes128-ctr"], "read_mode": "mmap"},
+    {"window_size": 16 * 1024 * 1024, "ciphers": ["aes128-gcm@openssh.com"]},
+    {"window_size": 16 * 1024 * 1024, "ciphers": ["aes256-ctr"]},
+]
+
+
+# The original send path: fresh SSHClient with paramiko defaults and sftp.put
+def baseline_put(server, source, target):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect("127.0.0.1", port=server.port, username="bench", password="bench")
+    try:
+        sftp = ssh.open_sftp()
+        sftp.put(source, target)
+        sftp.close()
+    finally:
+        ssh.close()
+
+
+def measure(label, settings, repeat, size, send):
+    start = time.perf_counter()
+    for i in range(repeat):
+        send(i)
+    elapsed = time.perf_counter() - start
+    row = {"case": label}
+    row.update(settings)
+    row.update({"seconds": round(elapsed, 3), "mb_per_s": round(size * repeat / elapsed / 1e6, 1)})
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SFTP upload throughput benchmark")
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the uploaded file in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="Uploads per case")
+    parser.add_argument("--output", help="Save results as JSON to this path")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="sftp_bench_")
+    target_dir = os.path.join(work_dir, "pi")
+    os.makedirs(target_dir)
+    source = os.path.join(work_dir, "payload.bin")
+    size = args.size_mb * 1024 * 1024
+    with open(source, "wb") as f:
+        f.write(os.urandom(size))
+
+    relay = load_relay({"log_dir": os.path.join(work_dir, "logs")})
+    relay.CONFIG["delta_transfer"]["enabled"] = False
+    relay.CONFIG["resumable"]["verify"] = "size"
+
+    server = LocalSFTPServer(window_size=64 * 1024 * 1024).start()
+    results = []
+    try:
+        results.append(measure("sftp.put", {}, args.repeat, size,
+                               lambda i: baseline_put(server, source, os.path.join(target_dir, f"base_{i}"))))
+        for n, settings in enumerate(CASES):
+            pi = server.pi_config(f"bench{n}", target_dir)
+            pi["sftp_engine"] = settings
+
+            def send(i, pi=pi):
+                with relay.SFTP_POOL.session(pi) as (conn, sftp):
+                    relay.put_resumable(conn, sftp, source, os.path.join(target_dir, f"{pi['name']}_{i}"), pi)
+
+            send(-1)  # Connect and warm up outside the measurement
+            results.append(measure("engine", settings, args.repeat, size, send))
+    finally:
+        relay.SFTP_POOL.close()
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,12 @@ import socket
 import threading
 import argparse
 from pathlib import Path
-import paramiko
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+
+# paramiko and watchdog are imported where they are first used, so the
+# receiver is accepting uploads before the SSH stack has been loaded
+
+# Startup milestones are reported relative to this
+START_TIME = time.monotonic()
 
 # Configuration
 CONFIG = {
@@ -35,7 +38,8 @@ CONFIG = {
     ],
     "server_port": 8000,                  # Port for receiving files via network
     "enable_sftp": True,                  # Enable SFTP server for file reception
-    "sftp_port": 2222                     # Port for SFTP server
+    "sftp_port": 2222,                    # Port for SFTP server
+    "ssh_timeout": 10                     # Seconds for each of TCP connect, SSH banner and authentication
 }
 
 # Setup logging
@@ -56,7 +60,12 @@ def setup_logging():
     
     return logging.getLogger("FileRelay")
 
-logger = setup_logging()
+# Handlers are installed by setup_logging() once the configuration is known
+logger = logging.getLogger("FileRelay")
+
+# Log how long after start a milestone was reached
+def log_startup_phase(phase):
+    logger.info(f"Startup: {phase} {time.monotonic() - START_TIME:.3f}s after start")
 
 # Ensure directories exist
 def ensure_directories():
@@ -65,7 +74,12 @@ def ensure_directories():
         logger.info(f"Ensured directory exists: {dir_path}")
 
 # File handler for detecting new files
-class NewFileHandler(FileSystemEventHandler):
+class NewFileHandler:
+    # Called by the observer for every event, like FileSystemEventHandler.dispatch
+    def dispatch(self, event):
+        if event.event_type == "created":
+            self.on_created(event)
+    
     def on_created(self, event):
         if event.is_directory:
             return
@@ -79,6 +93,39 @@ class NewFileHandler(FileSystemEventHandler):
         # Process the file (relay to all Raspberry Pis)
         relay_file_to_raspberry_pis(file_path)
 
+# Files in incoming_dir written after their latest transfer log (or with
+# none), i.e. ones that arrived while the relay was not running
+def find_backlog():
+    # transfer_<YYYYmmdd_HHMMSS>_<file name>.json, written once the transfer finished
+    prefix_length = len("transfer_YYYYmmdd_HHMMSS_")
+    relayed = {}
+    with os.scandir(CONFIG["log_dir"]) as entries:
+        for entry in entries:
+            if entry.name.startswith("transfer_") and entry.name.endswith(".json"):
+                file_name = entry.name[prefix_length:-len(".json")]
+                relayed[file_name] = max(entry.stat().st_mtime, relayed.get(file_name, 0))
+    
+    backlog = []
+    with os.scandir(CONFIG["incoming_dir"]) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime > relayed.get(entry.name, 0):
+                backlog.append(entry.path)
+    return backlog
+
+# Relay whatever arrived while the service was down
+def relay_backlog():
+    try:
+        backlog = find_backlog()
+    except Exception as e:
+        logger.error(f"Backlog scan of {CONFIG['incoming_dir']} failed: {str(e)}")
+        return
+    logger.info(f"Backlog scan found {len(backlog)} unrelayed files in {CONFIG['incoming_dir']}")
+    for file_path in backlog:
+        try:
+            relay_file_to_raspberry_pis(file_path)
+        except Exception as e:
+            logger.error(f"Failed to relay {file_path}: {str(e)}")
+
 # Relay file to all Raspberry Pis
 def relay_file_to_raspberry_pis(file_path):
     file_name = os.path.basename(file_path)
@@ -128,6 +175,7 @@ def relay_file_to_raspberry_pis(file_path):
 
 # Send file via SFTP
 def send_file_via_sftp(file_path, pi_config):
+    import paramiko
     logger.info(f"Sending {file_path} to {pi_config['name']} ({pi_config['ip']})")
     
     ssh = paramiko.SSHClient()
@@ -137,7 +185,10 @@ def send_file_via_sftp(file_path, pi_config):
         ssh.connect(
             pi_config["ip"],
             username=pi_config["user"],
-            password=pi_config["password"]
+            password=pi_config["password"],
+            timeout=CONFIG["ssh_timeout"],
+            banner_timeout=CONFIG["ssh_timeout"],
+            auth_timeout=CONFIG["ssh_timeout"]
         )
         
         # Create target directory if it doesn't exist
@@ -168,9 +219,14 @@ class FileReceiver:
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(5)
             logger.info(f"File receiver server started on {self.host}:{self.port}")
+            log_startup_phase("receiver listening")
             
+            first = True
             while True:
                 client_socket, addr = self.server_socket.accept()
+                if first:
+                    log_startup_phase("first connection")
+                    first = False
                 logger.info(f"Connection from {addr}")
                 
                 # Handle client in a new thread
@@ -231,39 +287,48 @@ class FileReceiver:
 
 # Main function
 def main():
-    logger.info("Starting R-Car S4 File Relay System")
-    
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="R-Car S4 File Relay System")
     parser.add_argument("--config", help="Path to configuration file")
     args = parser.parse_args()
     
     # Load configuration from file if specified
+    config_error = None
     if args.config:
         try:
             with open(args.config, 'r') as f:
                 config_data = json.load(f)
                 global CONFIG
                 CONFIG.update(config_data)
-                logger.info(f"Loaded configuration from {args.config}")
         except Exception as e:
-            logger.error(f"Failed to load configuration: {str(e)}")
+            config_error = e
+    
+    setup_logging()
+    logger.info("Starting R-Car S4 File Relay System")
+    if config_error:
+        logger.error(f"Failed to load configuration: {str(config_error)}")
+    elif args.config:
+        logger.info(f"Loaded configuration from {args.config}")
     
     # Ensure necessary directories exist
     ensure_directories()
     
+    # Start TCP server for file reception in a new thread, before anything slower
+    file_receiver = FileReceiver(port=CONFIG["server_port"])
+    server_thread = threading.Thread(target=file_receiver.start)
+    server_thread.daemon = True
+    server_thread.start()
+    
     # Start file watcher for incoming directory
+    from watchdog.observers import Observer
     event_handler = NewFileHandler()
     observer = Observer()
     observer.schedule(event_handler, CONFIG["incoming_dir"], recursive=False)
     observer.start()
     logger.info(f"Watching for new files in {CONFIG['incoming_dir']}")
     
-    # Start TCP server for file reception in a new thread
-    file_receiver = FileReceiver()
-    server_thread = threading.Thread(target=file_receiver.start)
-    server_thread.daemon = True
-    server_thread.start()
+    # Files that arrived while the service was down produced no events
+    threading.Thread(target=relay_backlog, name="backlog-scan", daemon=True).start()
     
     try:
         # Keep the main thread running
@@ -16,18 +16,49 @@ import logging
 import shutil
 import json
 import socket
+import select
+import signal
+import asyncio
 import threading
+import queue
+import itertools
 import argparse
+import shlex
+import re
+import fnmatch
+import functools
+import hashlib
+import errno
+import zlib
+import struct
+import mmap
+import math
+import sqlite3
+import glob
+import heapq
+import random
+import bisect
+import http.server
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-import paramiko
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+
+# paramiko, watchdog and the optional codecs are imported where they are first
+# used, so the receiver is accepting uploads before they have been loaded
+
+# Startup milestones are reported relative to this
+START_TIME = time.monotonic()
 
 # Configuration
 CONFIG = {
     "incoming_dir": "/home/root/incoming",  # Directory to watch for incoming files
     "outgoing_dir": "/home/root/outgoing",  # Directory to store outgoing files
     "log_dir": "/home/root/logs",           # Directory to store logs
+    "staging_dir": "/home/root/incoming/.staging",  # Uploads are written here and renamed into incoming_dir
+    "outgoing_store": "hardlink",           # "hardlink" (reflink/copy_file_range across filesystems), "cas" or "copy"
+    "store_forward_dir": None,              # Files held for offline Pis (default: outgoing_dir/.store_forward)
     "raspberry_pis": [
         {"name": "zc1", "ip": "192.168.1.106", "user": "raspberry", "password": "raspberry", "target_dir": "/home/raspberry/received_files"},
         {"name": "zc2", "ip": "192.168.1.245", "user": "raspberry", "password": "raspberry", "target_dir": "/home/raspberry/received_files"},
@@ -35,18 +66,137 @@ CONFIG = {
     ],
     "file_patterns": {
         # Format: "pattern": ["raspi1", "raspi2", ...] or "all" for all Raspberry Pis
+        # Plain patterns are file name prefixes; the longest matching prefix wins.
+        # "glob:<pattern>" and "re:<regex>" rules are checked first, in the order listed.
+        # {"targets": <targets>, "class": "<name>"} also sets the scheduler's priority class.
         "zc1_": ["zc1"],              # Files starting with "raspi1_" go to raspi1
         "zc2_": ["zc2"],              # Files starting with "raspi2_" go to raspi2
         "zc3_": ["zc3"],              # Files starting with "raspi3_" go to raspi3
         "zc12_": ["zc1", "zc2"],   # Files starting with "raspi12_" go to raspi1 and raspi2
         "zc13_": ["zc1", "zc3"],   # Files starting with "raspi13_" go to raspi1 and raspi3
         "zc23_": ["zc2", "zc3"],   # Files starting with "raspi23_" go to raspi2 and raspi3
-        "all_": "all"                       # Files starting with "all_" go to all Raspberry Pis
+        "all_": {"targets": "all", "class": "bulk"},  # Files starting with "all_" go to all Raspberry Pis
+        "urgent_": {"targets": "all", "class": "urgent"}  # Files starting with "urgent_" go to all Pis ahead of other traffic
     },
     "default_target": "all",              # Default target if no pattern matches: "all" or specific Pi names
+    "route_cache_size": 4096,             # Recent file name routing decisions kept in memory
+    "config_reload_interval": 5,          # Seconds between checks of --config for routing changes (0 disables)
     "server_port": 8000,                  # Port for receiving files via network
+    "receiver_mode": "asyncio",           # "asyncio" (single event loop) or "threaded" (thread per connection)
+    "receiver_backlog": 1024,             # Listen backlog for the receiver socket
+    "max_connections": 2048,              # Concurrent uploads served before new ones are refused
+    "client_read_timeout": 30,            # Seconds a client may stay silent before being dropped
+    "recv_chunk_size": 262144,            # Bytes read from a client socket per receive call
+    "recv_strategy": "recv_into",         # "recv_into" (reused buffer), "splice" (Linux zero-copy) or "recv"
+    "preallocate_files": True,            # posix_fallocate incoming files to their announced size
+    "disk_writer_threads": 4,             # Threads performing blocking disk writes for the event loop
+    "stabilize_interval": 0.25,           # Poll period for files without a close/rename event
+    "stabilize_quiet_time": 1.0,          # Size/mtime must be unchanged this long before relaying
     "enable_sftp": True,                  # Enable SFTP server for file reception
-    "sftp_port": 2222                     # Port for SFTP server
+    "sftp_port": 2222,                    # Port for SFTP server
+    "sftp_pool": {
+        "idle_timeout": 300,              # Close pooled SSH/SFTP sessions unused for this many seconds
+        "max_idle_sessions": 4,           # Idle SFTP channels kept open per Raspberry Pi
+        "keepalive_interval": 30,         # SSH keepalive interval for pooled transports (0 disables)
+        "health_check_interval": 30,      # How often idle connections are checked and reaped
+        "connect_timeout": 5,             # Seconds to open the TCP connection to a Pi
+        "banner_timeout": 10,             # Seconds to wait for the Pi's SSH banner
+        "auth_timeout": 10                # Seconds to wait for authentication to complete
+    },
+    "health": {
+        "failure_threshold": 3,           # Consecutive connect failures before a Pi is marked down
+        "probe_interval": 30,             # Seconds between liveness probes of a healthy, idle Pi
+        "recovery_interval": 2,           # Seconds between probes of a Pi that is down
+        "probe_timeout": 3                # Seconds a probe waits for the Pi's SSH banner
+    },
+    "transfer_log": "journal",            # "journal" (batched SQLite store) or "json" (one file per transfer)
+    "journal": {
+        "dir": None,                      # Journal databases (default: log_dir/journal)
+        "flush_interval": 0.2,            # Seconds records wait to be committed together
+        "batch_size": 500,                # Records committed in one transaction at most
+        "max_bytes": 64 * 1024 * 1024,    # Rotate to a new database beyond this size
+        "max_age": 86400                  # Rotate to a new database after this many seconds
+    },
+    "ingest_queue": {
+        "workers": 4,                     # Threads taking detected files off the queue and relaying them
+        "max_pending": 10000,             # Files queued or in flight before the watcher blocks
+        "high_watermark": 8000,           # Depth at which receivers hold back new uploads
+        "state_file": None,               # Pending work persisted here (default: log_dir/ingest_queue.jsonl)
+        "compact_every": 1000             # Rewrite the state file after this many completed entries
+    },
+    "delta_transfer": {
+        "enabled": True,                  # Skip unchanged files and send only changed blocks of large ones
+        "min_size": 8 * 1024 * 1024,      # Files smaller than this are always sent in full when changed
+        "block_size": 0,                  # rsync block size in bytes (0 picks one from the file size)
+        "max_literal_ratio": 0.8,         # Fall back to a full send when more than this much has changed
+        "remote_python": "python3",       # Interpreter on the Pi that runs the delta helper
+        "remote_dir": ".file_relay"       # Pi directory for the helper and its temp files (relative to home)
+    },
+    "sftp_engine": {                      # Per-Pi overrides go in the Pi entry's own "sftp_engine"
+        "window_size": 16 * 1024 * 1024,  # SSH channel window advertised for SFTP sessions
+        "max_packet_size": 32768,         # Largest SSH packet accepted on SFTP channels
+        "request_size": 32768,            # Bytes per SFTP write request (OpenSSH accepts up to 261120)
+        "read_buffer": 4 * 1024 * 1024,   # Source read size per iteration
+        "read_mode": "buffer",            # "buffer" (readinto a reused buffer) or "mmap"
+        "ciphers": ["aes128-gcm@openssh.com", "aes128-ctr"]  # Preferred ciphers, fastest first
+    },
+    "resumable": {
+        "checkpoint_bytes": 8 * 1024 * 1024,  # Confirmed upload offset is saved locally this often
+        "verify": "sha256"                # Check "sha256" (falls back to size) or "size" before renaming into place
+    },
+    "retry": {
+        "max_attempts": 8,                # Automatic re-sends of a failed destination
+        "base_delay": 2,                  # Seconds before the first retry; doubles each attempt
+        "max_delay": 600                  # Upper bound on the backoff before jitter
+    },
+    "fanout": {
+        "workers_per_pi": 2,              # Concurrent transfers allowed to a single Raspberry Pi
+        "queue_size": 64                  # Pending transfers queued per Raspberry Pi before relays block
+    },
+    "cut_through": {
+        # Streams bypass the fan-out queues, priority classes, delta and compression;
+        # only pacing applies. Keep them for large uploads.
+        "enabled": True,                  # Stream uploads to their Pis while they are still being received
+        "min_size": 64 * 1024 * 1024,     # Smaller uploads are relayed from disk once complete
+        "max_streams_per_pi": 1,          # Further uploads to a Pi that is already streaming are relayed from disk
+        "max_buffer": 64 * 1024 * 1024    # Bytes buffered per Pi before a slow one falls back to a normal send
+    },
+    "compression": {
+        "ingest": True,                   # Offer compressed uploads to framed-protocol senders
+        "egress": True,                   # Compress sends to Pis that can decompress (delta sends take precedence)
+        "codecs": ["zstd", "lz4", "zlib"],  # Preference order; only codecs both ends support are used
+        "min_size": 64 * 1024,            # Smaller files are always sent as is
+        "max_size": 256 * 1024 * 1024,    # Larger files are sent as is so an interrupted send can resume
+        "sample_size": 64 * 1024,         # Bytes test-compressed to decide whether a file is worth it
+        "max_ratio": 0.9,                 # Skip compression when the sample shrinks less than this
+        "busy_load": 0.75,                # 1-minute load per CPU above which the fast level is used
+        "skip_extensions": [".zip", ".gz", ".tgz", ".xz", ".bz2", ".zst", ".lz4", ".7z", ".rar",
+                            ".jpg", ".jpeg", ".png", ".mp4", ".mkv", ".deb", ".apk"]
+    },
+    "framed_protocol": {
+        "ack_batch": 64,                  # Files acknowledged together at most
+        "ack_delay": 0.05,                # Pending acks are sent once the client pauses this long
+        "max_header": 65536               # Largest frame body accepted
+    },
+    "scheduler": {
+        "classes": {"urgent": 16, "normal": 4, "bulk": 1},  # Priority class -> weight; busy links are shared in this ratio
+        "default_class": "normal",        # Class of files whose file_patterns rule names none
+        "pi_rate": 0,                     # Bytes/s to each Pi (0: unlimited); a Pi entry's "rate_limit" overrides it
+        "uplink_rate": 0,                 # Bytes/s to all Pis together (0: unlimited)
+        "burst": 256 * 1024,              # Bytes a rate-limited link may send at once after being idle
+        "express_workers": 1,             # Extra workers per Pi that only take small files of the heaviest class ("urgent_" files by default)
+        "express_max_size": 1024 * 1024   # Largest file an express worker takes
+    },
+    "multiprocess": {
+        "receiver_processes": 0,          # Receiver processes sharing server_port via SO_REUSEPORT (0: receive in-process)
+        "cpu_workers": 0                  # Processes for checksums and delta encoding (0: run them on the calling thread)
+    },
+    "metrics": {
+        "host": "127.0.0.1",              # Interface serving the Prometheus endpoint ("0.0.0.0" for all)
+        "port": 9108,                     # Prometheus text format on /metrics (0 disables)
+        "snapshot_file": None,            # JSON snapshot of all metrics (default: log_dir/metrics.json)
+        "snapshot_interval": 60           # Seconds between snapshot writes (0 disables)
+    }
 }
 
 # Setup logging
@@ -58,7 +208,7 @@ def setup_logging():
     
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(essage)s',
+        format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[
             logging.FileHandler(log_file),
             logging.StreamHandler(sys.stdout)
@@ -67,59 +217,665 @@ def setup_logging():
     
     return logging.getLogger("FileRelay")
 
-logger = setup_logging()
+# Handlers are installed by setup_logging() once the configuration is known
+logger = logging.getLogger("FileRelay")
 
 # Ensure directories exist
 def ensure_directories():
-    for dir_path in [CONFIG["incoming_dir"], CONFIG["outgoing_dir"], CONFIG["log_dir"]]:
+    for dir_path in [CONFIG["incoming_dir"], CONFIG["staging_dir"], CONFIG["outgoing_dir"], CONFIG["log_dir"]]:
         os.makedirs(dir_path, exist_ok=True)
         logger.info(f"Ensured directory exists: {dir_path}")
 
+# Relay metrics
+#
+# Histograms and counters are allocated once (per stage, or per Pi on its
+# first transfer), so recording an event is a bisect and a couple of integer
+# increments under a lock. Queue depths are read when metrics are exported.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = (1e5, 5e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 1e9)  # bytes per second
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+    
+    # Upper bound of the bucket holding the q-th quantile (None without data)
+    @staticmethod
+    def quantile(bounds, counts, q):
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(bounds + (math.inf,), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return math.inf
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+# Transfer metrics for one Raspberry Pi
+class PiMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.throughput = Histogram(THROUGHPUT_BUCKETS)
+        self.files = Counter()
+        self.bytes = Counter()
+        self.errors = Counter()
+
+class RelayMetrics:
+    STAGES = ("detect_delay", "route_lookup", "outgoing_store", "ssh_connect", "sftp_put", "link_wait", "log_write")
+    ERRORS = ("receive", "relay", "ssh_connect", "transfer", "cut_through", "log_write")
+    
+    def __init__(self):
+        self.stages = {stage: Histogram(LATENCY_BUCKETS) for stage in self.STAGES}
+        self.errors = {kind: Counter() for kind in self.ERRORS}
+        self.pis = {}
+        self.startup = {}                 # milestone -> seconds after START_TIME
+        self.lock = threading.Lock()
+        self.started = time.time()
+    
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+    
+    def error(self, kind):
+        self.errors[kind].inc()
+    
+    # Record and log how long after start a milestone was first reached
+    def startup_phase(self, phase):
+        if phase in self.startup:
+            return
+        with self.lock:
+            if phase in self.startup:
+                return
+            seconds = self.startup[phase] = time.monotonic() - START_TIME
+        logger.info(f"Startup: {phase.replace('_', ' ')} {seconds:.3f}s after start")
+    
+    def pi(self, name):
+        metrics = self.pis.get(name)
+        if metrics is None:
+            with self.lock:
+                metrics = self.pis.setdefault(name, PiMetrics())
+        return metrics
+    
+    # A completed send of file_size bytes to a Pi
+    def transfer(self, pi_name, seconds, file_size):
+        metrics = self.pi(pi_name)
+        metrics.latency.observe(seconds)
+        metrics.files.inc()
+        metrics.bytes.inc(file_size)
+        if seconds > 0:
+            metrics.throughput.observe(file_size / seconds)
+    
+    def transfer_failed(self, pi_name):
+        self.pi(pi_name).errors.inc()
+        self.error("transfer")
+    
+    # Current queue depths: {"ingest_queue": n, "retry_pending": n, "fanout_queue": {pi: n}}
+    def gauges(self):
+        return {
+            "ingest_queue": INGEST_QUEUE.depth() if INGEST_QUEUE is not None else 0,
+            "retry_pending": RETRY_SCHEDULER.pending(),
+            "fanout_queue": FANOUT.queue_depths(),
+            "pi_up": HEALTH.states(),
+            "store_forward": FORWARD_STORE.depths(),
+        }
+    
+    def render_prometheus(self):
+        lines = []
+        
+        def histogram(name, help_text, label, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for value, hist in series:
+                counts, total = hist.snapshot()
+                cumulative = 0
+                for bound, count in zip(hist.bounds + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {total}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {cumulative}')
+        
+        def simple(name, kind, help_text, label, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for value, number in series:
+                lines.append(f'{name}{{{label}="{value}"}} {number}' if label else f"{name} {number}")
+        
+        with self.lock:
+            pis = sorted(self.pis.items())
+        gauges = self.gauges()
+        histogram("relay_stage_seconds", "Time spent in each relay stage", "stage", self.stages.items())
+        histogram("relay_pi_transfer_seconds", "Time to send one file to a Pi", "pi",
+                  [(name, m.latency) for name, m in pis])
+        histogram("relay_pi_throughput_bytes_per_second", "Per-file send rate to a Pi", "pi",
+                  [(name, m.throughput) for name, m in pis])
+        simple("relay_pi_files_total", "counter", "Files sent to a Pi", "pi", [(name, m.files.value) for name, m in pis])
+        simple("relay_pi_bytes_total", "counter", "Bytes of files sent to a Pi", "pi",
+               [(name, m.bytes.value) for name, m in pis])
+        simple("relay_pi_errors_total", "counter", "Failed sends to a Pi", "pi", [(name, m.errors.value) for name, m in pis])
+        simple("relay_errors_total", "counter", "Errors by pipeline stage", "stage",
+               [(kind, counter.value) for kind, counter in self.errors.items()])
+        simple("relay_fanout_queue_depth", "gauge", "Transfers queued per Pi", "pi", sorted(gauges["fanout_queue"].items()))
+        simple("relay_pi_up", "gauge", "Whether a Pi is considered reachable", "pi", sorted(gauges["pi_up"].items()))
+        simple("relay_store_forward_files", "gauge", "Files held for a Pi while it is offline", "pi",
+               sorted(gauges["store_forward"].items()))
+        simple("relay_ingest_queue_depth", "gauge", "Detected files waiting or being relayed", None,
+               [(None, gauges["ingest_queue"])])
+        simple("relay_retry_pending", "gauge", "Failed destinations waiting for a retry", None,
+               [(None, gauges["retry_pending"])])
+        simple("relay_start_time_seconds", "gauge", "Unix time the relay started", None, [(None, self.started)])
+        simple("relay_startup_seconds", "gauge", "Seconds from start to each startup milestone", "phase",
+               sorted(self.startup.items()))
+        return "\n".join(lines) + "\n"
+    
+    def snapshot(self):
+        def summary(hist):
+            counts, total = hist.snapshot()
+            count = sum(counts)
+            return {
+                "count": count,
+                "mean": total / count if count else None,
+                "p50": Histogram.quantile(hist.bounds, counts, 0.5),
+                "p99": Histogram.quantile(hist.bounds, counts, 0.99),
+            }
+        
+        with self.lock:
+            pis = sorted(self.pis.items())
+        return {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "uptime": time.time() - self.started,
+            "startup": dict(self.startup),
+            "stages": {stage: summary(hist) for stage, hist in self.stages.items()},
+            "errors": {kind: counter.value for kind, counter in self.errors.items()},
+            "pis": {
+                name: {
+                    "files": m.files.value,
+                    "bytes": m.bytes.value,
+                    "errors": m.errors.value,
+                    "latency": summary(m.latency),
+                    "throughput": summary(m.throughput),
+                }
+                for name, m in pis
+            },
+            "queues": self.gauges(),
+        }
+
+METRICS = RelayMetrics()
+
+# Serves METRICS on /metrics and writes periodic JSON snapshots
+class MetricsExporter:
+    def __init__(self, host="127.0.0.1", port=9108, snapshot_file=None, snapshot_interval=60):
+        self.host = host
+        self.port = port
+        self.snapshot_file = snapshot_file or os.path.join(CONFIG["log_dir"], "metrics.json")
+        self.snapshot_interval = snapshot_interval
+        self.server = None
+        self.stop_event = threading.Event()
+    
+    def start(self):
+        if self.port:
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(handler):
+                    if handler.path.split("?")[0] != "/metrics":
+                        handler.send_error(404)
+                        return
+                    body = METRICS.render_prometheus().encode('utf-8')
+                    handler.send_response(200)
+                    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                    handler.send_header("Content-Length", str(len(body)))
+                    handler.end_headers()
+                    handler.wfile.write(body)
+                
+                def log_message(handler, format, *args):
+                    pass
+            
+            # Metrics are optional: relaying carries on without the endpoint
+            try:
+                self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+            except OSError as e:
+                logger.error(f"Failed to serve metrics on {self.host}:{self.port}: {str(e)}")
+            else:
+                self.server.daemon_threads = True
+                threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+                logger.info(f"Serving metrics on http://{self.host}:{self.server.server_address[1]}/metrics")
+        if self.snapshot_interval:
+            threading.Thread(target=self._snapshot_loop, name="metrics-snapshot", daemon=True).start()
+    
+    def write_snapshot(self):
+        tmp_path = self.snapshot_file + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(METRICS.snapshot(), f, indent=2)
+        os.replace(tmp_path, self.snapshot_file)
+    
+    def _snapshot_loop(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to write metrics snapshot: {str(e)}")
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.snapshot_interval:
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to write metrics snapshot: {str(e)}")
+
 # File handler for detecting new files
-class NewFileHandler(FileSystemEventHandler):
+#
+# A file is relayed as soon as it is known to be complete:
+#   - IN_CLOSE_WRITE (on_closed) after a writer finishes in incoming_dir
+#   - a rename into incoming_dir, e.g. from staging_dir
+#   - otherwise, once its size and mtime stop changing (polled off the observer thread)
+# With close events available, files that are being written in place wait for the
+# close instead of the stabilisation poll, so slow writers are never relayed half-written.
+class NewFileHandler:
+    def __init__(self, on_ready, close_events=True):
+        self.on_ready = on_ready
+        self.close_events = close_events
+        self.incoming_dir = os.path.abspath(CONFIG["incoming_dir"])
+        self.pending = {}                 # path -> [size, mtime_ns, last_change, being_written]
+        self.lock = threading.Lock()
+        self.poller = None
+    
+    # Called by the observer for every event, like FileSystemEventHandler.dispatch
+    def dispatch(self, event):
+        handler = getattr(self, f"on_{event.event_type}", None)
+        if handler is not None:
+            handler(event)
+    
+    def _is_incoming(self, path):
+        # Only plain files directly inside incoming_dir; staging and hidden files are ignored
+        return (os.path.dirname(os.path.abspath(path)) == self.incoming_dir
+                and not os.path.basename(path).startswith("."))
+    
     def on_created(self, event):
+        if event.is_directory or not self._is_incoming(event.src_path):
+            return
+        self._track(event.src_path, being_written=False)
+    
+    def on_modified(self, event):
+        if event.is_directory or not self._is_incoming(event.src_path):
+            return
+        self._track(event.src_path, being_written=True)
+    
+    def on_closed(self, event):
+        if event.is_directory or not self._is_incoming(event.src_path):
+            return
+        self._complete(event.src_path, "close_write")
+    
+    def on_moved(self, event):
         if event.is_directory:
             return
+        with self.lock:
+            self.pending.pop(event.src_path, None)
+        if self._is_incoming(event.dest_path):
+            self._complete(event.dest_path, "rename")
+    
+    def on_deleted(self, event):
+        with self.lock:
+            self.pending.pop(event.src_path, None)
+    
+    # Relay an existing file once it has been stable for stabilize_quiet_time
+    def track_existing(self, file_path):
+        self._track(file_path, being_written=False)
+    
+    def _track(self, file_path, being_written):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.pending.get(file_path)
+            if entry is None:
+                self.pending[file_path] = [-1, -1, now, being_written]
+            else:
+                entry[2] = now
+                entry[3] = entry[3] or being_written
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll, name="stabilize-poller", daemon=True)
+                self.poller.start()
+    
+    def _complete(self, file_path, reason):
+        with self.lock:
+            self.pending.pop(file_path, None)
+        if take_cut_through_file(file_path):
+            return                        # Already streamed to its Pis while it was being received
+        try:
+            METRICS.observe("detect_delay", max(0.0, time.time() - os.stat(file_path).st_mtime))
+        except OSError:
+            pass
+        logger.info(f"New file detected: {file_path} ({reason})")
+        self.on_ready(file_path)
+    
+    def _poll(self):
+        interval = CONFIG["stabilize_interval"]
+        quiet_time = CONFIG["stabilize_quiet_time"]
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            stable = []
+            with self.lock:
+                items = list(self.pending.items())
+            for file_path, entry in items:
+                if self.close_events and entry[3]:
+                    continue
+                try:
+                    st = os.stat(file_path)
+                except FileNotFoundError:
+                    with self.lock:
+                        self.pending.pop(file_path, None)
+                    continue
+                with self.lock:
+                    if self.pending.get(file_path) is not entry:
+                        continue
+                    if (st.st_size, st.st_mtime_ns) != (entry[0], entry[1]):
+                        entry[0], entry[1], entry[2] = st.st_size, st.st_mtime_ns, now
+                    elif now - entry[2] >= quiet_time:
+                        stable.append(file_path)
+            for file_path in stable:
+                self._complete(file_path, "stable")
+
+def create_observer():
+    from watchdog.observers import Observer
+    return Observer()
+
+# Whether the observer reports IN_CLOSE_WRITE (only the inotify backend does)
+def observer_has_close_events(observer):
+    return type(observer).__name__ == "InotifyObserver"
+
+# Routing table compiled once from CONFIG: a prefix trie with longest-match
+# semantics plus optional glob/regex rules, each resolved to its Pi configs
+class FileRouter:
+    def __init__(self, config):
+        self.raspberry_pis = tuple(config["raspberry_pis"])
+        self.pis_by_name = {pi["name"]: pi for pi in self.raspberry_pis}
+        self.default_class = config["scheduler"]["default_class"]
+        self.trie = {}                    # char -> child node; the None key holds a route
+        self.rules = []                   # [(compiled regex, route)] in declaration order
+        for pattern, targets in config["file_patterns"].items():
+            route = self._resolve(targets)
+            if pattern.startswith("glob:"):
+                self.rules.append((re.compile(fnmatch.translate(pattern[len("glob:"):])), route))
+            elif pattern.startswith("re:"):
+                self.rules.append((re.compile(pattern[len("re:"):]), route))
+            else:
+                node = self.trie
+                for ch in pattern:
+                    node = node.setdefault(ch, {})
+                node[None] = route
+        self.default_route = self._resolve(config["default_target"])
+        self.route = functools.lru_cache(maxsize=config["route_cache_size"])(self._route)
+    
+    # (target names, Pi config tuple, priority class) for a target spec; unknown names are dropped
+    def _resolve(self, targets):
+        priority = self.default_class
+        if isinstance(targets, dict):
+            priority = targets.get("class", priority)
+            targets = targets["targets"]
+        if targets == "all":
+            names = tuple(pi["name"] for pi in self.raspberry_pis)
+        elif isinstance(targets, str):
+            names = (targets,)
+        else:
+            names = tuple(dict.fromkeys(targets))
+        pis = tuple(self.pis_by_name[name] for name in names if name in self.pis_by_name)
+        return names, pis, priority
+    
+    def _route(self, file_name):
+        for regex, route in self.rules:
+            if regex.match(file_name):
+                return route
         
-        # Give the system some time to finish writing the file
-        time.sleep(1)
-        
-        file_path = event.src_path
-        logger.info(f"New file detected: {file_path}")
+        best = None
+        node = self.trie
+        for ch in file_name:
+            node = node.get(ch)
+            if node is None:
+                break
+            best = node.get(None, best)
         
-        # Process the file (relay to all Raspberry Pis)
-        relay_file_to_raspberry_pis(file_path)
+        return best or self.default_route
+
+ROUTER = FileRouter(CONFIG)
 
 # Determine target Raspberry Pis based on file name
 def get_target_pis(file_name):
-    # Check for matches in file patterns
-    for pattern, targets in CONFIG["file_patterns"].items():
-        if file_name.startswith(pattern):
-            if targets == "all":
-                return [pi["name"] for pi in CONFIG["raspberry_pis"]]
-            else:
-                return targets
+    return list(ROUTER.route(file_name)[0])
+
+# Settings that take effect immediately when the config file changes
+HOT_RELOAD_KEYS = ("raspberry_pis", "file_patterns", "default_target", "route_cache_size")
+
+# Load a JSON config file into CONFIG and recompile the router
+def load_config(config_path, keys=None):
+    global ROUTER
+    with open(config_path, 'r') as f:
+        config_data = json.load(f)
+    if keys is not None:
+        config_data = {key: value for key, value in config_data.items() if key in keys}
+    new_config = dict(CONFIG, **config_data)
+    router = FileRouter(new_config)
+    CONFIG.update(config_data)
+    ROUTER = router                       # Single reference swap; in-flight lookups keep the old table
+
+# Reload routing from the config file whenever it changes on disk
+class ConfigWatcher:
+    def __init__(self, config_path, interval):
+        self.config_path = config_path
+        self.interval = interval
+        self.mtime = self._mtime()
+        self.stop_event = threading.Event()
+    
+    def _mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def start(self):
+        thread = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+        thread.start()
+    
+    def _watch(self):
+        while not self.stop_event.wait(self.interval):
+            mtime = self._mtime()
+            if mtime is None or mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                load_config(self.config_path, keys=HOT_RELOAD_KEYS)
+                logger.info(f"Reloaded routing from {self.config_path}")
+            except Exception as e:
+                logger.error(f"Ignoring invalid configuration in {self.config_path}: {str(e)}")
+    
+    def stop(self):
+        self.stop_event.set()
+
+# SHA-256 of a file, cached by identity so repeated lookups don't re-read it
+def file_sha256(file_path):
+    st = os.stat(file_path)
+    return _file_sha256(file_path, st.st_ino, st.st_size, st.st_mtime_ns)
+
+@functools.lru_cache(maxsize=1024)
+def _file_sha256(file_path, inode, size, mtime_ns):
+    return cpu_call(hash_file, file_path)
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+# Process pool for CPU-bound per-file work (see CONFIG["multiprocess"])
+#
+# Hashing and the rsync block search hold the GIL for long stretches, which
+# would otherwise stall the receiver and the paramiko transports. Work is sent
+# to the pool by path, so file data never crosses the process boundary.
+CPU_POOL = None
+
+def cpu_call(func, *args):
+    if CPU_POOL is None:
+        return func(*args)
+    try:
+        return CPU_POOL.submit(func, *args).result()
+    except BrokenProcessPool:
+        logger.error(f"CPU worker pool failed, running {func.__name__} in-process")
+        return func(*args)
+
+def start_cpu_pool(workers):
+    global CPU_POOL
+    CPU_POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    logger.info(f"Started {workers} CPU worker processes")
+
+def stop_cpu_pool():
+    global CPU_POOL
+    if CPU_POOL is not None:
+        CPU_POOL.shutdown(cancel_futures=True)
+        CPU_POOL = None
+
+# Copy a file without moving its data through user space where the kernel allows
+def clone_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        # Reflink (btrfs/xfs): shares extents, no data is copied at all
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())  # FICLONE
+            cloned = True
+        except (ImportError, OSError):
+            cloned = False
+        if not cloned and hasattr(os, "copy_file_range"):
+            remaining = os.fstat(fsrc.fileno()).st_size
+            try:
+                while remaining > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+                    if n == 0:
+                        break
+                    remaining -= n
+                cloned = remaining == 0
+            except OSError:
+                fdst.seek(0)
+                fdst.truncate()
+        if not cloned:
+            fsrc.seek(0)
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
+
+# Make dst refer to src's data: a hardlink on the same filesystem, otherwise a clone
+def link_or_clone(src, dst):
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            clone_file(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Make dst an independent copy of src (a reflink where the filesystem allows),
+# so later in-place writes to src don't change it
+def clone_to(src, dst):
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        clone_file(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Place an incoming file in outgoing_dir according to CONFIG["outgoing_store"]
+#
+# "hardlink" shares the incoming file's inode. Network uploads arrive by
+# rename from staging_dir and never change it, but a producer that rewrites a
+# watched file in place (scp, open with "wb") rewrites the outgoing file too;
+# use "cas" or "copy" for such producers. CAS objects are always private
+# copies, since their name is a hash of their contents.
+def store_outgoing(file_path, file_name):
+    mode = CONFIG["outgoing_store"]
+    outgoing_path = os.path.join(CONFIG["outgoing_dir"], file_name)
     
-    # If no pattern matches, use default target
-    if CONFIG["default_target"] == "all":
-        return [pi["name"] for pi in CONFIG["raspberry_pis"]]
+    if mode == "copy":
+        shutil.copy2(file_path, outgoing_path)
+    elif mode == "cas":
+        # Content-addressed: identical payloads share one object whatever their name
+        digest = file_sha256(file_path)
+        object_dir = os.path.join(CONFIG["outgoing_dir"], ".objects", digest[:2])
+        object_path = os.path.join(object_dir, digest)
+        if not os.path.exists(object_path):
+            os.makedirs(object_dir, exist_ok=True)
+            clone_to(file_path, object_path)
+        link_or_clone(object_path, outgoing_path)
     else:
-        return CONFIG["default_target"]
+        link_or_clone(file_path, outgoing_path)
+    
+    return outgoing_path
+
+# Remove content-addressed objects no longer referenced by any outgoing file
+def prune_outgoing_objects():
+    objects_dir = os.path.join(CONFIG["outgoing_dir"], ".objects")
+    removed = 0
+    if not os.path.isdir(objects_dir):
+        return removed
+    for shard in os.scandir(objects_dir):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.stat().st_nlink == 1:
+                os.remove(entry.path)
+                removed += 1
+    if removed:
+        logger.info(f"Pruned {removed} unreferenced objects from {objects_dir}")
+    return removed
 
 # Relay file to specific Raspberry Pis
-def relay_file_to_raspberry_pis(file_path):
+def relay_file_to_raspberry_pis(file_path, on_complete=None):
     file_name = os.path.basename(file_path)
     file_size = os.path.getsize(file_path)
     
     # Determine target Raspberry Pis
-    target_pi_names = get_target_pis(file_name)
-    target_pis = [pi for pi in CONFIG["raspberry_pis"] if pi["name"] in target_pi_names]
+    start = time.perf_counter()
+    target_pi_names, target_pis, _ = ROUTER.route(file_name)
+    METRICS.observe("route_lookup", time.perf_counter() - start)
+    target_pi_names = list(target_pi_names)
     
     logger.info(f"Relaying file: {file_name} ({file_size} bytes) to Raspberry Pis: {', '.join(target_pi_names)}")
     
-    # Create a copy in the outgoing directory
-    outgoing_path = os.path.join(CONFIG["outgoing_dir"], file_name)
-    shutil.copy2(file_path, outgoing_path)
+    # Place the file in the outgoing directory
+    start = time.perf_counter()
+    store_outgoing(file_path, file_name)
+    METRICS.observe("outgoing_store", time.perf_counter() - start)
     
     # Record in transfer log
     transfer_log = {
@@ -131,181 +887,3234 @@ def relay_file_to_raspberry_pis(file_path):
         "destinations": []
     }
     
-    # Send to each target Raspberry Pi
+    # Dispatch to every target Raspberry Pi at once; the log is saved when the last one finishes
+    record = TransferRecord(transfer_log, len(target_pis), on_complete)
     for pi in target_pis:
-        try:
-            send_file_via_sftp(file_path, pi)
-            status = "success"
-        except Exception as e:
-            logger.error(f"Failed to send file to {pi['name']}: {str(e)}")
-            status = f"failed: {str(e)}"
-        
-        transfer_log["destinations"].append({
-            "device": pi["name"],
-            "ip": pi["ip"],
-            "target_path": os.path.join(pi["target_dir"], file_name),
-            "status": status,
-            "timestamp": datetime.datetime.now().isoformat()
-        })
+        FANOUT.submit(file_path, pi, record)
+    if not target_pis:
+        record.finish()
+    return record
+
+# Save transfer log
+def save_transfer_log(transfer_log):
+    if CONFIG["transfer_log"] == "journal":
+        get_journal().record(transfer_log)
+        return
     
-    # Save transfer log
     log_file = os.path.join(
         CONFIG["log_dir"], 
-        f"transfer_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{file_name}.json"
+        f"transfer_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{transfer_log['file_name']}.json"
     )
     with open(log_file, 'w') as f:
         json.dump(transfer_log, f, indent=2)
     
     logger.info(f"Transfer log saved to {log_file}")
 
-# Send file via SFTP
-def send_file_via_sftp(file_path, pi_config):
-    logger.info(f"Sending {file_path} to {pi_config['name']} ({pi_config['ip']})")
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    file_size INTEGER,
+    source TEXT,
+    targets TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS destinations (
+    transfer_id INTEGER NOT NULL REFERENCES transfers(id),
+    device TEXT NOT NULL,
+    ip TEXT,
+    target_path TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    transfer TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_file_name ON transfers(file_name, timestamp);
+CREATE INDEX IF NOT EXISTS destinations_device ON destinations(device, status, timestamp);
+CREATE INDEX IF NOT EXISTS destinations_status ON destinations(status, timestamp);
+CREATE INDEX IF NOT EXISTS destinations_transfer ON destinations(transfer_id);
+"""
+
+# Append-only transfer journal in rotated SQLite (WAL) databases
+#
+# Records are queued by the relay threads and committed by a single writer
+# thread in batches (group commit), so a burst of transfers costs one
+# transaction rather than one file each.
+class TransferJournal:
+    def __init__(self, dir=None, flush_interval=0.2, batch_size=500, max_bytes=64 * 1024 * 1024,
+                 max_age=86400):
+        self.dir = dir or os.path.join(CONFIG["log_dir"], "journal")
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue = queue.Queue()
+        self.db = None
+        self.db_path = None
+        self.opened_at = 0.0
+        os.makedirs(self.dir, exist_ok=True)
+        self.thread = threading.Thread(target=self._write_loop, name="transfer-journal", daemon=True)
+        self.thread.start()
     
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def record(self, transfer_log):
+        self.queue.put(transfer_log)
     
-    try:
-        ssh.connect(
-            pi_config["ip"],
-            username=pi_config["user"],
-            password=pi_config["password"]
-        )
-        
-        # Create target directory if it doesn't exist
-        stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {pi_config['target_dir']}")
-        
-        # Transfer the file
-        sftp = ssh.open_sftp()
-        target_path = os.path.join(pi_config["target_dir"], os.path.basename(file_path))
-        sftp.put(file_path, target_path)
-        sftp.close()
-        
-        logger.info(f"Successfully sent {file_path} to {pi_config['name']}")
-    finally:
-        ssh.close()
+    def _open(self):
+        if self.db:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        self.db_path = os.path.join(self.dir, f"transfers_{stamp}.db")
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(JOURNAL_SCHEMA)
+        self.opened_at = time.monotonic()
+        logger.info(f"Transfer journal writing to {self.db_path}")
+    
+    def _needs_rotation(self):
+        if time.monotonic() - self.opened_at >= self.max_age:
+            return True
+        size = 0
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size >= self.max_bytes
+    
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+            # Gather whatever else arrives within the flush interval into the same commit
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} records to transfer journal: {str(e)}")
+            if stop:
+                break
+        if self.db:
+            self.db.close()
+    
+    def _commit(self, batch):
+        if self.db is None or self._needs_rotation():
+            self._open()
+        with self.db:
+            for transfer_log in batch:
+                cursor = self.db.execute(
+                    "INSERT INTO transfers (file_name, file_size, source, targets, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        transfer_log["file_name"],
+                        transfer_log["file_size"],
+                        transfer_log.get("source"),
+                        json.dumps(transfer_log.get("targets", [])),
+                        transfer_log["timestamp"]
+                    )
+                )
+                transfer_id = cursor.lastrowid
+                rows = []
+                for destination in transfer_log["destinations"]:
+                    status, _, error = destination["status"].partition(": ")
+                    rows.append((
+                        transfer_id,
+                        destination["device"],
+                        destination.get("ip"),
+                        destination.get("target_path"),
+                        status,
+                        error or None,
+                        destination.get("transfer"),
+                        destination["timestamp"]
+                    ))
+                self.db.executemany(
+                    "INSERT INTO destinations (transfer_id, device, ip, target_path, status, error, transfer, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+    
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
 
-# TCP server for receiving files over network
-class FileReceiver:
-    def __init__(self, host='0.0.0.0', port=CONFIG["server_port"]):
-        self.host = host
-        self.port = port
-        self.server_socket = None
+JOURNAL = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    global JOURNAL
+    with _journal_lock:
+        if JOURNAL is None:
+            JOURNAL = TransferJournal(**CONFIG["journal"])
+        return JOURNAL
+
+# Turn "today", "yesterday", "6h", "7d" or an ISO date/time into an ISO timestamp
+def parse_journal_time(value):
+    if value is None:
+        return None
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    if value == "today":
+        return today.isoformat()
+    if value == "yesterday":
+        return (today - datetime.timedelta(days=1)).isoformat()
+    match = re.fullmatch(r"(\d+)([smhd])", value)
+    if match:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[match.group(2)]
+        delta = datetime.timedelta(**{unit: int(match.group(1))})
+        return (datetime.datetime.now() - delta).isoformat()
+    return datetime.datetime.fromisoformat(value).isoformat()
+
+# Query destination records across all journal databases, oldest first
+def query_journal(journal_dir=None, file_name=None, device=None, status=None, since=None, until=None,
+                  limit=None):
+    journal_dir = journal_dir or CONFIG["journal"]["dir"] or os.path.join(CONFIG["log_dir"], "journal")
+    conditions = []
+    params = []
+    for column, value in (("t.file_name", file_name), ("d.device", device), ("d.status", status)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        conditions.append("d.timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("d.timestamp < ?")
+        params.append(until)
+    sql = (
+        "SELECT d.timestamp, d.device, d.status, t.file_name, t.file_size, d.target_path, d.transfer, d.error "
+        "FROM destinations d JOIN transfers t ON t.id = d.transfer_id"
+    )
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY d.timestamp"
     
-    def start(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
+    db_paths = sorted(glob.glob(os.path.join(journal_dir, "transfers_*.db")))
+    results = []
+    for db_path in db_paths:
+        db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            logger.info(f"File receiver server started on {self.host}:{self.port}")
-            
-            while True:
-                client_socket, addr = self.server_socket.accept()
-                logger.info(f"Connection from {addr}")
-                
-                # Handle client in a new thread
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-        except Exception as e:
-            logger.error(f"Server error: {str(e)}")
+            for row in db.execute(sql, params):
+                results.append(dict(zip(
+                    ("timestamp", "device", "status", "file_name", "file_size", "target_path", "transfer", "error"),
+                    row
+                )))
+                if limit and len(results) >= limit:
+                    return results
         finally:
-            if self.server_socket:
-                self.server_socket.close()
+            db.close()
+    return results
+
+# Print journal query results for the command line
+def print_journal_query(args):
+    rows = query_journal(
+        file_name=args.file,
+        device=args.device,
+        status=args.status,
+        since=parse_journal_time(args.since),
+        until=parse_journal_time(args.until),
+        limit=args.limit
+    )
+    for row in rows:
+        if args.json:
+            print(json.dumps(row))
+        else:
+            error = f" ({row['error']})" if row["error"] else ""
+            print(f"{row['timestamp']}  {row['device']:<8} {row['status']:<8} {row['file_name']} "
+                  f"[{row['file_size']} bytes]{error}")
+    if not args.json:
+        print(f"{len(rows)} records")
+
+# Latest transfer record time (ISO) per file name for records since an ISO
+# timestamp, from the journal or the JSON transfer logs. Files whose latest
+# attempt at some destination failed are left out: their retry was only
+# scheduled in memory, so they still need relaying. `names` limits which JSON
+# logs are read.
+def relayed_files(since, names=None):
+    relayed = {}
+    latest = {}                           # (file name, device) -> (timestamp, status)
     
-    def handle_client(self, client_socket, addr):
-        try:
-            # Receive header with file name and size
-            header_data = client_socket.recv(1024).decode('utf-8')
-            header = json.loads(header_data)
-            
-            file_name = header.get('file_name')
-            file_size = header.get('file_size')
-            
-            if not file_name or not isinstance(file_size, int):
-                raise ValueError("Invalid file header")
-            
-            logger.info(f"Receiving file: {file_name} ({file_size} bytes) from {addr}")
-            
-            # Define the destination path
-            dest_path = os.path.join(CONFIG["incoming_dir"], file_name)
-            
-            # Send acknowledgment
-            client_socket.send(b"ACK")
-            
-            # Receive and write the file
-            with open(dest_path, 'wb') as f:
-                bytes_received = 0
-                while bytes_received < file_size:
-                    chunk = client_socket.recv(min(4096, file_size - bytes_received))
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    bytes_received += len(chunk)
-            
-            logger.info(f"File {file_name} received successfully from {addr}")
-            client_socket.send(b"SUCCESS")
-            
-        except Exception as e:
-            logger.error(f"Error handling client {addr}: {str(e)}")
+    def note(file_name, device, timestamp, status):
+        if timestamp >= latest.get((file_name, device), ("", None))[0]:
+            latest[(file_name, device)] = (timestamp, status)
+    
+    if CONFIG["transfer_log"] == "journal":
+        journal_dir = CONFIG["journal"]["dir"] or os.path.join(CONFIG["log_dir"], "journal")
+        for db_path in sorted(glob.glob(os.path.join(journal_dir, "transfers_*.db"))):
+            db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
             try:
-                client_socket.send(f"ERROR: {str(e)}".encode('utf-8'))
-            except:
-                pass
-        finally:
-            client_socket.close()
+                for file_name, timestamp, device, status, destination_time in db.execute(
+                    "SELECT t.file_name, t.timestamp, d.device, d.status, d.timestamp FROM transfers t "
+                    "LEFT JOIN destinations d ON d.transfer_id = t.id WHERE t.timestamp >= ?",
+                    (since,)
+                ):
+                    relayed[file_name] = max(timestamp, relayed.get(file_name, ""))
+                    if device is not None:
+                        note(file_name, device, destination_time, status)
+            finally:
+                db.close()
+    else:
+        # transfer_<YYYYmmdd_HHMMSS>_<file name>.json, written once the transfer finished
+        prefix_length = len("transfer_YYYYmmdd_HHMMSS_")
+        with os.scandir(CONFIG["log_dir"]) as entries:
+            for entry in entries:
+                if not (entry.name.startswith("transfer_") and entry.name.endswith(".json")):
+                    continue
+                timestamp = datetime.datetime.fromtimestamp(entry.stat().st_mtime).isoformat()
+                file_name = entry.name[prefix_length:-len(".json")]
+                if timestamp < since or (names is not None and file_name not in names):
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        destinations = json.load(f).get("destinations", [])
+                except (OSError, ValueError):
+                    continue
+                relayed[file_name] = max(timestamp, relayed.get(file_name, ""))
+                for destination in destinations:
+                    note(file_name, destination["device"], destination["timestamp"],
+                         destination["status"].partition(": ")[0])
+    
+    for (file_name, _), (_, status) in latest.items():
+        if status == "failed":
+            relayed.pop(file_name, None)
+    return relayed
 
-# Main function
-def main():
-    logger.info("Starting R-Car S4 File Relay System")
+# Bounded, persistent queue of detected files waiting to be relayed
+#
+# Every path is recorded in an append-only state file when queued ("add") and
+# when its relay finishes ("done"), so work still pending at shutdown is
+# replayed on the next start. A path is queued at most once; events for a path
+# that is already being relayed mark it to be relayed again afterwards.
+class IngestQueue:
+    def __init__(self, workers=4, max_pending=10000, high_watermark=8000, state_file=None,
+                 compact_every=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.high_watermark = high_watermark
+        self.state_file = state_file or os.path.join(CONFIG["log_dir"], "ingest_queue.jsonl")
+        self.compact_every = compact_every
+        self.pending = {}                 # path -> None, in arrival order
+        self.in_flight = set()
+        self.requeue = set()              # In-flight paths that changed again
+        self.completed_since_compact = 0
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.threads = []
+        self.state = None
+        self.shared_depth = None          # multiprocessing value mirroring depth() for receiver processes
     
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description="R-Car S4 File Relay System")
-    parser.add_argument("--config", help="Path to configuration file")
-    args = parser.parse_args()
+    def depth(self):
+        return len(self.pending) + len(self.in_flight)
     
-    # Load configuration from file if specified
-    if args.config:
+    def _publish_depth(self):
+        if self.shared_depth is not None:
+            self.shared_depth.value = self.depth()
+    
+    def start(self):
+        self._recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def _recover(self):
+        recovered = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue        # Torn final line from a crash
+                    if entry["op"] == "add":
+                        recovered[entry["path"]] = None
+                    else:
+                        recovered.pop(entry["path"], None)
+        self.pending = {path: None for path in recovered if os.path.exists(path)}
+        self._compact()
+        if self.pending:
+            logger.info(f"Recovered {len(self.pending)} pending relays from {self.state_file}")
+    
+    def _compact(self):
+        tmp_path = self.state_file + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for path in list(self.in_flight) + list(self.pending):
+                f.write(json.dumps({"op": "add", "path": path}) + "\n")
+        os.replace(tmp_path, self.state_file)
+        if self.state:
+            self.state.close()
+        self.state = open(self.state_file, 'a')
+        self.completed_since_compact = 0
+    
+    def _record(self, op, path):
+        if self.state.closed:
+            return              # Stopped: the entry stays pending and is replayed on restart
+        self.state.write(json.dumps({"op": op, "path": path}) + "\n")
+        self.state.flush()
+    
+    # Whether a file is waiting in the queue or being relayed
+    def queued(self, file_path):
+        with self.cond:
+            return file_path in self.pending or file_path in self.in_flight
+    
+    # Queue a file for relaying; blocks only while the queue is full. Returns the depth.
+    def put(self, file_path):
+        with self.cond:
+            if file_path in self.pending:
+                return self.depth()
+            if file_path in self.in_flight:
+                self.requeue.add(file_path)
+                return self.depth()
+            while self.depth() >= self.max_pending and not self.stopping:
+                logger.warning(f"Ingest queue full ({self.depth()} files), waiting for relays to finish")
+                self.cond.wait()
+            self.pending[file_path] = None
+            self._record("add", file_path)
+            self._publish_depth()
+            self.cond.notify_all()
+            depth = self.depth()
+        if depth >= self.high_watermark:
+            logger.warning(f"Ingest queue depth {depth} above high watermark {self.high_watermark}")
+        return depth
+    
+    def congested(self):
+        return self.depth() >= self.high_watermark
+    
+    # Block until the queue is below its high watermark (used to hold back uploads)
+    def wait_for_capacity(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.depth() < self.high_watermark or self.stopping, timeout)
+    
+    def _work(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.stopping)
+                if self.stopping:
+                    return
+                file_path = next(iter(self.pending))
+                del self.pending[file_path]
+                self.in_flight.add(file_path)
+            try:
+                relay_file_to_raspberry_pis(file_path, on_complete=lambda record, p=file_path: self._done(p))
+            except FileNotFoundError:
+                logger.warning(f"Skipping {file_path}: file no longer exists")
+                self._done(file_path)
+            except Exception as e:
+                METRICS.error("relay")
+                logger.error(f"Failed to relay {file_path}: {str(e)}")
+                self._done(file_path)
+    
+    def _done(self, file_path):
+        with self.cond:
+            self.in_flight.discard(file_path)
+            if file_path in self.requeue:
+                self.requeue.discard(file_path)
+                self.pending[file_path] = None
+            else:
+                self._record("done", file_path)
+                self.completed_since_compact += 1
+                if self.completed_since_compact >= self.compact_every:
+                    self._compact()
+            self._publish_depth()
+            self.cond.notify_all()
+    
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.state:
+            self.state.close()
+
+INGEST_QUEUE = None
+
+# The parent's ingest queue depth as seen from a receiver process; stands in
+# for INGEST_QUEUE there so uploads are held back the same way
+class SharedIngestGate:
+    def __init__(self, shared_depth, high_watermark):
+        self.shared_depth = shared_depth
+        self.high_watermark = high_watermark
+    
+    def depth(self):
+        return self.shared_depth.value
+    
+    def congested(self):
+        return self.depth() >= self.high_watermark
+    
+    def wait_for_capacity(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.congested():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+# Hold back a new upload while relays are falling behind
+def wait_for_ingest_capacity():
+    if INGEST_QUEUE is not None and INGEST_QUEUE.congested():
+        logger.warning(f"Relay backlog at {INGEST_QUEUE.depth()} files, delaying upload")
+        INGEST_QUEUE.wait_for_capacity(CONFIG["client_read_timeout"])
+
+# Files in incoming_dir written after their latest transfer record (or with
+# none), i.e. ones that arrived while the relay was not running, plus files
+# whose retries were still pending when it stopped.
+# Returns [(path, mtime)].
+def find_backlog():
+    files = []
+    with os.scandir(CONFIG["incoming_dir"]) as entries:
+        for entry in entries:
+            if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False):
+                files.append((entry.path, entry.name, entry.stat().st_mtime))
+    if not files:
+        return []
+    since = datetime.datetime.fromtimestamp(min(mtime for _, _, mtime in files)).isoformat()
+    relayed = relayed_files(since, {name for _, name, _ in files})
+    return [
+        (path, mtime) for path, name, mtime in files
+        if relayed.get(name, "") < datetime.datetime.fromtimestamp(mtime).isoformat()
+    ]
+
+# Queue the unrelayed backlog of incoming_dir. Files modified within
+# stabilize_quiet_time go through the watcher's stabilisation first.
+def queue_backlog(event_handler):
+    start = time.perf_counter()
+    try:
+        backlog = find_backlog()
+    except Exception as e:
+        logger.error(f"Backlog scan of {CONFIG['incoming_dir']} failed: {str(e)}")
+        return
+    logger.info(f"Backlog scan found {len(backlog)} unrelayed files in {CONFIG['incoming_dir']} "
+                f"({time.perf_counter() - start:.3f}s)")
+    quiet_time = CONFIG["stabilize_quiet_time"]
+    for file_path, mtime in backlog:
+        if INGEST_QUEUE.queued(file_path):
+            continue                      # Recovered from the ingest queue's state file
+        if time.time() - mtime < quiet_time:
+            event_handler.track_existing(file_path)
+        else:
+            INGEST_QUEUE.put(file_path)
+    METRICS.startup_phase("backlog_queued")
+
+# Pooled SSH transport and SFTP sessions for a single Raspberry Pi
+class PooledPiConnection:
+    def __init__(self, pi_config, max_idle_sessions, keepalive_interval, timeouts=None):
+        self.pi_config = pi_config
+        self.max_idle_sessions = max_idle_sessions
+        self.keepalive_interval = keepalive_interval
+        self.timeouts = timeouts or {}    # ssh.connect timeout, banner_timeout and auth_timeout
+        self.ssh = None
+        self.idle_sessions = []           # [(sftp, released_at)], most recently used last
+        self.created_dirs = set()         # Remote directories already created on this transport
+        self.remote_helpers = {}          # Remote dir -> helper path, or None if it can't run there
+        self.remote_codecs = None         # Codecs the Pi can decompress, probed once per transport
+        self.active_sessions = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        transport = self.ssh.get_transport() if self.ssh else None
+        return transport is not None and transport.is_active()
+
+    def _connect(self):
+        import paramiko
+        self._close_locked()
+        if not HEALTH.available(self.pi_config):
+            raise IOError(f"{self.pi_config['name']} is offline")
+        settings = sftp_engine_settings(self.pi_config)
+        
+        def transport_factory(sock, **kwargs):
+            transport = paramiko.Transport(
+                sock,
+                default_window_size=settings["window_size"],
+                default_max_packet_size=settings["max_packet_size"],
+                **kwargs
+            )
+            # Offer the preferred ciphers first, e.g. AES-GCM where the board has fast AES
+            options = transport.get_security_options()
+            preferred = [cipher for cipher in settings["ciphers"] if cipher in options.ciphers]
+            options.ciphers = tuple(preferred + [c for c in options.ciphers if c not in preferred])
+            return transport
+        
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        start = time.perf_counter()
         try:
-            with open(args.config, 'r') as f:
-                config_data = json.load(f)
-                global CONFIG
-                CONFIG.update(config_data)
-                logger.info(f"Loaded configuration from {args.config}")
+            ssh.connect(
+                self.pi_config["ip"],
+                port=self.pi_config.get("port", 22),
+                username=self.pi_config["user"],
+                password=self.pi_config["password"],
+                transport_factory=transport_factory,
+                **self.timeouts
+            )
+        except paramiko.AuthenticationException:
+            METRICS.error("ssh_connect")
+            raise                         # The Pi is up; its credentials are wrong
         except Exception as e:
-            logger.error(f"Failed to load configuration: {str(e)}")
-    
-    # Ensure necessary directories exist
-    ensure_directories()
+            METRICS.error("ssh_connect")
+            HEALTH.failure(self.pi_config, e)
+            raise
+        METRICS.observe("ssh_connect", time.perf_counter() - start)
+        HEALTH.success(self.pi_config)
+        if self.keepalive_interval:
+            ssh.get_transport().set_keepalive(self.keepalive_interval)
+        self.ssh = ssh
+        logger.info(f"Opened pooled SSH connection to {self.pi_config['name']} ({self.pi_config['ip']})")
+
+    def acquire(self):
+        with self.lock:
+            if not self.is_alive():
+                self._connect()
+            self.last_used = time.monotonic()
+            self.active_sessions += 1
+            while self.idle_sessions:
+                sftp, _ = self.idle_sessions.pop()
+                if not sftp.sock.closed:
+                    return sftp
+            transport = self.ssh.get_transport()
+        import paramiko
+        settings = sftp_engine_settings(self.pi_config)
+        try:
+            return paramiko.SFTPClient.from_transport(
+                transport,
+                window_size=settings["window_size"],
+                max_packet_size=settings["max_packet_size"]
+            )
+        except Exception:
+            with self.lock:
+                self.active_sessions -= 1
+            raise
+
+    def release(self, sftp, healthy=True):
+        with self.lock:
+            self.active_sessions -= 1
+            self.last_used = time.monotonic()
+            if healthy and self.is_alive() and len(self.idle_sessions) < self.max_idle_sessions:
+                self.idle_sessions.append((sftp, self.last_used))
+                return
+        sftp.close()
+
+    def ensure_dir(self, target_dir):
+        if target_dir in self.created_dirs:
+            return
+        stdin, stdout, stderr = self.ssh.exec_command(f"mkdir -p {shlex.quote(target_dir)}")
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            raise IOError(f"mkdir -p {target_dir} failed: {stderr.read().decode('utf-8', 'replace').strip()}")
+        self.created_dirs.add(target_dir)
+
+    def run_command(self, command, send_input=None):
+        stdin, stdout, stderr = self.ssh.exec_command(command)
+        if send_input:
+            send_input(stdin.channel)
+            stdin.channel.shutdown_write()
+        output = stdout.read()
+        exit_status = stdout.channel.recv_exit_status()
+        return exit_status, output, stderr.read().decode('utf-8', 'replace').strip()
+
+    def reap(self, idle_timeout):
+        # Drop idle SFTP channels and, once nothing is in use, the transport itself
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            if self.ssh and not self.is_alive():
+                expired.extend(sftp for sftp, _ in self.idle_sessions)
+                self.idle_sessions = []
+                self._close_locked()
+            else:
+                keep = []
+                for sftp, released_at in self.idle_sessions:
+                    if now - released_at > idle_timeout:
+                        expired.append(sftp)
+                    else:
+                        keep.append((sftp, released_at))
+                self.idle_sessions = keep
+                if self.ssh and not self.active_sessions and not self.idle_sessions \
+                        and now - self.last_used > idle_timeout:
+                    logger.info(f"Closing idle SSH connection to {self.pi_config['name']}")
+                    self._close_locked()
+        for sftp in expired:
+            sftp.close()
+
+    def _close_locked(self):
+        for sftp, _ in self.idle_sessions:
+            sftp.close()
+        self.idle_sessions = []
+        self.created_dirs.clear()
+        self.remote_helpers.clear()
+        self.remote_codecs = None
+        if self.ssh:
+            self.ssh.close()
+            self.ssh = None
+
+    def close(self):
+        with self.lock:
+            self._close_locked()
+
+# Long-lived SSH/SFTP connections keyed by Raspberry Pi entry
+class SFTPConnectionPool:
+    def __init__(self, idle_timeout=300, max_idle_sessions=4, keepalive_interval=30,
+                 health_check_interval=30, connect_timeout=5, banner_timeout=10, auth_timeout=10):
+        self.idle_timeout = idle_timeout
+        self.max_idle_sessions = max_idle_sessions
+        self.keepalive_interval = keepalive_interval
+        self.health_check_interval = health_check_interval
+        self.timeouts = {"timeout": connect_timeout, "banner_timeout": banner_timeout, "auth_timeout": auth_timeout}
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reaper = None
+
+    # Everything a connection is made with, credentials included, so an entry
+    # changed by a config reload gets new connections; the old ones are reaped once idle
+    @staticmethod
+    def pool_key(pi_config):
+        return (pi_config["name"], pi_config["ip"], pi_config.get("port", 22), pi_config["user"],
+                pi_config.get("password"))
+
+    def get_connection(self, pi_config):
+        key = self.pool_key(pi_config)
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = PooledPiConnection(pi_config, self.max_idle_sessions, self.keepalive_interval, self.timeouts)
+                self._connections[key] = conn
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, name="sftp-pool-reaper", daemon=True)
+                self._reaper.start()
+        return conn
+
+    @contextmanager
+    def session(self, pi_config):
+        conn = self.get_connection(pi_config)
+        sftp = conn.acquire()
+        try:
+            yield conn, sftp
+        except Exception:
+            conn.release(sftp, healthy=False)
+            raise
+        else:
+            conn.release(sftp)
+
+    def _reap_loop(self):
+        while not self._stop.wait(self.health_check_interval):
+            with self._lock:
+                connections = list(self._connections.values())
+            for conn in connections:
+                try:
+                    conn.reap(self.idle_timeout)
+                except Exception as e:
+                    logger.error(f"Error reaping connection to {conn.pi_config['name']}: {str(e)}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+SFTP_POOL = SFTPConnectionPool(**CONFIG["sftp_pool"])
+
+# Reachability of each Raspberry Pi, with a circuit breaker per Pi
+#
+# failure_threshold consecutive connect failures or failed probes mark a Pi
+# down. Sends to it are then skipped without touching the network and their
+# files wait in the ForwardStore. A background thread probes each Pi by
+# opening a TCP connection and reading its SSH banner: a down Pi every
+# recovery_interval, a healthy one every probe_interval unless a connect has
+# just succeeded. The first good probe of a down Pi marks it up and drains
+# its stored files.
+class TargetHealth:
+    def __init__(self, failure_threshold=3, probe_interval=30, recovery_interval=2, probe_timeout=3):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.recovery_interval = recovery_interval
+        self.probe_timeout = probe_timeout
+        self.failures = {}                # Pi name -> consecutive failures
+        self.down = {}                    # Pi name -> monotonic time it was marked down
+        self.last_ok = {}                 # Pi name -> monotonic time of the last successful connect or probe
+        self.last_probe = {}
+        self.probing = set()              # Pi names with a probe in progress
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def available(self, pi_config):
+        return pi_config["name"] not in self.down
+    
+    def states(self):
+        with self.lock:
+            return {pi["name"]: int(pi["name"] not in self.down) for pi in ROUTER.raspberry_pis}
+    
+    def success(self, pi_config):
+        name = pi_config["name"]
+        with self.lock:
+            self.failures[name] = 0
+            self.last_ok[name] = time.monotonic()
+            down_since = self.down.pop(name, None)
+        if down_since is not None:
+            logger.info(f"{name} is reachable again after {time.monotonic() - down_since:.0f}s")
+            threading.Thread(target=FORWARD_STORE.drain, args=(pi_config,), name=f"forward-{name}",
+                             daemon=True).start()
+    
+    def failure(self, pi_config, error):
+        name = pi_config["name"]
+        with self.lock:
+            self.failures[name] = self.failures.get(name, 0) + 1
+            tripped = self.failures[name] >= self.failure_threshold and name not in self.down
+            if tripped:
+                self.down[name] = time.monotonic()
+        if tripped:
+            logger.error(f"{name} marked offline after {self.failures[name]} failures ({str(error)}); "
+                         f"holding its files until it is reachable")
+    
+    # Plain TCP connect to the SSH port. No SSH handshake, so probes don't fill
+    # sshd's logs or count against MaxStartups and fail2ban on the Pi.
+    def probe(self, pi_config):
+        try:
+            socket.create_connection((pi_config["ip"], pi_config.get("port", 22)),
+                                     timeout=self.probe_timeout).close()
+        except OSError as e:
+            self.failure(pi_config, e)
+            return False
+        finally:
+            with self.lock:
+                self.probing.discard(pi_config["name"])
+        self.success(pi_config)
+        return True
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="target-health", daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        while not self.stop_event.wait(min(self.recovery_interval, self.probe_interval)):
+            now = time.monotonic()
+            for pi in ROUTER.raspberry_pis:
+                name = pi["name"]
+                if name in self.down:
+                    due = now - self.last_probe.get(name, 0) >= self.recovery_interval
+                else:
+                    due = now - max(self.last_probe.get(name, 0), self.last_ok.get(name, 0)) >= self.probe_interval
+                if due and name not in self.probing:
+                    # One thread per probe, so an unresponsive Pi can't delay the others
+                    self.last_probe[name] = now
+                    with self.lock:
+                        self.probing.add(name)
+                    threading.Thread(target=self.probe, args=(pi,), name=f"probe-{name}", daemon=True).start()
+    
+    def stop(self):
+        self.stop_event.set()
+
+HEALTH = TargetHealth(**CONFIG["health"])
+
+# Per-Pi on-disk queue of files waiting for an offline Pi
+#
+# Each entry is a private copy (reflink where possible) of the file in
+# dir/<Pi name>/ under its own name, so it survives restarts, cleanup and
+# in-place rewrites of the original, and a newer
+# file of the same name replaces the one waiting. Entries are sent oldest
+# first when the Pi comes back and removed once delivered.
+class ForwardStore:
+    def __init__(self, dir=None):
+        self.dir = os.path.abspath(dir or os.path.join(CONFIG["outgoing_dir"], ".store_forward"))
+        self.draining = set()
+        self.submitted = set()            # Stored paths queued or being sent, skipped by drain
+        self.lock = threading.Lock()
+    
+    def contains(self, file_path):
+        return os.path.dirname(os.path.dirname(os.path.abspath(file_path))) == self.dir
+    
+    def add(self, file_path, pi_config):
+        if self.contains(file_path):
+            return file_path
+        pi_dir = os.path.join(self.dir, pi_config["name"])
+        os.makedirs(pi_dir, exist_ok=True)
+        stored_path = os.path.join(pi_dir, os.path.basename(file_path))
+        clone_to(file_path, stored_path)
+        return stored_path
+    
+    # Inode of a stored entry, to remove it only if it was not replaced meanwhile
+    def identity(self, file_path):
+        if not self.contains(file_path):
+            return None
+        try:
+            return os.stat(file_path).st_ino
+        except OSError:
+            return None
+    
+    def remove(self, file_path, identity):
+        try:
+            if os.stat(file_path).st_ino == identity:
+                os.remove(file_path)
+        except OSError:
+            pass
+        self.release(file_path)
+    
+    # A submitted entry is no longer queued or being sent
+    def release(self, file_path):
+        with self.lock:
+            self.submitted.discard(file_path)
+    
+    def entries(self, name):
+        try:
+            with os.scandir(os.path.join(self.dir, name)) as it:
+                files = [(entry.stat().st_mtime, entry.path) for entry in it
+                         if entry.is_file() and not entry.name.endswith(".tmp")]
+        except FileNotFoundError:
+            return []
+        return [path for _, path in sorted(files)]
+    
+    def depths(self):
+        return {pi["name"]: len(self.entries(pi["name"])) for pi in ROUTER.raspberry_pis}
+    
+    # Queue every stored file for a reachable Pi at once; the fanout workers send them back to back
+    def drain(self, pi_config):
+        name = pi_config["name"]
+        with self.lock:
+            if name in self.draining:
+                return
+            self.draining.add(name)
+        try:
+            with self.lock:
+                entries = [path for path in self.entries(name) if path not in self.submitted]
+            if entries:
+                logger.info(f"Forwarding {len(entries)} held files to {name}")
+            for stored_path in entries:
+                if not HEALTH.available(pi_config):
+                    break
+                with self.lock:
+                    if stored_path in self.submitted:
+                        continue          # Still queued or being sent since an earlier drain
+                    self.submitted.add(stored_path)
+                try:
+                    transfer_log = {
+                        "file_name": os.path.basename(stored_path),
+                        "file_size": os.path.getsize(stored_path),
+                        "timestamp": datetime.datetime.now().isoformat(),
+                        "source": "store_forward",
+                        "targets": [name],
+                        "destinations": []
+                    }
+                except OSError:
+                    self.release(stored_path)
+                    continue
+                FANOUT.submit(stored_path, pi_config, TransferRecord(transfer_log, 1))
+        except Exception as e:
+            logger.error(f"Error forwarding held files to {name}: {str(e)}")
+        finally:
+            with self.lock:
+                self.draining.discard(name)
+    
+    # Drain whatever was left from a previous run for Pis that are up
+    def drain_all(self):
+        for pi in ROUTER.raspberry_pis:
+            if HEALTH.available(pi):
+                self.drain(pi)
+
+FORWARD_STORE = ForwardStore(CONFIG["store_forward_dir"])
+
+# Helper run on the Raspberry Pi (stdlib only) for block-delta transfers:
+#   sig <path> <block_size>                 -> adler32 + md5 of every full block on stdout
+#   patch <path> <block_size> <sha256>      -> rebuild <path> from its old blocks and literal
+#                                              data on stdin, verify, then rename into place
+# It lives in delta_transfer.remote_dir and writes its temporary files there
+# too, so nothing but finished files appears in target_dir.
+REMOTE_DELTA_HELPER = b"""import hashlib, os, struct, sys, tempfile, zlib
+def temp_file(path, suffix):
+    # Next to the helper, else in the target's parent; must be on the target's filesystem
+    target_dir = os.path.dirname(os.path.abspath(path))
+    dev = os.stat(target_dir).st_dev
+    for d in (os.path.dirname(os.path.abspath(__file__)), os.path.dirname(target_dir), target_dir):
+        try:
+            if os.stat(d).st_dev == dev and os.access(d, os.W_OK):
+                fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix=suffix, dir=d)
+                os.chmod(tmp, 0o644)
+                return os.fdopen(fd, 'wb'), tmp
+        except OSError:
+            pass
+    sys.exit('no writable directory for ' + path)
+def sig(path, bs):
+    out = sys.stdout.buffer
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(bs)
+            if len(block) < bs:
+                break
+            out.write(struct.pack('>I', zlib.adler32(block)) + hashlib.md5(block).digest())
+def read_exact(inp, n):
+    data = inp.read(n)
+    if len(data) != n:
+        sys.exit('truncated delta stream')
+    return data
+def patch(path, bs, sha):
+    inp = sys.stdin.buffer
+    digest = hashlib.sha256()
+    dst, tmp = temp_file(path, '.delta')
+    with open(path, 'rb') as src, dst:
+        while True:
+            op = read_exact(inp, 1)
+            if op == b'E':
+                break
+            (n,) = struct.unpack('>I', read_exact(inp, 4))
+            if op == b'C':
+                src.seek(n * bs)
+                data = src.read(bs)
+            elif op == b'L':
+                data = read_exact(inp, n)
+            else:
+                sys.exit('bad delta op')
+            digest.update(data)
+            dst.write(data)
+    if digest.hexdigest() != sha:
+        os.remove(tmp)
+        sys.exit('checksum mismatch after patch')
+    os.replace(tmp, path)
+    st = os.stat(path)
+    print(st.st_size, int(st.st_mtime))
+def codecs():
+    found = ['zlib']
+    for codec, module in (('zstd', 'zstandard'), ('lz4', 'lz4.frame')):
+        try:
+            __import__(module)
+            found.append(codec)
+        except ImportError:
+            pass
+    print(' '.join(found))
+def inflate(path, codec, sha):
+    if codec == 'zstd':
+        import zstandard
+        dec = zstandard.ZstdDecompressor().decompressobj()
+    elif codec == 'lz4':
+        import lz4.frame
+        dec = lz4.frame.LZ4FrameDecompressor()
+    else:
+        dec = zlib.decompressobj()
+    inp = sys.stdin.buffer
+    digest = hashlib.sha256()
+    dst, tmp = temp_file(path, '.inflate')
+    with dst:
+        while True:
+            data = inp.read(1 << 20)
+            if not data:
+                break
+            data = dec.decompress(data)
+            digest.update(data)
+            dst.write(data)
+        if hasattr(dec, 'flush'):
+            data = dec.flush()
+            digest.update(data)
+            dst.write(data)
+    if digest.hexdigest() != sha:
+        os.remove(tmp)
+        sys.exit('checksum mismatch after inflate')
+    os.replace(tmp, path)
+    st = os.stat(path)
+    print(st.st_size, int(st.st_mtime))
+if sys.argv[1] == 'sig':
+    sig(sys.argv[2], int(sys.argv[3]))
+elif sys.argv[1] == 'codecs':
+    codecs()
+elif sys.argv[1] == 'inflate':
+    inflate(sys.argv[2], sys.argv[3], sys.argv[4])
+else:
+    patch(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+"""
+REMOTE_DELTA_HELPER_NAME = f".file_relay_delta_{hashlib.sha256(REMOTE_DELTA_HELPER).hexdigest()[:12]}.py"
+
+# Hashes of files already on a Raspberry Pi, persisted under log_dir/manifests
+class PiManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.saved_at = 0.0
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+    
+    def get(self, remote_path):
+        with self.lock:
+            return self.entries.get(remote_path)
+    
+    def update(self, remote_path, sha256, attrs):
+        with self.lock:
+            self.entries[remote_path] = {"sha256": sha256, "size": attrs.st_size, "mtime": attrs.st_mtime}
+            self.dirty = True
+            # Writes are batched; losing the last second only costs a redundant send
+            if time.monotonic() - self.saved_at >= 1.0:
+                self._save_locked()
+    
+    def forget(self, remote_path):
+        with self.lock:
+            if self.entries.pop(remote_path, None) is not None:
+                self.dirty = True
+    
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                self._save_locked()
+    
+    def _save_locked(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_manifest(pi_config):
+    with _manifests_lock:
+        manifest = _manifests.get(pi_config["name"])
+        if manifest is None:
+            manifest_dir = os.path.join(CONFIG["log_dir"], "manifests")
+            os.makedirs(manifest_dir, exist_ok=True)
+            manifest = PiManifest(os.path.join(manifest_dir, f"{pi_config['name']}.json"))
+            _manifests[pi_config["name"]] = manifest
+        return manifest
+
+def save_manifests():
+    with _manifests_lock:
+        manifests = list(_manifests.values())
+    for manifest in manifests:
+        manifest.save()
+
+# rsync-style block size: about sqrt(file size), rounded to 1 KiB
+def delta_block_size(file_size):
+    block_size = CONFIG["delta_transfer"]["block_size"]
+    if block_size:
+        return block_size
+    return min(max(int(math.sqrt(file_size)) // 1024 * 1024, 4096), 128 * 1024)
+
+# Match a local file against the remote block signatures
+#
+# Yields ("C", block_index) for blocks the Pi already has and ("L", start, end)
+# for literal byte ranges. Unmatched data is searched byte by byte with a rolling
+# adler32 for up to two blocks (enough to resync after an insertion or deletion);
+# beyond that the search only tries block-aligned offsets so a mostly new file
+# is still processed at C speed.
+def compute_delta(data, signatures, block_size):
+    M = 65521
+    length = len(data)
+    pos = 0
+    literal_start = 0
+    weak = None
+    while pos + block_size <= length:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block_size])
+        candidates = signatures.get(weak)
+        if candidates:
+            strong = hashlib.md5(data[pos:pos + block_size]).digest()
+            index = candidates.get(strong)
+            if index is not None:
+                if literal_start < pos:
+                    yield ("L", literal_start, pos)
+                yield ("C", index)
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+        if pos - literal_start >= 2 * block_size or pos + block_size >= length:
+            pos += block_size
+            weak = None
+            continue
+        # Roll the window forward by one byte
+        out_byte = data[pos]
+        in_byte = data[pos + block_size]
+        a = ((weak & 0xffff) - out_byte + in_byte) % M
+        b = ((weak >> 16) - block_size * out_byte + a - 1) % M
+        weak = (b << 16) | a
+        pos += 1
+    if literal_start < length:
+        yield ("L", literal_start, length)
+
+# Delta ops for a whole file (run through cpu_call)
+def delta_ops(file_path, signatures, block_size):
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return list(compute_delta(data, signatures, block_size))
+
+# Make sure the delta helper exists in remote_dir on the Pi; None if it can't run there
+def ensure_delta_helper(conn, sftp, target_dir):
+    import paramiko
+    if target_dir in conn.remote_helpers:
+        return conn.remote_helpers[target_dir]
+    python = CONFIG["delta_transfer"]["remote_python"]
+    try:
+        # Relative to the login directory (the Pi user's home)
+        helper_dir = os.path.join(sftp.normalize("."), CONFIG["delta_transfer"]["remote_dir"])
+        helper_path = os.path.join(helper_dir, REMOTE_DELTA_HELPER_NAME)
+        try:
+            sftp.stat(helper_path)
+        except IOError:
+            try:
+                sftp.mkdir(helper_dir, 0o700)
+            except IOError:
+                sftp.stat(helper_dir)     # Already there, or created by a concurrent session
+            # Renamed into place so a concurrent session never runs a partial helper
+            tmp_path = f"{helper_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with sftp.open(tmp_path, 'wb') as f:
+                f.write(REMOTE_DELTA_HELPER)
+            replace_remote_file(sftp, tmp_path, helper_path)
+        exit_status, _, error = conn.run_command(f"{python} -c 'import hashlib, zlib'")
+        if exit_status != 0:
+            raise IOError(error or f"{python} not available")
+    except (IOError, paramiko.SSHException) as e:
+        logger.warning(f"Delta transfers disabled for {conn.pi_config['name']}:{target_dir}: {str(e)}")
+        helper_path = None
+    conn.remote_helpers[target_dir] = helper_path
+    return helper_path
+
+# Send only the blocks of file_path that differ from the existing remote copy.
+# Returns the remote attributes after patching, or None if a full send is better.
+def send_delta(conn, sftp, file_path, target_path, file_size, digest):
+    helper_path = ensure_delta_helper(conn, sftp, os.path.dirname(target_path))
+    if helper_path is None:
+        return None
+    
+    python = CONFIG["delta_transfer"]["remote_python"]
+    block_size = delta_block_size(file_size)
+    exit_status, output, error = conn.run_command(
+        f"{python} {shlex.quote(helper_path)} sig {shlex.quote(target_path)} {block_size}"
+    )
+    if exit_status != 0:
+        logger.warning(f"Remote signature failed for {target_path}: {error}")
+        return None
+    
+    signatures = {}
+    for index in range(len(output) // 20):
+        weak, strong = struct.unpack_from('>I16s', output, index * 20)
+        signatures.setdefault(weak, {}).setdefault(strong, index)
+    if not signatures:
+        return None
+    
+    ops = cpu_call(delta_ops, file_path, signatures, block_size)
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        literal_bytes = sum(op[2] - op[1] for op in ops if op[0] == "L")
+        if literal_bytes > file_size * CONFIG["delta_transfer"]["max_literal_ratio"]:
+            return None
+        
+        def send_ops(channel):
+            # Copy ops are tiny, so they are batched instead of sent one packet each
+            pending = bytearray()
+            for op in ops:
+                if op[0] == "C":
+                    pending += b"C" + struct.pack('>I', op[1])
+                    if len(pending) >= 32768:
+                        channel.sendall(pending)
+                        pending.clear()
+                    continue
+                for start in range(op[1], op[2], 1024 * 1024):
+                    end = min(start + 1024 * 1024, op[2])
+                    pending += b"L" + struct.pack('>I', end - start)
+                    channel.sendall(pending)
+                    pending.clear()
+                    for piece in SCHEDULER.paced(data[start:end]):
+                        channel.sendall(piece)
+            pending += b"E"
+            channel.sendall(pending)
+        
+        exit_status, output, error = conn.run_command(
+            f"{python} {shlex.quote(helper_path)} patch {shlex.quote(target_path)} {block_size} {digest}",
+            send_input=send_ops
+        )
+    if exit_status != 0:
+        logger.warning(f"Remote patch failed for {target_path}: {error}")
+        return None
+    
+    logger.info(
+        f"Delta sent {target_path}: {literal_bytes} of {file_size} bytes transferred "
+        f"({len(ops)} ops, {block_size} byte blocks)"
+    )
+    return sftp.stat(target_path)
+
+# Streaming compression
+#
+# Codecs are negotiated per connection (ingest: HELLO frames, egress: the Pi's
+# remote helper) and chosen per file. Files that are already compressed, by
+# extension or magic bytes, or whose first sample_size bytes barely shrink
+# are sent as is; the fast level is used while the CPU is busy.
+COMPRESSION_LEVELS = {"zstd": (3, 1), "lz4": (3, 0), "zlib": (6, 1)}  # codec -> (normal, fast)
+COMPRESSED_MAGIC = (b"PK\x03\x04", b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"\x04\x22\x4d\x18", b"\xfd7zXZ",
+                    b"BZh", b"7z\xbc\xaf", b"Rar!", b"\xff\xd8\xff", b"\x89PNG")
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# Module for an optional codec (zstandard or lz4.frame), imported on first
+# use; None if it isn't installed. zlib is always available as a fallback.
+@functools.lru_cache(maxsize=None)
+def codec_module(codec):
+    try:
+        if codec == "zstd":
+            import zstandard
+            return zstandard
+        if codec == "lz4":
+            import lz4.frame
+            return lz4.frame
+    except ImportError:
+        pass
+    return None
+
+# Codecs this side can use, fastest/best first
+def local_codecs():
+    return [codec for codec in CONFIG["compression"]["codecs"]
+            if codec == "zlib" or codec_module(codec) is not None]
+
+# lz4 frames need begin() before the first chunk
+class _LZ4Compressor:
+    def __init__(self, level):
+        self.compressor = codec_module("lz4").LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+    
+    def compress(self, data):
+        out = self.header + self.compressor.compress(data)
+        self.header = b""
+        return out
+    
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+def make_compressor(codec, level):
+    if codec == "zstd":
+        return codec_module("zstd").ZstdCompressor(level=level).compressobj()
+    if codec == "lz4":
+        return _LZ4Compressor(level)
+    return zlib.compressobj(level)
+
+def make_decompressor(codec):
+    if codec == "zstd":
+        return codec_module("zstd").ZstdDecompressor().decompressobj()
+    if codec == "lz4":
+        return codec_module("lz4").LZ4FrameDecompressor()
+    return zlib.decompressobj()
+
+# Pick (codec, level) for a file from its name and first bytes, or None to send it as is
+def choose_compression(file_name, sample, codecs):
+    settings = CONFIG["compression"]
+    if not codecs or len(sample) < min(settings["min_size"], settings["sample_size"]):
+        return None
+    if os.path.splitext(file_name)[1].lower() in settings["skip_extensions"] or sample.startswith(COMPRESSED_MAGIC):
+        return None
+    codec = codecs[0]
+    busy = os.getloadavg()[0] / (os.cpu_count() or 1) >= settings["busy_load"]
+    level = COMPRESSION_LEVELS[codec][1 if busy else 0]
+    compressor = make_compressor(codec, level)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    if compressed > len(sample) * settings["max_ratio"]:
+        return None
+    return codec, level
+
+# Compressed chunks of an open file from its current position, hashing the raw bytes into digest
+def compressed_chunks(f, codec, level, digest=None):
+    compressor = make_compressor(codec, level)
+    while True:
+        data = f.read(COMPRESS_CHUNK_SIZE)
+        if not data:
+            break
+        if digest:
+            digest.update(data)
+        out = compressor.compress(data)
+        if out:
+            yield out
+    out = compressor.flush()
+    if out:
+        yield out
+
+_READ_AHEAD_END = object()
+
+# Run a chunk generator on its own thread a few chunks ahead of the consumer,
+# so compression overlaps with sending instead of running on the I/O thread
+def read_ahead(chunks, depth=4):
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    
+    def produce():
+        try:
+            for chunk in chunks:
+                while not stopped.is_set():
+                    try:
+                        items.put(chunk, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+            items.put(_READ_AHEAD_END)
+        except Exception as e:
+            items.put(e)
+    
+    threading.Thread(target=produce, name="read-ahead", daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _READ_AHEAD_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+# Codecs the Pi's remote helper can decompress ([] if it can't run there)
+def remote_codecs(conn, sftp, target_dir):
+    if conn.remote_codecs is None:
+        codecs = []
+        helper_path = ensure_delta_helper(conn, sftp, target_dir)
+        if helper_path:
+            python = CONFIG["delta_transfer"]["remote_python"]
+            exit_status, output, _ = conn.run_command(f"{python} {shlex.quote(helper_path)} codecs")
+            if exit_status == 0:
+                codecs = output.decode('ascii', 'replace').split()
+        conn.remote_codecs = [codec for codec in local_codecs() if codec in codecs]
+    return conn.remote_codecs
+
+# Send a file compressed through the remote helper, which inflates, verifies
+# and renames it into place. Returns the remote attributes, or None if
+# compression isn't worthwhile or possible for this file. Compressed sends
+# can't resume, so files above max_size are left to put_resumable.
+def send_compressed(conn, sftp, file_path, target_path, file_size, digest):
+    settings = CONFIG["compression"]
+    if not settings["min_size"] <= file_size <= settings["max_size"]:
+        return None
+    codecs = remote_codecs(conn, sftp, os.path.dirname(target_path))
+    with open(file_path, 'rb') as f:
+        choice = choose_compression(os.path.basename(file_path), f.read(settings["sample_size"]), codecs)
+        if choice is None:
+            return None
+        codec, level = choice
+        f.seek(0)
+        sent = 0
+        
+        def send_chunks(channel):
+            nonlocal sent
+            for chunk in read_ahead(compressed_chunks(f, codec, level)):
+                for piece in SCHEDULER.paced(chunk):
+                    channel.sendall(piece)
+                sent += len(chunk)
+        
+        helper_path = conn.remote_helpers[os.path.dirname(target_path)]
+        python = CONFIG["delta_transfer"]["remote_python"]
+        exit_status, _, error = conn.run_command(
+            f"{python} {shlex.quote(helper_path)} inflate {shlex.quote(target_path)} {codec} {digest}",
+            send_input=send_chunks
+        )
+    if exit_status != 0:
+        logger.warning(f"Compressed send of {target_path} failed: {error}")
+        return None
+    logger.info(f"Compressed send {target_path}: {sent} of {file_size} bytes transferred ({codec} level {level})")
+    return sftp.stat(target_path)
+
+# Local record of how much of an upload the Pi has confirmed, keyed by target path
+class UploadCheckpoint:
+    def __init__(self, pi_config, target_path):
+        checkpoint_dir = os.path.join(CONFIG["log_dir"], "checkpoints", pi_config["name"])
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        key = hashlib.sha1(target_path.encode('utf-8')).hexdigest()
+        self.path = os.path.join(checkpoint_dir, f"{key}.json")
+    
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def save(self, state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+    
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+# SFTP engine settings for a Pi: CONFIG["sftp_engine"] with the Pi's own overrides
+def sftp_engine_settings(pi_config):
+    return dict(CONFIG["sftp_engine"], **pi_config.get("sftp_engine", {}))
+
+# Write data to a pipelined remote file and wait until the Pi has acknowledged
+# it and every write before it. With pipelining off, paramiko collects the
+# replies to all outstanding writes before a write returns (see
+# SFTPFile.set_pipelined), so no other request is needed to confirm them.
+def write_acknowledged(remote_file, data):
+    remote_file.set_pipelined(False)
+    try:
+        remote_file.write(data)
+    finally:
+        remote_file.set_pipelined(True)
+
+# Copy local_file from offset into an open remote file as pipelined write requests.
+#
+# Writes are not acknowledged one at a time: paramiko keeps issuing requests and
+# only collects replies once about a hundred are outstanding, so the transfer is
+# bounded by the SSH window rather than the round-trip time. Every
+# checkpoint_bytes the last request is written acknowledged, which drains the
+# outstanding writes, and the now confirmed offset is checkpointed.
+def upload_stream(local_file, remote_file, offset, file_size, on_confirmed, settings=None):
+    settings = settings or CONFIG["sftp_engine"]
+    checkpoint_bytes = CONFIG["resumable"]["checkpoint_bytes"]
+    next_checkpoint = offset + checkpoint_bytes
+    read_size = settings["read_buffer"]
+    remote_file.MAX_REQUEST_SIZE = settings["request_size"]
+    remote_file.set_pipelined(True)
+    
+    def write(view, offset):
+        nonlocal next_checkpoint
+        end = offset + len(view)
+        confirm = end >= next_checkpoint and end < file_size
+        head = len(view) - min(len(view), remote_file.MAX_REQUEST_SIZE) if confirm else len(view)
+        for piece in SCHEDULER.paced(view[:head]):
+            remote_file.write(piece)
+        if confirm:
+            for piece in SCHEDULER.paced(view[head:]):
+                write_acknowledged(remote_file, piece)
+            on_confirmed(end)
+            next_checkpoint = end + checkpoint_bytes
+        return end
+    
+    if settings["read_mode"] == "mmap" and file_size:
+        with mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < file_size:
+                raise IOError(f"{local_file.name} shrank while uploading")
+            with memoryview(data) as view:
+                while offset < file_size:
+                    offset = write(view[offset:min(offset + read_size, file_size)], offset)
+        return offset
+    
+    buf = bytearray(read_size)
+    with memoryview(buf) as view:
+        while offset < file_size:
+            n = local_file.readinto(view[:min(read_size, file_size - offset)])
+            if not n:
+                raise IOError(f"{local_file.name} shrank while uploading")
+            offset = write(view[:n], offset)
+    return offset
+
+# Confirm the uploaded temp file matches the source before it replaces the target
+def verify_upload(conn, sftp, part_path, file_size, digest):
+    attrs = sftp.stat(part_path)
+    if attrs.st_size != file_size:
+        raise IOError(f"Uploaded size {attrs.st_size} does not match {file_size}")
+    if CONFIG["resumable"]["verify"] != "sha256":
+        return
+    exit_status, output, _ = conn.run_command(f"sha256sum {shlex.quote(part_path)}")
+    if exit_status != 0:
+        return                            # No sha256sum on the Pi; the size check has to do
+    remote_digest = output.split()[0].decode('ascii') if output else ""
+    if remote_digest != digest:
+        raise IOError(f"Checksum mismatch for {part_path}: {remote_digest} != {digest}")
+
+# Atomically move an uploaded temp file over its target
+def replace_remote_file(sftp, part_path, target_path):
+    try:
+        sftp.posix_rename(part_path, target_path)
+    except IOError:
+        # Server without the posix-rename extension: plain rename refuses to overwrite
+        try:
+            sftp.remove(target_path)
+        except IOError:
+            pass
+        sftp.rename(part_path, target_path)
+
+# Remove a failed upload's temp file and checkpoint so the next attempt starts over
+def discard_upload(sftp, part_path, checkpoint):
+    try:
+        sftp.remove(part_path)
+    except IOError:
+        pass
+    checkpoint.clear()
+
+# Upload to <target>.part, resuming a previous attempt from its last
+# checkpointed offset, verify it, then atomically rename it over the target
+def put_resumable(conn, sftp, file_path, target_path, pi_config, digest=None):
+    digest = digest or file_sha256(file_path)
+    file_size = os.path.getsize(file_path)
+    part_path = target_path + ".part"
+    checkpoint = UploadCheckpoint(pi_config, target_path)
+    
+    offset = 0
+    state = checkpoint.load()
+    if state and state["sha256"] == digest and state["size"] == file_size:
+        offset = state.get("offset", 0)
+        try:
+            part_size = sftp.stat(part_path).st_size
+        except IOError:
+            part_size = None
+        # The .part file must hold at least the confirmed bytes and no more than the file
+        if offset and (part_size is None or part_size < offset or part_size > file_size):
+            logger.warning(f"{part_path} on {pi_config['name']} does not match its checkpoint, starting over")
+            discard_upload(sftp, part_path, checkpoint)
+            offset = 0
+        if offset:
+            logger.info(f"Resuming {target_path} on {pi_config['name']} at byte {offset} of {file_size}")
+    state = {"sha256": digest, "size": file_size, "offset": offset}
+    checkpoint.save(state)
+    
+    def on_confirmed(confirmed):
+        state["offset"] = confirmed
+        checkpoint.save(state)
+    
+    with open(file_path, 'rb', buffering=0) as local_file:
+        local_file.seek(offset)
+        with sftp.open(part_path, 'r+' if offset else 'w', bufsize=0) as remote_file:
+            remote_file.seek(offset)
+            upload_stream(local_file, remote_file, offset, file_size, on_confirmed,
+                          sftp_engine_settings(pi_config))
+    
+    try:
+        verify_upload(conn, sftp, part_path, file_size, digest)
+    except IOError:
+        discard_upload(sftp, part_path, checkpoint)
+        raise
+    replace_remote_file(sftp, part_path, target_path)
+    checkpoint.clear()
+    return sftp.stat(target_path)
+
+# Send the whole file, compressed when the Pi and the content allow it.
+# Returns ("compressed" or "full", remote attributes).
+def send_whole_file(conn, sftp, file_path, target_path, pi_config, digest=None):
+    digest = digest or file_sha256(file_path)
+    if CONFIG["compression"]["egress"] and pi_config.get("compression", True):
+        attrs = send_compressed(conn, sftp, file_path, target_path, os.path.getsize(file_path), digest)
+        if attrs is not None:
+            return "compressed", attrs
+    return "full", put_resumable(conn, sftp, file_path, target_path, pi_config, digest)
+
+# Transfer one file over an open pooled session, skipping or delta-encoding where possible.
+# Returns how the file was sent: "full", "compressed", "delta" or "unchanged".
+def transfer_file(conn, sftp, file_path, target_path, pi_config):
+    delta = CONFIG["delta_transfer"]
+    if not delta["enabled"]:
+        return send_whole_file(conn, sftp, file_path, target_path, pi_config)[0]
+    
+    manifest = get_manifest(pi_config)
+    file_size = os.path.getsize(file_path)
+    digest = file_sha256(file_path)
+    
+    try:
+        remote = sftp.stat(target_path)
+    except IOError:
+        remote = None
+    
+    known = manifest.get(target_path)
+    if remote is not None and known and known["sha256"] == digest \
+            and known["size"] == remote.st_size and known["mtime"] == remote.st_mtime:
+        return "unchanged"
+    
+    attrs = None
+    if remote is not None and file_size >= delta["min_size"] and remote.st_size:
+        attrs = send_delta(conn, sftp, file_path, target_path, file_size, digest)
+    mode = "delta"
+    if attrs is None:
+        manifest.forget(target_path)
+        mode, attrs = send_whole_file(conn, sftp, file_path, target_path, pi_config, digest)
+    manifest.update(target_path, digest, attrs)
+    return mode
+
+# Send file via SFTP
+def send_file_via_sftp(file_path, pi_config):
+    import paramiko
+    logger.info(f"Sending {file_path} to {pi_config['name']} ({pi_config['ip']})")
+    target_path = os.path.join(pi_config["target_dir"], os.path.basename(file_path))
+    
+    # Retry once on a fresh transport if the pooled one was dropped underneath us
+    for attempt in range(2):
+        conn = SFTP_POOL.get_connection(pi_config)
+        try:
+            with SFTP_POOL.session(pi_config) as (conn, sftp):
+                conn.ensure_dir(pi_config["target_dir"])
+                start = time.perf_counter()
+                mode = transfer_file(conn, sftp, file_path, target_path, pi_config)
+                METRICS.observe("sftp_put", time.perf_counter() - start)
+            break
+        except paramiko.AuthenticationException:
+            raise
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            if attempt or conn.is_alive() or not HEALTH.available(pi_config):
+                raise
+            logger.warning(f"Connection to {pi_config['name']} dropped ({str(e)}), reconnecting")
+    
+    logger.info(f"Successfully sent {file_path} to {pi_config['name']} ({mode})")
+    return mode
+
+# Token bucket whose waiters are served in weighted fair order.
+#
+# Each request is stamped with a virtual finish time of
+# max(virtual time, the flow's last finish) + bytes / weight and only the
+# earliest stamp may take tokens, so while the link is saturated every flow
+# gets bandwidth in proportion to its weight. The bucket may go into debt for
+# a request larger than the burst; later requests wait it off.
+class LinkShaper:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiters = []                 # (finish, seq) heap
+        self.seq = itertools.count()
+        self.virtual_time = 0.0
+        self.last_finish = {}             # flow -> finish time of its latest request
+        self.cond = threading.Condition()
+    
+    # Block until n bytes of flow may be sent
+    def consume(self, flow, weight, n):
+        if not self.rate:
+            return
+        with self.cond:
+            finish = max(self.virtual_time, self.last_finish.get(flow, 0.0)) + n / weight
+            self.last_finish[flow] = finish
+            entry = (finish, next(self.seq))
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    rate = self.rate      # May change under us on a config reload
+                    if not rate:
+                        break
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+                    self.updated = now
+                    if self.waiters[0] is entry and self.tokens >= 0:
+                        self.tokens -= n
+                        self.virtual_time = finish
+                        break
+                    if self.waiters[0] is entry:
+                        self.cond.wait(-self.tokens / rate)
+                    else:
+                        self.cond.wait()
+            finally:
+                if self.waiters[0] is entry:
+                    heapq.heappop(self.waiters)
+                else:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                self.cond.notify_all()
+    
+    def set_rate(self, rate):
+        with self.cond:
+            if rate != self.rate:
+                self.rate = rate
+                self.cond.notify_all()
+
+_transfer_context = threading.local()
+
+# Priority classes and link shaping for sends to the Pis
+#
+# Every send runs inside transfer(pi, priority), and each chunk written to a
+# Pi passes paced(), which takes it from the Pi's shaper (flows are
+# priority classes) and then from the shared uplink shaper (flows are
+# Pi/class pairs, weighted by the class weight times the Pi's "weight").
+class TransferScheduler:
+    def __init__(self, classes, default_class="normal", pi_rate=0, uplink_rate=0, burst=256 * 1024,
+                 express_workers=1, express_max_size=1024 * 1024):
+        self.classes = classes
+        self.default_class = default_class
+        self.pi_rate = pi_rate
+        self.burst = burst
+        self.express_workers = express_workers
+        self.express_max_size = express_max_size
+        self.top_class = max(classes, key=classes.get)
+        self.uplink = LinkShaper(uplink_rate, burst)
+        self.pi_shapers = {}
+        self.lock = threading.Lock()
+    
+    def weight(self, priority):
+        return self.classes.get(priority, self.classes.get(self.default_class, 1))
+    
+    # Whether an express worker may take this transfer
+    def is_express(self, priority, file_size):
+        return priority == self.top_class and file_size <= self.express_max_size
+    
+    def pi_shaper(self, pi_config):
+        rate = pi_config.get("rate_limit", self.pi_rate)
+        with self.lock:
+            shaper = self.pi_shapers.get(pi_config["name"])
+            if shaper is None:
+                shaper = self.pi_shapers[pi_config["name"]] = LinkShaper(rate, self.burst)
+            shaper.set_rate(rate)         # Follows config reloads
+        return shaper
+    
+    @contextmanager
+    def transfer(self, pi_config, priority):
+        previous = getattr(_transfer_context, "current", None)
+        _transfer_context.current = (pi_config, self.pi_shaper(pi_config), priority, self.weight(priority))
+        try:
+            yield
+        finally:
+            _transfer_context.current = previous
+    
+    # Yield data in pieces of at most burst bytes, each once the links of the
+    # current transfer allow it, so a large chunk can't hold a link for long
+    def paced(self, data):
+        current = getattr(_transfer_context, "current", None)
+        if current is None or not (current[1].rate or self.uplink.rate):
+            yield data
+            return
+        pi_config, shaper, priority, weight = current
+        view = memoryview(data)
+        for offset in range(0, len(view), self.burst):
+            piece = view[offset:offset + self.burst]
+            start = time.perf_counter()
+            shaper.consume(priority, weight, len(piece))
+            self.uplink.consume((pi_config["name"], priority), weight * pi_config.get("weight", 1), len(piece))
+            METRICS.observe("link_wait", time.perf_counter() - start)
+            yield piece
+
+SCHEDULER = TransferScheduler(**CONFIG["scheduler"])
+
+# Bounded per-Pi transfer queue served in weighted fair order across priority
+# classes: a job's cost is its size over its class weight, so a small file of
+# a heavy class overtakes queued bulk transfers without starving them.
+# Express jobs may exceed the bound and are the only ones express workers take.
+class TransferQueue:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.heap = []                    # (finish, seq, express, job)
+        self.seq = itertools.count()
+        self.virtual_time = 0.0
+        self.last_finish = {}             # priority class -> finish time of its latest job
+        self.closed = False
+        self.cond = threading.Condition()
+    
+    def put(self, job, priority, file_size):
+        express = SCHEDULER.is_express(priority, file_size)
+        with self.cond:
+            while len(self.heap) >= self.maxsize and not express and not self.closed:
+                self.cond.wait()
+            finish = max(self.virtual_time, self.last_finish.get(priority, 0.0)) + \
+                max(file_size, 1) / SCHEDULER.weight(priority)
+            self.last_finish[priority] = finish
+            heapq.heappush(self.heap, (finish, next(self.seq), express, job))
+            self.cond.notify_all()
+    
+    # Next job in fair order (express workers: next express job); None once closed and drained
+    def get(self, express=False):
+        with self.cond:
+            while True:
+                if express:
+                    index = min((i for i, entry in enumerate(self.heap) if entry[2]),
+                                key=lambda i: self.heap[i], default=None)
+                else:
+                    index = 0 if self.heap else None
+                if index is not None:
+                    break
+                if self.closed:
+                    return None
+                self.cond.wait()
+            entry = self.heap[index]
+            last = self.heap.pop()
+            if index < len(self.heap):
+                self.heap[index] = last
+                heapq.heapify(self.heap)
+            self.virtual_time = max(self.virtual_time, entry[0])
+            self.cond.notify_all()
+            return entry[3]
+    
+    def qsize(self):
+        with self.cond:
+            return len(self.heap)
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+# One relayed file tracked across all of its destinations
+class TransferRecord:
+    def __init__(self, transfer_log, pending, on_complete=None):
+        self.transfer_log = transfer_log
+        self.pending = pending
+        self.on_complete = on_complete
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_destination(self, destination):
+        with self.lock:
+            self.transfer_log["destinations"].append(destination)
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.finish()
+
+    def finish(self):
+        start = time.perf_counter()
+        try:
+            save_transfer_log(self.transfer_log)
+            METRICS.observe("log_write", time.perf_counter() - start)
+        except Exception as e:
+            METRICS.error("log_write")
+            logger.error(f"Failed to save transfer log for {self.transfer_log['file_name']}: {str(e)}")
+        finally:
+            self.done.set()
+            if self.on_complete:
+                self.on_complete(self)
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+# Hold file_path for an offline Pi and record the destination as deferred
+def defer_transfer(file_path, pi, record, attempt=0):
+    try:
+        FORWARD_STORE.add(file_path, pi)
+        status = f"deferred: {pi['name']} is offline"
+        logger.info(f"Holding {os.path.basename(file_path)} for {pi['name']} until it is reachable")
+    except OSError as e:
+        logger.error(f"Failed to hold {file_path} for {pi['name']}: {str(e)}")
+        status = f"failed: {str(e)}"
+    record.add_destination({
+        "device": pi["name"],
+        "ip": pi["ip"],
+        "target_path": os.path.join(pi["target_dir"], os.path.basename(file_path)),
+        "status": status,
+        "transfer": None,
+        "attempt": attempt,
+        "timestamp": datetime.datetime.now().isoformat()
+    })
+
+# Bounded transfer queue and worker threads for a single Raspberry Pi
+class PiWorkerQueue:
+    def __init__(self, pi_config, workers, queue_size, express_workers=0):
+        self.pi_config = pi_config
+        self.queue = TransferQueue(queue_size)
+        self.threads = []
+        for i in range(workers + express_workers):
+            express = i >= workers
+            thread = threading.Thread(
+                target=self._work,
+                args=(express,),
+                name=f"relay-{pi_config['name']}-{'express-' if express else ''}{i}",
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self, express=False):
+        while True:
+            job = self.queue.get(express)
+            if job is None:
+                break
+            file_path, pi, record, attempt, priority = job
+            if not HEALTH.available(pi):
+                defer_transfer(file_path, pi, record, attempt)
+                FORWARD_STORE.release(file_path)
+                continue
+            stored = FORWARD_STORE.identity(file_path)
+            mode = None
+            start = time.perf_counter()
+            try:
+                with SCHEDULER.transfer(pi, priority):
+                    mode = send_file_via_sftp(file_path, pi)
+                status = "success"
+                METRICS.transfer(pi["name"], time.perf_counter() - start, record.transfer_log["file_size"])
+                if stored is not None:
+                    FORWARD_STORE.remove(file_path, stored)
+            except Exception as e:
+                METRICS.transfer_failed(pi["name"])
+                if not HEALTH.available(pi):
+                    defer_transfer(file_path, pi, record, attempt)
+                    FORWARD_STORE.release(file_path)
+                    continue
+                logger.error(f"Failed to send file to {pi['name']}: {str(e)}")
+                status = f"failed: {str(e)}"
+                if not RETRY_SCHEDULER.schedule(file_path, pi, attempt + 1):
+                    FORWARD_STORE.release(file_path)
+            
+            record.add_destination({
+                "device": pi["name"],
+                "ip": pi["ip"],
+                "target_path": os.path.join(pi["target_dir"], os.path.basename(file_path)),
+                "status": status,
+                "transfer": mode,
+                "attempt": attempt,
+                "timestamp": datetime.datetime.now().isoformat()
+            })
+
+    def stop(self):
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
+
+# Fans each file out to all of its target Raspberry Pis concurrently
+class FanoutEngine:
+    def __init__(self, workers_per_pi=2, queue_size=64):
+        self.workers_per_pi = workers_per_pi
+        self.queue_size = queue_size
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, file_path, pi_config, record, attempt=0):
+        key = SFTPConnectionPool.pool_key(pi_config)
+        with self._lock:
+            worker_queue = self._queues.get(key)
+            if worker_queue is None:
+                worker_queue = PiWorkerQueue(pi_config, self.workers_per_pi, self.queue_size,
+                                             SCHEDULER.express_workers)
+                self._queues[key] = worker_queue
+        priority = ROUTER.route(os.path.basename(file_path))[2]
+        # Blocks when this Pi's queue is full, pushing back on the caller
+        worker_queue.queue.put((file_path, pi_config, record, attempt, priority),
+                               priority, record.transfer_log["file_size"])
+
+    def queue_depths(self):
+        with self._lock:
+            return {key[0]: worker_queue.queue.qsize() for key, worker_queue in self._queues.items()}
+
+    def stop(self):
+        with self._lock:
+            worker_queues = list(self._queues.values())
+            self._queues.clear()
+        for worker_queue in worker_queues:
+            worker_queue.stop()
+
+FANOUT = FanoutEngine(**CONFIG["fanout"])
+
+# Re-drives failed destinations with exponential backoff and full jitter
+class RetryScheduler:
+    def __init__(self, max_attempts=8, base_delay=2, max_delay=600):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.heap = []                    # (due, seq, file_path, pi_config, attempt)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+    
+    def schedule(self, file_path, pi_config, attempt):
+        if attempt > self.max_attempts:
+            logger.error(f"Giving up on {file_path} to {pi_config['name']} after {self.max_attempts} retries")
+            return False
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), file_path, pi_config, attempt))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        logger.info(f"Retry {attempt} of {file_path} to {pi_config['name']} in {delay:.1f}s")
+        return True
+    
+    def pending(self):
+        with self.cond:
+            return len(self.heap)
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopping and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.stopping:
+                    return
+                _, _, file_path, pi_config, attempt = heapq.heappop(self.heap)
+            if not os.path.exists(file_path):
+                logger.warning(f"Dropping retry of {file_path}: file no longer exists")
+                FORWARD_STORE.release(file_path)
+                continue
+            transfer_log = {
+                "file_name": os.path.basename(file_path),
+                "file_size": os.path.getsize(file_path),
+                "timestamp": datetime.datetime.now().isoformat(),
+                "source": "retry",
+                "targets": [pi_config["name"]],
+                "destinations": []
+            }
+            FANOUT.submit(file_path, pi_config, TransferRecord(transfer_log, 1), attempt)
+    
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+RETRY_SCHEDULER = RetryScheduler(**CONFIG["retry"])
+
+# Streams one upload to a single Pi as its chunks arrive.
+#
+# Chunks are queued up to CONFIG["cut_through"]["max_buffer"] bytes; a Pi that
+# falls further behind (or can't be reached) is detached and, once the upload
+# is complete, gets the file through the normal fan-out queue instead.
+class CutThroughStream:
+    def __init__(self, relay, pi_config, max_chunks):
+        self.relay = relay
+        self.pi_config = pi_config
+        self.target_path = os.path.join(pi_config["target_dir"], relay.file_name)
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.detached = False
+        self.digest = None
+        self.thread = threading.Thread(target=self._run, name=f"cut-through-{pi_config['name']}", daemon=True)
+        self.thread.start()
+    
+    def feed(self, chunk):
+        if self.detached:
+            return
+        try:
+            self.queue.put_nowait(chunk)
+        except queue.Full:
+            logger.warning(f"{self.pi_config['name']} fell behind streaming {self.relay.file_name}, "
+                           f"sending it after the upload instead")
+            self.detached = True
+    
+    def close(self, digest):
+        self.digest = digest
+        if digest is None:
+            self.detached = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass                          # Detached: the worker stops at its next chunk
+    
+    def _stream(self, conn, sftp):
+        pi = self.pi_config
+        part_path = self.target_path + ".stream.part"    # Distinct from put_resumable's .part
+        conn.ensure_dir(pi["target_dir"])
+        written = 0
+        with sftp.open(part_path, 'w', bufsize=0) as remote_file:
+            remote_file.MAX_REQUEST_SIZE = sftp_engine_settings(pi)["request_size"]
+            remote_file.set_pipelined(True)
+            while True:
+                chunk = self.queue.get()
+                if chunk is None or self.detached:
+                    break
+                for piece in SCHEDULER.paced(chunk):
+                    remote_file.write(piece)
+                written += len(chunk)
+        if self.detached or written != self.relay.file_size:
+            raise IOError(f"stream stopped after {written} of {self.relay.file_size} bytes")
+        verify_upload(conn, sftp, part_path, written, self.digest)
+        replace_remote_file(sftp, part_path, self.target_path)
+        attrs = sftp.stat(self.target_path)
+        if CONFIG["delta_transfer"]["enabled"]:
+            get_manifest(pi).update(self.target_path, self.digest, attrs)
+    
+    def _run(self):
+        pi = self.pi_config
+        start = time.perf_counter()
+        try:
+            with SCHEDULER.transfer(pi, self.relay.priority), SFTP_POOL.session(pi) as (conn, sftp):
+                self._stream(conn, sftp)
+        except Exception as e:
+            release_stream_slot(pi)
+            METRICS.error("cut_through")
+            self.detached = True
+            self.relay.published.wait()
+            if self.relay.file_path is None:
+                return                    # Upload itself failed; nothing to relay
+            logger.warning(f"Cut-through to {pi['name']} failed ({str(e)}), queueing a normal send")
+            FANOUT.submit(self.relay.file_path, pi, self.relay.record)
+            return
+        release_stream_slot(pi)
+        METRICS.transfer(pi["name"], time.perf_counter() - start, self.relay.file_size)
+        logger.info(f"Successfully streamed {self.relay.file_name} to {pi['name']}")
+        self.relay.record.add_destination({
+            "device": pi["name"],
+            "ip": pi["ip"],
+            "target_path": self.target_path,
+            "status": "success",
+            "transfer": "cut_through",
+            "attempt": 0,
+            "timestamp": datetime.datetime.now().isoformat()
+        })
+
+# Tees an upload being received to its target Pis at once, routed on the
+# header's file name, so relaying finishes shortly after the upload does.
+# Pis that already stream max_streams_per_pi uploads, or that hold a copy the
+# normal path could skip or delta against, get it from disk once complete.
+class CutThroughRelay:
+    def __init__(self, file_name, file_size):
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_path = None
+        self.published = threading.Event()
+        self.sha256 = hashlib.sha256()
+        
+        start = time.perf_counter()
+        target_pi_names, target_pis, self.priority = ROUTER.route(file_name)
+        METRICS.observe("route_lookup", time.perf_counter() - start)
+        transfer_log = {
+            "file_name": file_name,
+            "file_size": file_size,
+            "timestamp": datetime.datetime.now().isoformat(),
+            "source": "cut_through",
+            "targets": list(target_pi_names),
+            "destinations": []
+        }
+        self.record = TransferRecord(transfer_log, len(target_pis))
+        max_chunks = max(1, CONFIG["cut_through"]["max_buffer"] // CONFIG["recv_chunk_size"])
+        self.offline = []
+        self.fallback = []
+        self.streams = []
+        for pi in target_pis:
+            if not HEALTH.available(pi):
+                self.offline.append(pi)
+            elif has_remote_copy(pi, file_name) or not acquire_stream_slot(pi):
+                self.fallback.append(pi)
+            else:
+                self.streams.append(CutThroughStream(self, pi, max_chunks))
+        if self.streams:
+            logger.info(f"Streaming {file_name} ({file_size} bytes) to Raspberry Pis: "
+                        f"{', '.join(stream.pi_config['name'] for stream in self.streams)}")
+    
+    # chunk may be a view of a reused receive buffer; the streams get their own copy
+    def feed(self, chunk):
+        self.sha256.update(chunk)
+        if self.streams:
+            chunk = bytes(chunk)
+        for stream in self.streams:
+            stream.feed(chunk)
+    
+    # Move the completed upload into incoming_dir (bypassing the watcher) and let the streams finish.
+    # If anything fails once the file is published, it is relayed normally instead.
+    def publish(self, part_path):
+        dest_path = os.path.abspath(os.path.join(CONFIG["incoming_dir"], self.file_name))
+        with _cut_through_lock:
+            _cut_through_files.add(dest_path)
+        published = handed_off = False
+        try:
+            publish_incoming_file(part_path, self.file_name)
+            published = True
+            # Stamped after the upload's last write so the backlog scan sees it as relayed
+            self.record.transfer_log["timestamp"] = datetime.datetime.now().isoformat()
+            start = time.perf_counter()
+            store_outgoing(dest_path, self.file_name)
+            METRICS.observe("outgoing_store", time.perf_counter() - start)
+            self.file_path = dest_path
+            digest = self.sha256.hexdigest()
+            for stream in self.streams:
+                stream.close(digest)
+            self.published.set()
+            for pi in self.offline:
+                defer_transfer(dest_path, pi, self.record)
+            for pi in self.fallback:
+                FANOUT.submit(dest_path, pi, self.record)
+            if not self.streams and not self.offline and not self.fallback:
+                self.record.finish()
+            handed_off = True
+        except Exception as e:
+            if not published:
+                raise                     # Still staged; the receiver discards it
+            logger.error(f"Cut-through relay of {self.file_name} failed ({str(e)}), queueing a normal relay")
+            self.file_path = None
+            self.abort()
+        finally:
+            if not handed_off:
+                with _cut_through_lock:
+                    _cut_through_files.discard(dest_path)
+        if not handed_off:
+            INGEST_QUEUE.put(dest_path)
+        return dest_path
+    
+    def abort(self):
+        for stream in self.streams:
+            stream.close(None)
+        self.published.set()
+
+_cut_through_files = set()
+_cut_through_streams = {}                 # Pi name -> streams in progress
+_cut_through_lock = threading.Lock()
+
+def acquire_stream_slot(pi_config):
+    with _cut_through_lock:
+        active = _cut_through_streams.get(pi_config["name"], 0)
+        if active >= CONFIG["cut_through"]["max_streams_per_pi"]:
+            return False
+        _cut_through_streams[pi_config["name"]] = active + 1
+        return True
+
+def release_stream_slot(pi_config):
+    with _cut_through_lock:
+        _cut_through_streams[pi_config["name"]] -= 1
+
+# Whether the Pi is known to hold a version of file_name that skip-unchanged or delta could use
+def has_remote_copy(pi_config, file_name):
+    if not CONFIG["delta_transfer"]["enabled"]:
+        return False
+    return get_manifest(pi_config).get(os.path.join(pi_config["target_dir"], file_name)) is not None
+
+# Start a cut-through relay for an upload whose header just arrived, if
+# enabled; None when no target Pi would stream it
+def start_cut_through(file_name, file_size):
+    settings = CONFIG["cut_through"]
+    if not settings["enabled"] or file_size < settings["min_size"]:
+        return None
+    relay = CutThroughRelay(file_name, file_size)
+    return relay if relay.streams else None
+
+# Whether a file appearing in incoming_dir was published by a cut-through relay
+def take_cut_through_file(file_path):
+    with _cut_through_lock:
+        try:
+            _cut_through_files.remove(os.path.abspath(file_path))
+            return True
+        except KeyError:
+            return False
+
+# Parse the JSON header sent ahead of each uploaded file
+def parse_file_header(header_data):
+    return validate_file_header(json.loads(header_data.decode('utf-8')))
+
+# Check an upload header's file name and size
+def validate_file_header(header):
+    file_name = header.get('file_name')
+    file_size = header.get('file_size')
+    
+    if not file_name or not isinstance(file_size, int):
+        raise ValueError("Invalid file header")
+    
+    # Never let a client write outside the incoming directory
+    file_name = os.path.basename(file_name)
+    if not file_name or file_name in (".", ".."):
+        raise ValueError("Invalid file name")
+    
+    return file_name, file_size
+
+# Framed ingest protocol, version 1
+#
+# A connection that opens with FRAME_MAGIC carries any number of files. Frames
+# are a 1-byte type and a 4-byte big-endian body length, followed by the body.
+#   client -> server: optional HELLO frame {"codecs": [...]} first, answered with
+#                     the server's HELLO {"version", "codecs"} (the codecs both support);
+#                     FILE frame with a JSON header {"id", "file_name", "file_size"[, "encoding"]},
+#                     then file_size payload bytes and the payload's 32-byte SHA-256;
+#                     END frame once there are no more files
+#   server -> client: ACKS frames, a JSON list of {"id", "status"} ("ok" or "error",
+#                     with "error" set), batched up to ack_batch files or sent
+#                     whenever the client pauses for ack_delay
+# With an "encoding" the payload is instead sent compressed as 4-byte length
+# prefixed chunks ending with a zero length; file_size and the SHA-256 still
+# describe the original bytes.
+# Clients send files back to back without waiting for acks. Connections that
+# start with anything else are served with the legacy single-file protocol.
+FRAME_MAGIC = b"FRL\x01"
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_FILE = 1
+FRAME_END = 2
+FRAME_ACKS = 3
+FRAME_HELLO = 4
+CHUNK_LENGTH = struct.Struct("!I")
+MAX_ENCODED_CHUNK = 16 * 1024 * 1024
+
+def encode_frame(kind, body=b""):
+    return FRAME_HEADER.pack(kind, len(body)) + body
+
+# Split a frame header, refusing oversized bodies
+def decode_frame_header(data):
+    kind, length = FRAME_HEADER.unpack(data)
+    if length > CONFIG["framed_protocol"]["max_header"]:
+        raise ValueError(f"Frame of {length} bytes exceeds max_header")
+    return kind, length
+
+# Parse a FILE frame body into (id, file name, size, encoding or None)
+def parse_frame_file_header(body, codecs):
+    header = json.loads(body.decode('utf-8'))
+    file_name, file_size = validate_file_header(header)
+    encoding = header.get("encoding")
+    if encoding is not None and encoding not in codecs:
+        raise ValueError(f"Encoding {encoding} was not negotiated")
+    return header.get("id"), file_name, file_size, encoding
+
+# Answer a client's HELLO; returns the codecs both sides support
+def negotiate_codecs(body):
+    offered = json.loads(body.decode('utf-8')).get("codecs", []) if body else []
+    codecs = [codec for codec in local_codecs() if codec in offered] if CONFIG["compression"]["ingest"] else []
+    return codecs, encode_frame(FRAME_HELLO, json.dumps({"version": 1, "codecs": codecs}).encode('utf-8'))
+
+# Decompress one received chunk (None flushes the stream), pass it to
+# on_chunk and write it; returns the number of bytes written
+def inflate_chunk(decompressor, data, f, on_chunk=None):
+    if data is not None:
+        out = decompressor.decompress(data)
+    else:
+        out = decompressor.flush() if hasattr(decompressor, "flush") else b""
+    if out:
+        if on_chunk:
+            on_chunk(out)
+        f.write(out)
+    return len(out)
+
+# Read one length-prefixed compressed chunk length, refusing oversized ones
+def decode_chunk_length(data):
+    (length,) = CHUNK_LENGTH.unpack(data)
+    if length > MAX_ENCODED_CHUNK:
+        raise IOError(f"Compressed chunk of {length} bytes exceeds {MAX_ENCODED_CHUNK}")
+    return length
+
+# Receive a compressed payload from a blocking socket into an open file
+def receive_encoded_to_file(client_socket, f, file_size, encoding, on_chunk=None):
+    decompressor = make_decompressor(encoding)
+    bytes_written = 0
+    while True:
+        length = decode_chunk_length(recv_exact(client_socket, CHUNK_LENGTH.size))
+        if not length:
+            break
+        bytes_written += inflate_chunk(decompressor, recv_exact(client_socket, length), f, on_chunk)
+        if bytes_written > file_size:
+            raise IOError(f"Payload inflates beyond its announced {file_size} bytes")
+    return bytes_written + inflate_chunk(decompressor, None, f, on_chunk)
+
+# Receive exactly size bytes from a blocking socket
+def recv_exact(client_socket, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError(f"Connection closed after {len(data)} of {size} bytes")
+        data += chunk
+    return bytes(data)
+
+# Send files over one framed connection without waiting between them,
+# compressing those worth it with a codec negotiated with the receiver.
+# Returns the acks by file name, e.g. {"a.bin": {"id": 0, "status": "ok"}}.
+def send_files(host, port, file_paths, chunk_size=1024 * 1024, timeout=30, compression=True):
+    acks = {}
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        names = {}
+        codecs = []
+        sock.sendall(FRAME_MAGIC)
+        if compression:
+            sock.sendall(encode_frame(FRAME_HELLO, json.dumps({"codecs": local_codecs()}).encode('utf-8')))
+            kind, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+            codecs = json.loads(recv_exact(sock, length)).get("codecs", [])
+        
+        def collect_acks():
+            try:
+                while len(acks) < len(file_paths):
+                    kind, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+                    for ack in json.loads(recv_exact(sock, length)):
+                        acks[names[ack["id"]]] = ack
+            except (OSError, ValueError):
+                pass
+        
+        reader = threading.Thread(target=collect_acks, daemon=True)
+        reader.start()
+        for file_id, file_path in enumerate(file_paths):
+            file_name = os.path.basename(file_path)
+            names[file_id] = file_name
+            file_size = os.path.getsize(file_path)
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                choice = choose_compression(file_name, f.read(CONFIG["compression"]["sample_size"]), codecs)
+                f.seek(0)
+                header = {"id": file_id, "file_name": file_name, "file_size": file_size}
+                if choice:
+                    header["encoding"] = choice[0]
+                sock.sendall(encode_frame(FRAME_FILE, json.dumps(header).encode('utf-8')))
+                if choice:
+                    for chunk in read_ahead(compressed_chunks(f, choice[0], choice[1], digest)):
+                        sock.sendall(CHUNK_LENGTH.pack(len(chunk)) + chunk)
+                    sock.sendall(CHUNK_LENGTH.pack(0) + digest.digest())
+                    continue
+                sent = 0
+                while sent < file_size:
+                    chunk = f.read(min(chunk_size, file_size - sent))
+                    if not chunk:
+                        raise IOError(f"{file_path} shrank while sending")
+                    digest.update(chunk)
+                    sock.sendall(chunk)
+                    sent += len(chunk)
+            sock.sendall(digest.digest())
+        sock.sendall(encode_frame(FRAME_END))
+        reader.join(timeout)
+    return acks
+
+# Reserve disk space for an incoming file so writes don't fragment or fail midway
+def preallocate_file(fd, file_size):
+    if not CONFIG["preallocate_files"] or file_size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, file_size)
+        return True
+    except OSError as e:
+        # Some filesystems (e.g. tmpfs on older kernels, FAT) don't support fallocate
+        logger.debug(f"posix_fallocate not available for {file_size} bytes: {str(e)}")
+        return False
+
+_recv_buffers = threading.local()
+
+# Per-thread receive buffer, reused across connections handled by the same thread
+def get_recv_buffer(size):
+    buf = getattr(_recv_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = memoryview(bytearray(size))
+        _recv_buffers.buf = buf
+    return buf
+
+# Copy socket data straight into the file through a kernel pipe (Linux only)
+def _receive_spliced(client_socket, f, file_size, chunk_size):
+    pipe_r, pipe_w = os.pipe()
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(pipe_w, 1031, chunk_size)  # F_SETPIPE_SZ
+        except OSError:
+            pass
+        sock_fd = client_socket.fileno()
+        file_fd = f.fileno()
+        bytes_received = 0
+        while bytes_received < file_size:
+            n = os.splice(sock_fd, pipe_w, min(chunk_size, file_size - bytes_received))
+            if not n:
+                break
+            pending = n
+            while pending:
+                pending -= os.splice(pipe_r, file_fd, pending)
+            bytes_received += n
+        return bytes_received
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+# Receive up to file_size bytes from a socket into an open file.
+# With on_chunk every chunk is also handed to it before being written, which
+# rules out splice. With recv_into the chunk is a view of a reused buffer, so
+# on_chunk must copy anything it keeps.
+def receive_to_file(client_socket, f, file_size, chunk_size=None, strategy=None, on_chunk=None):
+    chunk_size = chunk_size or CONFIG["recv_chunk_size"]
+    strategy = strategy or CONFIG["recv_strategy"]
+    
+    if strategy == "splice" and hasattr(os, "splice") and not on_chunk:
+        f.flush()
+        return _receive_spliced(client_socket, f, file_size, chunk_size)
+    
+    bytes_received = 0
+    if strategy == "recv":
+        while bytes_received < file_size:
+            chunk = client_socket.recv(min(chunk_size, file_size - bytes_received))
+            if not chunk:
+                break
+            if on_chunk:
+                on_chunk(chunk)
+            f.write(chunk)
+            bytes_received += len(chunk)
+        return bytes_received
+    
+    # recv_into a reused buffer: no bytes object is allocated per chunk
+    buf = get_recv_buffer(chunk_size)
+    while bytes_received < file_size:
+        n = client_socket.recv_into(buf, min(chunk_size, file_size - bytes_received))
+        if not n:
+            break
+        if on_chunk:
+            on_chunk(buf[:n])
+        f.write(buf[:n])
+        bytes_received += n
+    return bytes_received
+
+_staging_ids = itertools.count()
+
+# Unique path in staging_dir for an upload in progress
+def staging_path(file_name):
+    return os.path.join(CONFIG["staging_dir"], f"{os.getpid()}_{next(_staging_ids)}_{file_name}")
+
+# Atomically move a fully received upload into incoming_dir
+def publish_incoming_file(part_path, file_name):
+    dest_path = os.path.join(CONFIG["incoming_dir"], file_name)
+    os.replace(part_path, dest_path)
+    return dest_path
+
+# Remove a partially received upload
+def discard_staged_file(part_path):
+    if part_path:
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+# TCP server for receiving files over network
+class FileReceiver:
+    def __init__(self, host='0.0.0.0', port=None, reuse_port=False):
+        self.host = host
+        self.port = CONFIG["server_port"] if port is None else port
+        self.reuse_port = reuse_port
+        self.server_socket = None
+        self.ready = threading.Event()
+    
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
+        try:
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(CONFIG["receiver_backlog"])
+            logger.info(f"File receiver server started on {self.host}:{self.port}")
+            METRICS.startup_phase("receiver_listening")
+            self.ready.set()
+            
+            while True:
+                client_socket, addr = self.server_socket.accept()
+                METRICS.startup_phase("first_connection")
+                logger.info(f"Connection from {addr}")
+                
+                # Handle client in a new thread
+                client_thread = threading.Thread(
+                    target=self.handle_client,
+                    args=(client_socket, addr)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+                
+        except Exception as e:
+            logger.error(f"Server error: {str(e)}")
+        finally:
+            self.ready.set()
+            if self.server_socket:
+                self.server_socket.close()
+    
+    def handle_client(self, client_socket, addr):
+        try:
+            magic = client_socket.recv(len(FRAME_MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+            if magic == FRAME_MAGIC:
+                client_socket.recv(len(FRAME_MAGIC))
+                self.handle_framed_client(client_socket, addr)
+            else:
+                self.handle_legacy_client(client_socket, addr)
+        except Exception as e:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: {str(e)}")
+        finally:
+            client_socket.close()
+    
+    # Framed protocol: many pipelined files per connection with batched acks
+    def handle_framed_client(self, client_socket, addr):
+        settings = CONFIG["framed_protocol"]
+        acks = []
+        codecs = []
+        try:
+            while True:
+                if acks and (len(acks) >= settings["ack_batch"] or
+                             not select.select([client_socket], [], [], settings["ack_delay"])[0]):
+                    client_socket.sendall(encode_frame(FRAME_ACKS, json.dumps(acks).encode('utf-8')))
+                    acks = []
+                kind, length = decode_frame_header(recv_exact(client_socket, FRAME_HEADER.size))
+                body = recv_exact(client_socket, length)
+                if kind == FRAME_END:
+                    break
+                if kind == FRAME_HELLO:
+                    codecs, reply = negotiate_codecs(body)
+                    client_socket.sendall(reply)
+                    continue
+                if kind != FRAME_FILE:
+                    raise ValueError(f"Unexpected frame type {kind}")
+                acks.append(self.receive_framed_file(client_socket, body, addr, codecs))
+        finally:
+            if acks:
+                client_socket.sendall(encode_frame(FRAME_ACKS, json.dumps(acks).encode('utf-8')))
+    
+    # Receive one file of a framed connection. A checksum mismatch only fails
+    # this file; anything that loses the framing position is raised.
+    def receive_framed_file(self, client_socket, body, addr, codecs):
+        file_id, file_name, file_size, encoding = parse_frame_file_header(body, codecs)
+        logger.info(f"Receiving file: {file_name} ({file_size} bytes) from {addr}")
+        part_path = staging_path(file_name)
+        wait_for_ingest_capacity()
+        cut_through = start_cut_through(file_name, file_size)
+        digest = hashlib.sha256()
+        
+        def on_chunk(chunk):
+            digest.update(chunk)
+            if cut_through:
+                cut_through.feed(chunk)
+        
+        try:
+            with open(part_path, 'wb') as f:
+                preallocate_file(f.fileno(), file_size)
+                if encoding:
+                    bytes_received = receive_encoded_to_file(client_socket, f, file_size, encoding, on_chunk)
+                else:
+                    bytes_received = receive_to_file(client_socket, f, file_size, on_chunk=on_chunk)
+            if bytes_received < file_size and not encoding:
+                raise ConnectionError(f"Connection closed after {bytes_received} of {file_size} bytes")
+            expected = recv_exact(client_socket, digest.digest_size)
+            if bytes_received != file_size:
+                raise ValueError(f"Payload inflated to {bytes_received} of {file_size} bytes")
+            if expected != digest.digest():
+                raise ValueError("checksum mismatch")
+            if cut_through:
+                cut_through.publish(part_path)
+            else:
+                publish_incoming_file(part_path, file_name)
+        except Exception as e:
+            discard_staged_file(part_path)
+            if cut_through:
+                cut_through.abort()
+            if not isinstance(e, ValueError):
+                raise
+            METRICS.error("receive")
+            logger.error(f"Rejected {file_name} from {addr}: {str(e)}")
+            return {"id": file_id, "status": "error", "error": str(e)}
+        logger.info(f"File {file_name} received successfully from {addr}")
+        return {"id": file_id, "status": "ok"}
+    
+    # Legacy protocol: JSON header, ACK, payload, SUCCESS for a single file
+    def handle_legacy_client(self, client_socket, addr):
+        part_path = None
+        cut_through = None
+        try:
+            # Receive header with file name and size
+            header_data = client_socket.recv(1024)
+            file_name, file_size = parse_file_header(header_data)
+            
+            logger.info(f"Receiving file: {file_name} ({file_size} bytes) from {addr}")
+            
+            # Write into staging_dir; the file appears in incoming_dir only once complete
+            part_path = staging_path(file_name)
+            
+            # Send acknowledgment once the relay pipeline can take more work
+            wait_for_ingest_capacity()
+            cut_through = start_cut_through(file_name, file_size)
+            client_socket.send(b"ACK")
+            
+            # Receive and write the file, streaming it to the target Pis as it arrives
+            with open(part_path, 'wb') as f:
+                preallocated = preallocate_file(f.fileno(), file_size)
+                bytes_received = receive_to_file(client_socket, f, file_size,
+                                                 on_chunk=cut_through.feed if cut_through else None)
+                if preallocated and bytes_received < file_size:
+                    f.truncate(bytes_received)
+            
+            if bytes_received < file_size:
+                raise ValueError(f"Connection closed after {bytes_received} of {file_size} bytes")
+            
+            if cut_through:
+                cut_through.publish(part_path)
+            else:
+                publish_incoming_file(part_path, file_name)
+            part_path = None
+            logger.info(f"File {file_name} received successfully from {addr}")
+            client_socket.send(b"SUCCESS")
+            
+        except Exception as e:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: {str(e)}")
+            discard_staged_file(part_path)
+            if cut_through:
+                cut_through.abort()
+            try:
+                client_socket.send(f"ERROR: {str(e)}".encode('utf-8'))
+            except:
+                pass
+
+# Event-loop TCP server serving many concurrent uploads from one thread
+class AsyncFileReceiver:
+    def __init__(self, host='0.0.0.0', port=None, reuse_port=False):
+        self.host = host
+        self.port = CONFIG["server_port"] if port is None else port
+        self.reuse_port = reuse_port
+        self.backlog = CONFIG["receiver_backlog"]
+        self.max_connections = CONFIG["max_connections"]
+        self.read_timeout = CONFIG["client_read_timeout"]
+        self.chunk_size = CONFIG["recv_chunk_size"]
+        self.active_connections = 0
+        self.loop = None
+        self.server = None
+        self.disk_executor = None
+        self.ready = threading.Event()
+    
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            logger.error(f"Server error: {str(e)}")
+        finally:
+            self.ready.set()
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.disk_executor = ThreadPoolExecutor(
+            max_workers=CONFIG["disk_writer_threads"],
+            thread_name_prefix="receiver-disk"
+        )
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_client,
+                self.host,
+                self.port,
+                backlog=self.backlog,
+                limit=self.chunk_size,
+                reuse_address=True,
+                reuse_port=self.reuse_port or None
+            )
+            logger.info(f"Async file receiver server started on {self.host}:{self.port}")
+            METRICS.startup_phase("receiver_listening")
+            self.ready.set()
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.disk_executor.shutdown(wait=False)
+    
+    def stop(self):
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+    
+    async def _read(self, reader, size):
+        return await asyncio.wait_for(reader.read(size), self.read_timeout)
+    
+    async def _disk(self, func, *args):
+        return await self.loop.run_in_executor(self.disk_executor, func, *args)
+    
+    async def handle_client(self, reader, writer):
+        METRICS.startup_phase("first_connection")
+        addr = writer.get_extra_info('peername')
+        if self.active_connections >= self.max_connections:
+            logger.warning(f"Refusing connection from {addr}: {self.active_connections} uploads in progress")
+            writer.write(b"ERROR: server busy")
+            writer.close()
+            return
+        
+        self.active_connections += 1
+        logger.info(f"Connection from {addr}")
+        try:
+            magic = await asyncio.wait_for(reader.readexactly(len(FRAME_MAGIC)), self.read_timeout)
+            if magic == FRAME_MAGIC:
+                await self.handle_framed_client(reader, writer, addr)
+            else:
+                await self.handle_legacy_client(reader, writer, addr, magic)
+        except asyncio.TimeoutError:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: no data for {self.read_timeout}s")
+        except Exception as e:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: {str(e)}")
+        finally:
+            self.active_connections -= 1
+            writer.close()
+    
+    async def _read_exactly(self, reader, size):
+        return await asyncio.wait_for(reader.readexactly(size), self.read_timeout)
+    
+    # Bytes the StreamReader has already read off the socket. asyncio has no
+    # public accessor for this; it is the only StreamReader internal used.
+    @staticmethod
+    def _buffered(reader):
+        return len(reader._buffer)
+    
+    # Stream one payload to a new file; returns the bytes received.
+    #
+    # With recv_strategy "recv" the payload goes through the StreamReader.
+    # Otherwise the transport is paused, whatever the StreamReader already
+    # holds is taken first, and the rest is read with sock_recv_into on a dup
+    # of the connection's socket into one buffer reused for every chunk.
+    # on_chunk then gets views of that buffer and must copy what it keeps.
+    async def _receive_to_file(self, reader, writer, part_path, file_size, on_chunk):
+        # Each chunk is written before the next read, so a slow disk stalls the
+        # socket and TCP flow control pushes back on the sender
+        f = await self._disk(open, part_path, 'wb')
+        transport = writer.transport
+        direct = CONFIG["recv_strategy"] != "recv"
+        sock = None
+        try:
+            preallocated = await self._disk(preallocate_file, f.fileno(), file_size)
+            bytes_received = 0
+            if direct:
+                transport.pause_reading()
+            while bytes_received < file_size and (not direct or self._buffered(reader)):
+                chunk = await self._read(reader, min(self.chunk_size, file_size - bytes_received))
+                if not chunk:
+                    break
+                if direct:
+                    transport.pause_reading()     # read() resumes the transport if it had paused it
+                if on_chunk:
+                    on_chunk(chunk)
+                await self._disk(f.write, chunk)
+                bytes_received += len(chunk)
+            if direct and bytes_received < file_size and not reader.at_eof():
+                sock = writer.get_extra_info('socket').dup()
+                sock.setblocking(False)
+                buf = memoryview(bytearray(min(self.chunk_size, file_size - bytes_received)))
+                while bytes_received < file_size:
+                    view = buf[:min(len(buf), file_size - bytes_received)]
+                    n = await asyncio.wait_for(self.loop.sock_recv_into(sock, view), self.read_timeout)
+                    if not n:
+                        break
+                    if on_chunk:
+                        on_chunk(view[:n])
+                    await self._disk(f.write, view[:n])
+                    bytes_received += n
+            if preallocated and bytes_received < file_size:
+                await self._disk(f.truncate, bytes_received)
+        finally:
+            if sock is not None:
+                sock.close()
+            if direct:
+                transport.resume_reading()
+            await self._disk(f.close)
+        return bytes_received
+    
+    # Inflate a compressed payload to a new file; decompression and writes
+    # run on the disk threads so the event loop only moves bytes
+    async def _receive_encoded_to_file(self, reader, part_path, file_size, encoding, on_chunk):
+        decompressor = make_decompressor(encoding)
+        f = await self._disk(open, part_path, 'wb')
+        try:
+            await self._disk(preallocate_file, f.fileno(), file_size)
+            bytes_written = 0
+            while True:
+                length = decode_chunk_length(await self._read_exactly(reader, CHUNK_LENGTH.size))
+                if not length:
+                    break
+                data = await self._read_exactly(reader, length)
+                bytes_written += await self._disk(inflate_chunk, decompressor, data, f, on_chunk)
+                if bytes_written > file_size:
+                    raise IOError(f"Payload inflates beyond its announced {file_size} bytes")
+            bytes_written += await self._disk(inflate_chunk, decompressor, None, f, on_chunk)
+        finally:
+            await self._disk(f.close)
+        return bytes_written
+    
+    # Framed protocol: many pipelined files per connection with batched acks
+    async def handle_framed_client(self, reader, writer, addr):
+        settings = CONFIG["framed_protocol"]
+        acks = []
+        codecs = []
+        try:
+            while True:
+                if len(acks) >= settings["ack_batch"]:
+                    await self._send_acks(writer, acks)
+                    acks = []
+                try:
+                    frame_header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size),
+                                                          settings["ack_delay"] if acks else self.read_timeout)
+                except asyncio.TimeoutError:
+                    if not acks:
+                        raise
+                    # Client paused: acknowledge what we have, then keep waiting
+                    await self._send_acks(writer, acks)
+                    acks = []
+                    continue
+                kind, length = decode_frame_header(frame_header)
+                body = await self._read_exactly(reader, length)
+                if kind == FRAME_END:
+                    break
+                if kind == FRAME_HELLO:
+                    codecs, reply = negotiate_codecs(body)
+                    writer.write(reply)
+                    await writer.drain()
+                    continue
+                if kind != FRAME_FILE:
+                    raise ValueError(f"Unexpected frame type {kind}")
+                acks.append(await self.receive_framed_file(reader, writer, body, addr, codecs))
+        finally:
+            if acks:
+                await self._send_acks(writer, acks)
+    
+    async def _send_acks(self, writer, acks):
+        writer.write(encode_frame(FRAME_ACKS, json.dumps(acks).encode('utf-8')))
+        await writer.drain()
+    
+    # Receive one file of a framed connection. A checksum mismatch only fails
+    # this file; anything that loses the framing position is raised.
+    async def receive_framed_file(self, reader, writer, body, addr, codecs):
+        file_id, file_name, file_size, encoding = parse_frame_file_header(body, codecs)
+        logger.info(f"Receiving file: {file_name} ({file_size} bytes) from {addr}")
+        part_path = staging_path(file_name)
+        if INGEST_QUEUE is not None and INGEST_QUEUE.congested():
+            await self.loop.run_in_executor(None, wait_for_ingest_capacity)
+        cut_through = start_cut_through(file_name, file_size)
+        digest = hashlib.sha256()
+        
+        def on_chunk(chunk):
+            digest.update(chunk)
+            if cut_through:
+                cut_through.feed(chunk)
+        
+        try:
+            if encoding:
+                bytes_received = await self._receive_encoded_to_file(reader, part_path, file_size, encoding, on_chunk)
+            else:
+                bytes_received = await self._receive_to_file(reader, writer, part_path, file_size, on_chunk)
+            if bytes_received < file_size and not encoding:
+                raise ConnectionError(f"Connection closed after {bytes_received} of {file_size} bytes")
+            expected = await self._read_exactly(reader, digest.digest_size)
+            if bytes_received != file_size:
+                raise ValueError(f"Payload inflated to {bytes_received} of {file_size} bytes")
+            if expected != digest.digest():
+                raise ValueError("checksum mismatch")
+            if cut_through:
+                await self._disk(cut_through.publish, part_path)
+            else:
+                await self._disk(publish_incoming_file, part_path, file_name)
+        except asyncio.CancelledError:
+            # Shutting down: clean up without awaiting anything in the cancelled task
+            discard_staged_file(part_path)
+            if cut_through:
+                cut_through.abort()
+            raise
+        except Exception as e:
+            await self._disk(discard_staged_file, part_path)
+            if cut_through:
+                cut_through.abort()
+            if not isinstance(e, ValueError):
+                raise
+            METRICS.error("receive")
+            logger.error(f"Rejected {file_name} from {addr}: {str(e)}")
+            return {"id": file_id, "status": "error", "error": str(e)}
+        logger.info(f"File {file_name} received successfully from {addr}")
+        return {"id": file_id, "status": "ok"}
+    
+    # Legacy protocol: JSON header, ACK, payload, SUCCESS for a single file
+    async def handle_legacy_client(self, reader, writer, addr, prefix):
+        part_path = None
+        cut_through = None
+        try:
+            # Receive header with file name and size (its first bytes were read for protocol detection)
+            header_data = prefix + await self._read(reader, 1024 - len(prefix))
+            file_name, file_size = parse_file_header(header_data)
+            
+            logger.info(f"Receiving file: {file_name} ({file_size} bytes) from {addr}")
+            
+            # Write into staging_dir; the file appears in incoming_dir only once complete
+            part_path = staging_path(file_name)
+            
+            # Send acknowledgment once the relay pipeline can take more work
+            if INGEST_QUEUE is not None and INGEST_QUEUE.congested():
+                await self.loop.run_in_executor(None, wait_for_ingest_capacity)
+            cut_through = start_cut_through(file_name, file_size)
+            writer.write(b"ACK")
+            await writer.drain()
+            
+            bytes_received = await self._receive_to_file(reader, writer, part_path, file_size,
+                                                         cut_through.feed if cut_through else None)
+            
+            if bytes_received < file_size:
+                raise ValueError(f"Connection closed after {bytes_received} of {file_size} bytes")
+            
+            if cut_through:
+                await self._disk(cut_through.publish, part_path)
+            else:
+                await self._disk(publish_incoming_file, part_path, file_name)
+            part_path = None
+            logger.info(f"File {file_name} received successfully from {addr}")
+            writer.write(b"SUCCESS")
+            await writer.drain()
+            
+        except asyncio.TimeoutError:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: no data for {self.read_timeout}s")
+            await self._disk(discard_staged_file, part_path)
+            if cut_through:
+                cut_through.abort()
+            self._send_error(writer, "read timeout")
+        except asyncio.CancelledError:
+            discard_staged_file(part_path)
+            if cut_through:
+                cut_through.abort()
+            raise
+        except Exception as e:
+            METRICS.error("receive")
+            logger.error(f"Error handling client {addr}: {str(e)}")
+            await self._disk(discard_staged_file, part_path)
+            if cut_through:
+                cut_through.abort()
+            self._send_error(writer, str(e))
+    
+    def _send_error(self, writer, message):
+        try:
+            writer.write(f"ERROR: {message}".encode('utf-8'))
+        except Exception:
+            pass
+
+# Build the receiver selected by CONFIG["receiver_mode"]
+def create_file_receiver(host='0.0.0.0', port=None, reuse_port=False):
+    if CONFIG["receiver_mode"] == "threaded":
+        return FileReceiver(host, port, reuse_port)
+    return AsyncFileReceiver(host, port, reuse_port)
+
+# Entry point of a receiver process started by ReceiverProcesses.
+#
+# Receiver processes only receive: each upload is published into incoming_dir,
+# where the parent's watcher picks it up, so the ingest queue, connection pool,
+# journal, manifests and retries keep a single owner. Cut-through relaying is
+# therefore off in these processes.
+def run_receiver_process(config, index, shared_depth, config_path=None):
+    global ROUTER, INGEST_QUEUE
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # The parent handles Ctrl-C and terminates us
+    CONFIG.update(config)
+    setup_logging()
+    CONFIG["cut_through"] = dict(CONFIG["cut_through"], enabled=False)
+    ROUTER = FileRouter(CONFIG)
+    INGEST_QUEUE = SharedIngestGate(shared_depth, CONFIG["ingest_queue"]["high_watermark"])
+    if config_path and CONFIG["config_reload_interval"]:
+        ConfigWatcher(config_path, CONFIG["config_reload_interval"]).start()
+    logger.info(f"Receiver process {index} (pid {os.getpid()}) starting")
+    create_file_receiver(reuse_port=True).start()
+
+# Receiver processes sharing server_port through SO_REUSEPORT; the kernel
+# spreads incoming connections across them. Dead processes are restarted.
+class ReceiverProcesses:
+    def __init__(self, count, config_path=None):
+        self.count = count
+        self.config_path = config_path
+        self.context = multiprocessing.get_context("spawn")
+        self.shared_depth = self.context.RawValue('i', 0)
+        self.processes = [None] * count
+    
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        logger.info(f"Started {self.count} receiver processes on port {CONFIG['server_port']}")
+    
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=run_receiver_process,
+            args=(CONFIG, index, self.shared_depth, self.config_path),
+            name=f"receiver-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+    
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Receiver process {index} exited with {process.exitcode}, restarting it")
+                self._spawn(index)
+    
+    def stop(self):
+        for process in self.processes:
+            if process is not None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+# Main function
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="R-Car S4 File Relay System")
+    parser.add_argument("--config", help="Path to configuration file")
+    query = parser.add_argument_group("transfer journal query", "e.g. --query --device zc2 --status failed --since yesterday --until today")
+    query.add_argument("--query", action="store_true", help="Query the transfer journal and exit")
+    query.add_argument("--file", help="Only transfers of this file name")
+    query.add_argument("--device", help="Only destinations on this Raspberry Pi")
+    query.add_argument("--status", choices=["success", "failed", "deferred"], help="Only destinations with this status")
+    query.add_argument("--since", help="Start time: ISO date/time, today, yesterday or an age such as 6h or 7d")
+    query.add_argument("--until", help="End time (exclusive), same formats as --since")
+    query.add_argument("--limit", type=int, help="Maximum number of records")
+    query.add_argument("--json", action="store_true", help="Print records as JSON lines")
+    args = parser.parse_args()
+    
+    # Load configuration from file if specified
+    config_watcher = None
+    config_error = None
+    if args.config:
+        try:
+            load_config(args.config)
+        except Exception as e:
+            config_error = e
+    
+    setup_logging()
+    if config_error:
+        logger.error(f"Failed to load configuration: {str(config_error)}")
+    elif args.config and not args.query:
+        logger.info(f"Loaded configuration from {args.config}")
+    
+    if args.query:
+        print_journal_query(args)
+        return
+    
+    logger.info("Starting R-Car S4 File Relay System")
+    
+    if args.config and CONFIG["config_reload_interval"]:
+        config_watcher = ConfigWatcher(args.config, CONFIG["config_reload_interval"])
+        config_watcher.start()
+    
+    # Ensure necessary directories exist
+    ensure_directories()
+    
+    global SFTP_POOL, HEALTH, FORWARD_STORE, SCHEDULER, FANOUT, RETRY_SCHEDULER, INGEST_QUEUE
+    SFTP_POOL = SFTPConnectionPool(**CONFIG["sftp_pool"])
+    HEALTH = TargetHealth(**CONFIG["health"])
+    FORWARD_STORE = ForwardStore(CONFIG["store_forward_dir"])
+    SCHEDULER = TransferScheduler(**CONFIG["scheduler"])
+    FANOUT = FanoutEngine(**CONFIG["fanout"])
+    RETRY_SCHEDULER = RetryScheduler(**CONFIG["retry"])
+    
+    # Detected files go through a persistent queue to the relay workers
+    INGEST_QUEUE = IngestQueue(**CONFIG["ingest_queue"])
+    
+    # Start TCP server for file reception first, in receiver processes when configured;
+    # everything else (including loading the SSH stack) happens while it accepts uploads
+    multiprocess = CONFIG["multiprocess"]
+    receiver_processes = None
+    if multiprocess["receiver_processes"] and hasattr(socket, "SO_REUSEPORT"):
+        receiver_processes = ReceiverProcesses(multiprocess["receiver_processes"], args.config)
+        INGEST_QUEUE.shared_depth = receiver_processes.shared_depth
+        receiver_processes.start()
+    else:
+        if multiprocess["receiver_processes"]:
+            logger.warning("SO_REUSEPORT is not available, receiving in-process")
+        file_receiver = create_file_receiver()
+        server_thread = threading.Thread(target=file_receiver.start)
+        server_thread.daemon = True
+        server_thread.start()
+        file_receiver.ready.wait(5)
+    
+    # Before ingest starts: a new CAS object has one link until its outgoing file is linked
+    prune_outgoing_objects()
+    INGEST_QUEUE.start()
+    HEALTH.start()
+    threading.Thread(target=FORWARD_STORE.drain_all, name="forward-backlog", daemon=True).start()
+    if multiprocess["cpu_workers"]:
+        start_cpu_pool(multiprocess["cpu_workers"])
+    
+    metrics_exporter = MetricsExporter(**CONFIG["metrics"])
+    metrics_exporter.start()
     
     # Start file watcher for incoming directory
-    event_handler = NewFileHandler()
-    observer = Observer()
-    observer.schedule(event_handler, CONFIG["incoming_dir"], recursive=False)
+    observer = create_observer()
+    event_handler = NewFileHandler(INGEST_QUEUE.put, close_events=observer_has_close_events(observer))
+    # Recursive so renames out of a staging_dir inside incoming_dir arrive as moves
+    observer.schedule(event_handler, CONFIG["incoming_dir"], recursive=True)
     observer.start()
     logger.info(f"Watching for new files in {CONFIG['incoming_dir']}")
     
-    # Start TCP server for file reception in a new thread
-    file_receiver = FileReceiver()
-    server_thread = threading.Thread(target=file_receiver.start)
-    server_thread.daemon = True
-    server_thread.start()
+    # Files that arrived while the relay was down produced no events
+    threading.Thread(target=queue_backlog, args=(event_handler,), name="backlog-scan", daemon=True).start()
     
     try:
         # Keep the main thread running
         while True:
             time.sleep(1)
+            if receiver_processes:
+                receiver_processes.check()
     except KeyboardInterrupt:
         logger.info("Stopping file relay service...")
         observer.stop()
     
+    if receiver_processes:
+        receiver_processes.stop()
     observer.join()
+    if config_watcher:
+        config_watcher.stop()
+    INGEST_QUEUE.stop()
+    metrics_exporter.stop()
+    HEALTH.stop()
+    RETRY_SCHEDULER.stop()
+    FANOUT.stop()
+    SFTP_POOL.close()
+    stop_cpu_pool()
+    save_manifests()
+    if JOURNAL:
+        JOURNAL.close()
     logger.info("File relay service stopped")
 
 if __name__ == "__main__":
@@ -1,13 +1,15 @@
 import os
+import json
 import logging
 import atexit
-import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 import werkzeug.exceptions
 from dotenv import load_dotenv
 
 import database
+import upstream
+from filehandler import FileHandler
 
 load_dotenv()
 
@@ -20,17 +22,98 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 database.init_db()
+database.KNOWN_VERSIONS.start()
+file_handler = FileHandler()
 
 @app.route('/', methods=['GET'])
 def update_checker():
-    response = requests.get(os.getenv("CHECK_UPDATE_API"))
-    data = response.json()
-    version_data = data["Update details"]
+    try:
+        version_data = upstream.get_update_details()
+    except Exception as e:
+        logger.error(f"Update check failed: {e}")
+        return jsonify({"message": "Update server unavailable"}), 502
     logger.info(f"Version data: {version_data}")
     if database.check_update(version_data["id"]):
         return jsonify({"message": "Update available", "version": version_data["id"]}), 200
     else:
         return jsonify({"message": "No update available", "version": version_data["id"]}), 200
 
+# Many versions and/or ECUs in one call:
+#   {"versions": ["1.2.3", ...], "ecus": {"ecu-1": "1.2.2", ...}}
+# Every version is answered with whether it is known; each ECU also gets the
+# latest upstream version and whether an update is available for it.
+@app.route('/batch', methods=['POST'])
+def batch_update_checker():
+    body = request.get_json(silent=True) or {}
+    versions = body.get("versions", [])
+    ecus = body.get("ecus", {})
+    if not isinstance(versions, list) or not isinstance(ecus, dict) or \
+            not all(isinstance(v, (str, int)) for v in versions + list(ecus.values())):
+        return jsonify({"message": "Expected a list of versions and/or a map of ECU versions"}), 400
+    versions = [str(version) for version in versions]
+    ecus = {ecu: str(version) for ecu, version in ecus.items()}
 
+    latest = None
+    if ecus:
+        try:
+            latest = str(upstream.get_update_details()["id"])
+        except Exception as e:
+            logger.error(f"Update check failed: {e}")
+    known = database.check_updates(versions + list(ecus.values()) + ([latest] if latest else []))
+    if known is None:
+        return jsonify({"message": "Version database unavailable"}), 503
 
+    result = {"versions": {version: known[version] for version in versions}}
+    if ecus:
+        result["latest"] = latest
+        result["ecus"] = {
+            ecu: {
+                "version": version,
+                "known": known[version],
+                "update_available": bool(latest) and known[latest] and version != latest
+            }
+            for ecu, version in ecus.items()
+        }
+    return jsonify(result), 200
+
+# Streams newline-delimited JSON: a line as each stage starts, then the outcome
+# (or an error) as the last line, so the client sees progress while the
+# package downloads and forwards instead of waiting on one buffered response
+@app.route('/api/download/', methods=['GET'])
+def download_update():
+    try:
+        version_data = upstream.get_update_details()
+    except Exception as e:
+        logger.error(f"Update check failed: {e}")
+        return jsonify({"status": "error", "message": "Update server unavailable"}), 502
+
+    version = version_data["id"]
+    return Response(process_update(version, version_data), mimetype="application/x-ndjson")
+
+def process_update(version, version_data):
+    def line(**event):
+        return json.dumps(event) + "\n"
+
+    with file_handler.version_lock(version):
+        if database.check_update(version):
+            yield line(status="success", message=f"Version {version} already processed")
+            return
+        try:
+            yield line(status="downloading", version=version)
+            path = file_handler.download_update(version_data)
+            targets = file_handler.read_package_config(path)
+            yield line(status="forwarding", version=version,
+                       targets=[f"{target['ip']}:{target['target_dir']}" for target in targets])
+            results, confirmed = file_handler.forward(path, targets)
+        except Exception as e:
+            logger.error(f"Error processing update {version}: {e}")
+            yield line(status="error", message=str(e))
+            return
+
+        # Only a version every target confirmed counts as processed
+        if not confirmed:
+            yield line(status="error", message=f"Forwarding {version} failed", targets=results)
+            return
+        database.record_version(version, os.path.basename(path), version_data.get("update_type", "full"))
+
+    yield line(status="success", message=f"File downloaded and saved as {path}", version=version, targets=results)
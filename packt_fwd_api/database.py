@@ -1,9 +1,14 @@
 import os
+import time
+import atexit
 import logging
+import select
+import threading
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.errors
 from psycopg2 import pool
-from psycopg2.extras import DictCursor
-from psycopg2.binary import Binary
+from psycopg2.extras import execute_values
 import io
 from dotenv import load_dotenv 
 
@@ -23,32 +28,254 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-def init_db():
-    try:
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        logger.info("Database connection established")
-
-        # Create a cursor object
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS version_recieved (
-                id SERIAL PRIMARY KEY,
-                version VARCHAR(255) NOT NULL,
-                file_name VARCHAR(255) NOT NULL,
-                update_type VARCHAR(255) NOT NULL,
-                time_stamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+# Connection pool settings
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))  # Idle seconds before a ping
+
+# LISTEN needs a session that stays on one server connection; point these at the
+# database directly when DB_HOST/DB_PORT is a transaction-mode pooler
+DB_LISTEN_HOST = os.getenv("DB_LISTEN_HOST", DB_HOST)
+DB_LISTEN_PORT = os.getenv("DB_LISTEN_PORT", DB_PORT)
+VERSION_CHANNEL = "version_recieved"
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)  # Callers wait for a free connection instead of failing
+_last_used = {}                                           # id(conn) -> time it was returned to the pool
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                host=DB_HOST,
+                port=DB_PORT,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                keepalives=1,
+                keepalives_idle=60
             )
-        ''')
+            logger.info(f"Database connection pool created ({DB_POOL_MIN}-{DB_POOL_MAX} connections)")
+        return _pool
+
+# Whether a pooled connection can still be used; connections idle for longer
+# than DB_HEALTH_CHECK_INTERVAL are pinged before being handed out
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+# Borrow a connection from the pool; commits on success, rolls back on error
+@contextmanager
+def get_connection():
+    db_pool = get_pool()                  # Before taking a slot: creating the pool can fail
+    _pool_slots.acquire()
+    conn = None
+    broken = False
+    try:
+        conn = db_pool.getconn()
+        if not _is_healthy(conn):
+            logger.warning("Discarding broken database connection")
+            db_pool.putconn(conn, close=True)
+            _last_used.pop(id(conn), None)
+            conn = db_pool.getconn()
+        yield conn
         conn.commit()
-        logger.info("Table 'version_recieved' created or already exists")
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            broken = broken or bool(conn.closed)
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            db_pool.putconn(conn, close=broken)
+        _pool_slots.release()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            logger.info("Database connection pool closed")
+        _pool = None
+        _last_used.clear()
+
+atexit.register(close_pool)
+
+# In-memory set of every version in version_recieved
+#
+# A listener thread holds its own connection and LISTENs on VERSION_CHANNEL,
+# which the table's trigger notifies on every insert and delete. It starts
+# listening before the bulk load so no change can slip in between. Until the
+# set is loaded, and whenever the listener has lost its connection, lookups go
+# to the database instead.
+class VersionCache:
+    def __init__(self, reconnect_delay=5):
+        self.versions = set()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.reconnect_delay = reconnect_delay
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._listen, name="version-listener", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    # {version: known} for every version asked about
+    def lookup(self, versions):
+        if self.ready.is_set():
+            with self.lock:
+                return {version: version in self.versions for version in versions}
+        return _query_versions(versions)
+
+    def add(self, versions):
+        with self.lock:
+            self.versions.update(versions)
+
+    def _load(self):
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT version FROM version_recieved")
+                versions = {row[0] for row in cursor}
+        with self.lock:
+            self.versions = versions
+        logger.info(f"Loaded {len(versions)} known versions")
+
+    def _apply(self, payload):
+        op, _, version = payload.partition(":")
+        with self.lock:
+            if op == "DELETE":
+                self.versions.discard(version)
+            else:
+                self.versions.add(version)
+
+    def _listen(self):
+        while not self.stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(
+                    host=DB_LISTEN_HOST,
+                    port=DB_LISTEN_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    connect_timeout=DB_CONNECT_TIMEOUT,
+                    keepalives=1,
+                    keepalives_idle=60
+                )
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {VERSION_CHANNEL}")
+                self._load()
+                self.ready.set()
+                while not self.stop_event.is_set():
+                    if select.select([conn], [], [], 5)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self._apply(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Version listener error, falling back to database lookups: {e}")
+            finally:
+                self.ready.clear()
+                if conn is not None:
+                    conn.close()
+            self.stop_event.wait(self.reconnect_delay)
+
+KNOWN_VERSIONS = VersionCache()
+atexit.register(KNOWN_VERSIONS.stop)
+
+# {version: known} straight from the database, in one query
+def _query_versions(versions):
+    versions = list(dict.fromkeys(versions))
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT version FROM version_recieved WHERE version = ANY(%s)
+            ''', (versions,))
+            found = {row[0] for row in cursor}
+    return {version: version in found for version in versions}
+
+
+def init_db():
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS version_recieved (
+                        id SERIAL PRIMARY KEY,
+                        version VARCHAR(255) NOT NULL,
+                        file_name VARCHAR(255) NOT NULL,
+                        update_type VARCHAR(255) NOT NULL,
+                        time_stamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+            conn.commit()
+            logger.info("Table 'version_recieved' created or already exists")
+
+            # Version lookups use this index; older tables may already hold duplicates
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('''
+                        CREATE UNIQUE INDEX IF NOT EXISTS version_recieved_version_key
+                        ON version_recieved (version)
+                    ''')
+                conn.commit()
+            except psycopg2.errors.UniqueViolation:
+                conn.rollback()
+                logger.warning("Duplicate versions in 'version_recieved', creating a non-unique index instead")
+                with conn.cursor() as cursor:
+                    cursor.execute('''
+                        CREATE INDEX IF NOT EXISTS version_recieved_version_idx
+                        ON version_recieved (version)
+                    ''')
+                conn.commit()
+
+            # Tell listeners about every change so their version sets stay current
+            with conn.cursor() as cursor:
+                cursor.execute(f'''
+                    CREATE OR REPLACE FUNCTION notify_version_recieved() RETURNS trigger AS $$
+                    BEGIN
+                        IF TG_OP = 'DELETE' THEN
+                            PERFORM pg_notify('{VERSION_CHANNEL}', 'DELETE:' || OLD.version);
+                        ELSE
+                            PERFORM pg_notify('{VERSION_CHANNEL}', TG_OP || ':' || NEW.version);
+                        END IF;
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql
+                ''')
+                cursor.execute("DROP TRIGGER IF EXISTS version_recieved_notify ON version_recieved")
+                cursor.execute('''
+                    CREATE TRIGGER version_recieved_notify
+                    AFTER INSERT OR DELETE ON version_recieved
+                    FOR EACH ROW EXECUTE PROCEDURE notify_version_recieved()
+                ''')
     
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
@@ -56,23 +283,7 @@ def init_db():
 
 def check_update(version):
     try:
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        logger.info("Database connection established")
-
-        # Create a cursor object
-        cursor = conn.cursor(cursor_factory=DictCursor)
-
-        cursor.execute('''
-            SELECT * FROM version_recieved WHERE version = %s
-        ''', (version,))
-        result = cursor.fetchone()
+        result = KNOWN_VERSIONS.lookup([version])[version]
 
         if result:
             logger.info(f"Version {version} already exists in the database")
@@ -84,5 +295,29 @@ def check_update(version):
     except Exception as e:
         logger.error(f"Error checking version in database: {e}")
 
+# {version: known} for many versions at once
+def check_updates(versions):
+    try:
+        return KNOWN_VERSIONS.lookup(versions)
+    except Exception as e:
+        logger.error(f"Error checking versions in database: {e}")
 
+# Insert (version, file_name, update_type) rows in one multi-row statement,
+# skipping versions that are already recorded
+def record_versions(rows):
+    rows = list({row[0]: row for row in rows}.values())
+    if not rows:
+        return
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            execute_values(cursor, '''
+                INSERT INTO version_recieved (version, file_name, update_type)
+                SELECT v.version, v.file_name, v.update_type
+                FROM (VALUES %s) AS v (version, file_name, update_type)
+                WHERE NOT EXISTS (SELECT 1 FROM version_recieved r WHERE r.version = v.version)
+            ''', rows, page_size=1000)
+    KNOWN_VERSIONS.add(row[0] for row in rows)
+    logger.info(f"Recorded {len(rows)} versions")
 
+def record_version(version, file_name, update_type):
+    record_versions([(version, file_name, update_type)])
@@ -0,0 +1,190 @@
+import os
+import json
+import shlex
+import hashlib
+import logging
+import posixpath
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+from dotenv import load_dotenv
+
+import upstream
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_PATH = os.getenv("DOWNLOAD_PATH", "downloads")
+DOWNLOAD_API = os.getenv("DOWNLOAD_API")                 # Used when the update details carry no download URL
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "60"))
+SFTP_CHUNK_SIZE = 1024 * 1024
+SSH_TIMEOUT = float(os.getenv("SSH_TIMEOUT", "10"))      # Seconds for each of TCP connect, SSH banner and authentication
+
+class FileHandler:
+    def __init__(self, download_path=DOWNLOAD_PATH):
+        self.download_path = download_path
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        os.makedirs(download_path, exist_ok=True)
+
+    # One download/forward at a time per version; concurrent requests wait for it
+    def version_lock(self, version):
+        with self.locks_lock:
+            return self.locks.setdefault(version, threading.Lock())
+
+    # Stream url to DOWNLOAD_PATH/file_name, resuming a partial download with a
+    # Range request, and hash it as it is written. Returns (path, sha256).
+    def download(self, url, file_name, expected_sha256=None):
+        path = os.path.join(self.download_path, os.path.basename(file_name))
+        part_path = path + ".part"
+        meta_path = part_path + ".json"
+        digest = hashlib.sha256()
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        meta = {}
+        if offset:
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+            if meta.get("url") != url:
+                offset = 0
+
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if meta.get("etag"):
+                headers["If-Range"] = meta["etag"]    # Server sends the whole file if it changed
+        timeout = (upstream.UPSTREAM_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+        with upstream.session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 416 and offset:
+                logger.info(f"{file_name} was already fully downloaded")
+                response = None
+            elif response.status_code == 206 and offset:
+                logger.info(f"Resuming download of {file_name} at {offset} bytes")
+            else:
+                response.raise_for_status()
+                offset = 0
+            with open(meta_path, 'w') as f:
+                json.dump({"url": url, "etag": response.headers.get("ETag") if response else meta.get("etag")}, f)
+
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                # Re-hash what is already on disk, then hash new data as it streams in
+                while f.tell() < offset:
+                    chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, offset - f.tell()))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                f.seek(offset)
+                f.truncate()
+                if response is not None:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+
+        sha256 = digest.hexdigest()
+        if expected_sha256 and sha256 != expected_sha256.lower():
+            os.remove(part_path)
+            os.remove(meta_path)
+            raise ValueError(f"Checksum mismatch for {file_name}: expected {expected_sha256}, got {sha256}")
+        os.replace(part_path, path)
+        os.remove(meta_path)
+        logger.info(f"File downloaded and saved as {path} (sha256 {sha256})")
+        return path, sha256
+
+    # The package's deployment config.json: the shallowest one in the archive
+    @staticmethod
+    def config_member(zf):
+        names = [name for name in zf.namelist() if posixpath.basename(name) == "config.json"]
+        if not names:
+            raise FileNotFoundError(f"No config.json in {zf.filename}")
+        return min(names, key=len)
+
+    # Deployment targets from the package's config.json: "update_details" is
+    # one target or a list of them ({"ip", "username", "password", "target_dir"})
+    def read_package_config(self, zip_path):
+        with zipfile.ZipFile(zip_path) as zf:
+            with zf.open(self.config_member(zf)) as f:
+                config = json.load(f)
+        targets = config["update_details"]
+        return targets if isinstance(targets, list) else [targets]
+
+    # Forward every member of the archive except its deployment config to one
+    # target, streaming each one out of the ZIP straight into a remote file.
+    # Returns the number of files sent.
+    def forward_to_target(self, zip_path, target):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(target["ip"], port=target.get("port", 22), username=target["username"],
+                    password=target["password"], timeout=SSH_TIMEOUT, banner_timeout=SSH_TIMEOUT,
+                    auth_timeout=SSH_TIMEOUT)
+        try:
+            with zipfile.ZipFile(zip_path) as zf:
+                config_name = self.config_member(zf)
+                members = []
+                for info in zf.infolist():
+                    name = posixpath.normpath(info.filename)
+                    if info.is_dir() or info.filename == config_name or name.startswith(("/", "../")) or name == "..":
+                        continue
+                    members.append((info, posixpath.join(target["target_dir"], name)))
+
+                remote_dirs = sorted({posixpath.dirname(path) for _, path in members} | {target["target_dir"]})
+                _, stdout, stderr = ssh.exec_command("mkdir -p " + " ".join(shlex.quote(d) for d in remote_dirs))
+                if stdout.channel.recv_exit_status() != 0:
+                    raise IOError(f"mkdir failed on {target['ip']}: {stderr.read().decode('utf-8', 'replace')}")
+
+                sftp = ssh.open_sftp()
+                try:
+                    for info, remote_path in members:
+                        part_path = remote_path + ".part"
+                        with zf.open(info) as src, sftp.open(part_path, 'wb') as dst:
+                            dst.set_pipelined(True)
+                            while True:
+                                chunk = src.read(SFTP_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                dst.write(chunk)
+                        size = sftp.stat(part_path).st_size
+                        if size != info.file_size:
+                            raise IOError(f"{remote_path} on {target['ip']} has {size} of {info.file_size} bytes")
+                        sftp.posix_rename(part_path, remote_path)
+                finally:
+                    sftp.close()
+        finally:
+            ssh.close()
+        logger.info(f"Forwarded {len(members)} files from {zip_path} to {target['ip']}:{target['target_dir']}")
+        return len(members)
+
+    # Forward the archive to all targets at once. Returns {"ip:target_dir": result}
+    # and whether every target confirmed.
+    def forward(self, zip_path, targets):
+        results = {}
+        confirmed = True
+        with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+            futures = {executor.submit(self.forward_to_target, zip_path, target): target for target in targets}
+            for future, target in futures.items():
+                # Several targets can share a host, each with its own directory
+                key = f"{target['ip']}:{target['target_dir']}"
+                try:
+                    result = {"status": "success", "files": future.result()}
+                except Exception as e:
+                    logger.error(f"Error forwarding {zip_path} to {key}: {e}")
+                    result = {"status": "error", "message": str(e)}
+                    confirmed = False
+                if results.get(key, {}).get("status") != "error":
+                    results[key] = result
+        return results, confirmed
+
+    # Download and verify one update's package. Returns its path.
+    def download_update(self, version_data):
+        url = version_data.get("download_url") or version_data.get("file_url") or DOWNLOAD_API
+        if not url:
+            raise ValueError("No download URL in update details and DOWNLOAD_API is not set")
+        file_name = version_data.get("file_name") or f"update_{version_data['id']}.zip"
+        expected = version_data.get("sha256") or version_data.get("checksum")
+        path, _ = self.download(url, file_name, expected)
+        return path
@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CHECK_UPDATE_API = os.getenv("CHECK_UPDATE_API")
+
+# Upstream check settings
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "5"))
+UPSTREAM_CACHE_TTL = float(os.getenv("UPSTREAM_CACHE_TTL", "30"))    # Seconds a response is served without asking upstream
+UPSTREAM_STALE_TTL = float(os.getenv("UPSTREAM_STALE_TTL", "300"))   # Seconds an expired response may still be served while refreshing
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "10"))
+
+# Keep-alive connections to the update server, shared by all requests
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE))
+
+class _Entry:
+    def __init__(self, data, etag, last_modified, ttl):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.ttl = ttl
+        self.fetched_at = time.monotonic()
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+# TTL cache in front of one upstream JSON endpoint
+#
+# Fresh responses are served from memory. Expired ones are revalidated with a
+# conditional GET (If-None-Match / If-Modified-Since). While an expired
+# response is still within the stale window it is served at once and
+# revalidated in the background. Concurrent requests share one in-flight
+# upstream call, and a failed call falls back to the last response if any.
+class UpstreamCache:
+    def __init__(self, url, ttl=UPSTREAM_CACHE_TTL, stale_ttl=UPSTREAM_STALE_TTL,
+                 timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.entry = None
+        self.flight = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            entry = self.entry
+            age = time.monotonic() - entry.fetched_at if entry else None
+            if entry and age < entry.ttl:
+                return entry.data
+            flight = self.flight
+            leader = flight is None
+            if leader:
+                flight = self.flight = _Flight()
+
+        if entry and age < self.stale_ttl:
+            # Stale-while-revalidate: answer now, refresh once in the background
+            if leader:
+                threading.Thread(target=self._fetch, args=(flight, entry), daemon=True).start()
+            return entry.data
+
+        if leader:
+            self._fetch(flight, entry)
+        else:
+            flight.done.wait(sum(self.timeout))
+        if flight.error is not None or not flight.done.is_set():
+            if entry:
+                logger.warning(f"Update server unavailable, serving response from {age:.0f}s ago")
+                return entry.data
+            raise flight.error or requests.Timeout(f"Timed out waiting for {self.url}")
+        return flight.data
+
+    def _fetch(self, flight, entry):
+        try:
+            headers = {}
+            if entry and entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry and entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+            response = session.get(self.url, headers=headers, timeout=self.timeout)
+            max_age = self._max_age(response)
+            ttl = self.ttl if max_age is None else max_age
+            if response.status_code == 304 and entry:
+                new_entry = _Entry(entry.data, response.headers.get("ETag", entry.etag),
+                                   response.headers.get("Last-Modified", entry.last_modified), ttl)
+            else:
+                response.raise_for_status()
+                new_entry = _Entry(response.json(), response.headers.get("ETag"),
+                                   response.headers.get("Last-Modified"), ttl)
+            with self.lock:
+                self.entry = new_entry
+            flight.data = new_entry.data
+        except Exception as e:
+            logger.error(f"Error checking update server: {e}")
+            flight.error = e
+        finally:
+            with self.lock:
+                if self.flight is flight:
+                    self.flight = None
+            flight.done.set()
+
+    # Cache-Control max-age from the update server, if it sent one
+    @staticmethod
+    def _max_age(response):
+        for directive in response.headers.get("Cache-Control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name.lower() == "max-age" and value.isdigit():
+                return float(value)
+        return None
+
+_update_cache = UpstreamCache(CHECK_UPDATE_API)
+
+# Latest "Update details" published by the update server
+def get_update_details():
+    return _update_cache.get()["Update details"]